@@ -20,6 +20,9 @@ def kcenters(
     n_clusters: int = typer.Option(100, help="Number of clusters"),
     stride: int = typer.Option(None, help="Stride"),
     output_dir: str = typer.Option(".", help="Output directory"),
+    chunk_size: int = typer.Option(None, help="Stream trajectories in chunks of this many frames instead of loading them all"),
+    checkpoint: str = typer.Option(None, help="Directory to checkpoint the clustering to"),
+    resume: bool = typer.Option(False, help="Resume from the checkpoint directory if it holds a checkpoint"),
 ):
     """Run K-Centers clustering."""
     workflows.run_clustering(
@@ -30,7 +33,10 @@ def kcenters(
         iext=iext,
         n_clusters=n_clusters,
         stride=stride,
-        output_dir=output_dir
+        output_dir=output_dir,
+        chunk_size=chunk_size,
+        checkpoint=checkpoint,
+        resume=resume
     )
 
 @cluster_app.command("aplod")
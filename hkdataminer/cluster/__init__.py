@@ -2,5 +2,8 @@
 from .kcenters_ import *
 #from .leader_follower_ import *
 from .dbscan_ import *
+from .dbscan_sweep_ import *
 from .faiss_dbscan_ import *
-from .aplod_ import *
\ No newline at end of file
+from .aplod_ import *
+from .sharded_kcenters_ import *
+from .kmedoids_ import *
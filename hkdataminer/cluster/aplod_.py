@@ -5,7 +5,10 @@ __version__ = "0.91"
 # All rights reserved.
 # ===============================================================================
 # GLOBAL IMPORTS:
+import os
+import math
 import random
+import warnings
 import operator
 import time
 import numpy as np
@@ -15,71 +18,49 @@ from sklearn.utils import check_array
 from sklearn.neighbors import NearestNeighbors
 from sklearn.metrics.pairwise import pairwise_distances_argmin
 from sklearn.utils.validation import check_is_fitted
-from ..metrics.pairwise import pairwise_distances
+from ..metrics.pairwise import pairwise_distances, kneighbors, requires_native
+from ..metrics.rmsd_ import as_rmsd_dataset
+from ..metrics.vptree_ import VPTree
+from ..metrics.knn_graph_ import KNNGraph
+from .faiss_dbscan_ import new_index, build_index, set_nprobe, knn_search, faiss_threads
 from functools import reduce
 # ===============================================================================
 # LOCAL IMPORTS:
-#import knn as knnn
 # ===============================================================================
 import faiss
 
-def FaissNearestNeighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True, GPU=False):
-    dimension = X.shape[1]
-    if GPU is True:
-        if IVFFlat is True:
-            quantizer = faiss.IndexFlatL2(dimension)
-            index_cpu = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+def FaissNearestNeighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True, GPU=False,
+                          index_factory=None, refine_factor=None, report=None, batch_size=65536, n_jobs=None):
+    # index_factory, refine_factor, report, batch_size, n_jobs: see faiss_dbscan
+    with faiss_threads(n_jobs):
+        dimension = X.shape[1]
+        if GPU is True:
+            index_cpu = new_index(dimension, nlist, IVFFlat, index_factory)
             # here we specify METRIC_L2, by default it performs inner-product search
             res = faiss.StandardGpuResources()  # use a single GPU
             flat_config = faiss.GpuIndexFlatConfig()
             flat_config.device = 0
-            # make it an IVF GPU index
-            index_gpu = faiss.index_cpu_to_gpu(res, 0, index_cpu)
-            assert not index_gpu.is_trained
-            index_gpu.train(X)
-            assert index_gpu.is_trained
-            # here we specify METRIC_L2, by default it performs inner-product search
+            index = faiss.index_cpu_to_gpu(res, 0, index_cpu)
+            if not index.is_trained:
+                index.train(X)
+            index.add(X)
         else:
-            index_cpu = faiss.IndexFlatL2(dimension)
-            res = faiss.StandardGpuResources()
-            flat_config = faiss.GpuIndexFlatConfig()
-            flat_config.device = 0
-            index_gpu = faiss.index_cpu_to_gpu(res, 0, index_cpu)
-        index_gpu.add(X)
+            index = build_index(X, nlist, IVFFlat, index_factory, report)
         n_samples = 10
         k = min_samples
         samples = np.random.choice(len(X), n_samples)
         # print(samples)
-        D, I = index_gpu.search(X[samples], k)  # sanity check
-        while np.max(D[:, k - 1]) < eps:
+        D, I = index.search(X[samples], k)  # sanity check
+        # eps is a Euclidean distance, as in faiss_dbscan; D holds squared L2 distances
+        while np.max(D[:, k - 1]) < eps ** 2:
             k = k * 2
-            D, I = index_gpu.search(X[samples], k)
+            D, I = index.search(X[samples], k)
             # print(np.max(D[:, k - 1]), k, eps)
-        index_gpu.nprobe = nprobe
-        D, I = index_gpu.search(X, k)  # actual search
-    else:
-        if IVFFlat is True:
-            quantizer = faiss.IndexFlatL2(dimension)
-            index_cpu = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
-            # here we specify METRIC_L2, by default it performs inner-product search
-            assert not index_cpu.is_trained
-            index_cpu.train(X)
-            assert index_cpu.is_trained
-            # here we specify METRIC_L2, by default it performs inner-product search
-        else:
-            index_cpu = faiss.IndexFlatL2(dimension)
-        index_cpu.add(X)
-        n_samples = 10
-        k = min_samples
-        samples = np.random.choice(len(X), n_samples)
-        # print(samples)
-        D, I = index_cpu.search(X[samples], k)  # sanity check
-        while np.max(D[:, k - 1]) < eps:
-            k = k * 2
-            D, I = index_cpu.search(X[samples], k)
-            # print(np.max(D[:, k - 1]), k, eps)
-        index_cpu.nprobe = nprobe
-        D, I = index_cpu.search(X, k)  # actual search
+        if GPU is not True:
+            set_nprobe(index, nprobe)
+        elif IVFFlat is True and index_factory is None:
+            index.nprobe = nprobe
+        D, I = knn_search(index, X, k, refine_factor, batch_size)  # actual search
     if return_distance is True:
         return D, I
     else:
@@ -90,14 +71,14 @@ def run_knn(X, n_neighbors=100, n_samples=1000, metric='rmsd', algorithm='vp_tre
     #print "Calculating pairwise ", metric, " distances of ", n_samples, " samples..."
     t0 = time.time()
     if metric == "rmsd":
-        # samples = random.sample(list(X), n_samples)
-        # whole_samples= reduce(operator.add, (samples[i] for i in range(len(samples))))
-        # Abandoning RMSD path as per instruction since knnn is missing
-        raise NotImplementedError("RMSD metric is not supported in this APLoD version (missing knnn). Please use Euclidean on featurized data.")
+        # center the trajectory once; the samples and the VP-tree share it
+        X = as_rmsd_dataset(X)
+        whole_samples = X[sorted(random.sample(range(len(X)), n_samples))]
     else:
         whole_samples = random.sample(list(X), n_samples)
     
-    sample_dist_metric = pairwise_distances( whole_samples, whole_samples, metric=metric )
+    # Y=None: symmetric, every pair is computed once
+    sample_dist_metric = pairwise_distances(whole_samples, metric=metric)
     t1 = time.time()
     #print("time:", t1-t0)
     #print("Done.")
@@ -109,15 +90,14 @@ def run_knn(X, n_neighbors=100, n_samples=1000, metric='rmsd', algorithm='vp_tre
     t0 = time.time()
     
     if metric == 'rmsd':
-        # Abandoned path
-        pass
+        # exact kNN with the built-in vantage-point tree
+        distances_, indices = VPTree(X, metric=metric).query(X, k=n_neighbors)
+    elif requires_native(metric):
+        # e.g. "periodic" for dihedral angles: brute force in blocks with the native kernel
+        distances_, indices = kneighbors(X, n_neighbors, metric=metric)
     else:
         if algorithm == 'vp_tree':
-            # Missing knnn, fallback to auto/sklearn
-            print("Warning: vp_tree algorithm requested but knnn module missing. Falling back to sklearn NearestNeighbors.")
-            neighbors_model = NearestNeighbors(n_neighbors=n_neighbors, algorithm='auto', metric=metric)
-            neighbors_model.fit(X)
-            distances_, indices = neighbors_model.kneighbors(X, n_neighbors=n_neighbors, return_distance=True)
+            distances_, indices = VPTree(X, metric=metric).query(X, k=n_neighbors)
         else:
             neighbors_model = NearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm, metric=metric)
             neighbors_model.fit(X)
@@ -135,13 +115,46 @@ def calculate_rho(X_len, n_neighbors, dc_2, indices, distances_):
         for j in range(0,n_neighbors):
             index = indices[i,j]
             dist = distances_[i,j]
-            gaussian = np.math.exp(-(dist**2/dc_2))
+            gaussian = math.exp(-(dist**2/dc_2))
             rho[i] += gaussian
             rho[index] += gauss
     return rho
 
+def cached_knn_graph(knn_graph, X, n_neighbors, n_samples=1000, metric='rmsd'):
+    '''
+    Reuse knn_graph for X if it was built from X with metric and holds
+    n_neighbors neighbors and sample distances; otherwise (with a warning)
+    build it again. A path is loaded if it exists, and the graph built
+    again is saved there, so it serves as a cache across runs.
+
+    :param knn_graph: KNNGraph, or the path of one saved by ``KNNGraph.save``
+    :param X: the data the graph is for
+    :return: KNNGraph
+    '''
+    path = knn_graph if isinstance(knn_graph, str) else None
+    graph = None
+    if path is None:
+        graph = knn_graph
+    elif os.path.exists(path):
+        graph = KNNGraph.load(path)
+    if graph is not None:
+        try:
+            graph.check(X, metric)
+            if graph.sample_distances is None:
+                raise ValueError("KNNGraph has no sample distances")
+            if graph.n_neighbors is None or graph.n_neighbors < n_neighbors:
+                raise ValueError("KNNGraph holds fewer than %d neighbors per point" % n_neighbors)
+            return graph
+        except ValueError as e:
+            warnings.warn("Rebuilding the kNN graph: %s" % e)
+    graph = KNNGraph.build(X, n_neighbors, metric=metric, n_samples=min(n_samples, len(X)))
+    if path is not None:
+        graph.save(path)
+    return graph
+
 def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0.1, n_neighbors=100, n_samples=1000,
-                 metric='rmsd', algorithm='auto', sample_dist_metric=None, distances_=None, indices=None, parallel=True):
+                 metric='rmsd', algorithm='auto', sample_dist_metric=None, distances_=None, indices=None, parallel=True,
+                 knn_graph=None):
     """Adaptive Partitioning by Local Density-peaks (APLoD)
     We present an efficient density-based adaptive-resolution clustering method APLoD
     for analyzing large-scale molecular dynamics (MD) trajectories. APLoD performs the
@@ -161,7 +174,8 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
     X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
         array of shape (n_samples, n_samples)
         A feature array, or array of distances between samples if
-        ``metric='precomputed'``.
+        ``metric='precomputed'``, or a ``KNNGraph`` built with ``n_samples``
+        (its neighbors and sample distances replace ``run_knn``).
 
     rho_cutoff : float, optional
         The cut-off of the local density rho
@@ -177,12 +191,17 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by metrics.pairwise.calculate_distance for its
-        metric parameter.
+        metric parameter. Use "periodic" for dihedral angles in degrees, and
+        "rmsd" with an md.Trajectory (exact kNN via the built-in VP-tree).
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square.
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
+    knn_graph : KNNGraph or string, optional
+        The neighbor graph of X from an earlier run, or the path it is
+        cached at. It is checked against X and metric and built again
+        if it does not match, see ``cached_knn_graph``.
 
     Returns
     ----------
@@ -213,7 +232,17 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
     if delta_cutoff < 0.0 and delta_cutoff is not None:
        raise ValueError("delta must be non negative!")
 
-    if algorithm != "precomputed":
+    graph = X if isinstance(X, KNNGraph) else None
+    if graph is None and knn_graph is not None:
+        graph = cached_knn_graph(knn_graph, X, n_neighbors, n_samples=n_samples, metric=metric)
+    if graph is not None:
+        # one kNN pass, e.g. KNNGraph.build(X, n_neighbors, n_samples=n_samples)
+        if graph.sample_distances is None:
+            raise ValueError("KNNGraph has no sample distances, build it with n_samples")
+        distances_, indices = graph.kneighbors(n_neighbors)
+        sample_dist_metric = graph.sample_distances
+        n_samples = len(sample_dist_metric)
+    elif algorithm != "precomputed":
             sample_dist_metric, distances_, indices = run_knn(X=X, n_neighbors=n_neighbors, n_samples=n_samples, metric=metric, algorithm=algorithm)
     else:
         if sample_dist_metric is None:
@@ -246,7 +275,7 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
             for j in range(0,n_neighbors):
                 index = indices[i,j]
                 dist = distances_[i,j]
-                gaussian = np.math.exp(-(dist**2/dc_2))
+                gaussian = math.exp(-(dist**2/dc_2))
                 rho[i] += gaussian
                 rho[index] += gaussian
     else:
@@ -254,7 +283,7 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
             for j in range(0,n_neighbors):
                 index = indices[i,j]
                 dist = distances_[i,j]
-                gaussian = np.math.exp(-(dist**2/dc_2)) * weight[j]
+                gaussian = math.exp(-(dist**2/dc_2)) * weight[j]
                 rho[i] += gaussian
                 rho[index] += gaussian
 
@@ -289,10 +318,7 @@ def aplod_clustering(X, weight=None, rho_cutoff=1.0, delta_cutoff=1.0, percent=0
     #print("rho_cut:", rho_cut, rho_cut_index)
     #print("delta_cut", delta_cut, distances_index)
  
-    if metric == "rmsd:":
-        labels_ = -np.ones(X.xyz.shape[0], dtype=np.intp)
-    else:
-        labels_ = -np.ones(X_len, dtype=np.intp)
+    labels_ = -np.ones(X_len, dtype=np.intp)
     cluster_centers_list = []
     cluster = 0
     for i in range(len(rho_argsorted)):
@@ -341,12 +367,17 @@ class APLoD(BaseEstimator, ClusterMixin):
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by metrics.pairwise.calculate_distance for its
-        metric parameter.
+        metric parameter. Use "periodic" for dihedral angles in degrees, and
+        "rmsd" with an md.Trajectory (exact kNN via the built-in VP-tree).
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square.
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
+    knn_graph : KNNGraph or string, optional
+        The neighbor graph of X from an earlier run, or the path it is
+        cached at. It is checked against X and metric and built again
+        if it does not match, see ``cached_knn_graph``.
 
     Returns
     ----------
@@ -372,7 +403,8 @@ class APLoD(BaseEstimator, ClusterMixin):
     DOI: 10.1126/science.1242072
     """
     def __init__(self, rho_cutoff=1.0, delta_cutoff=1.0, percent=0.2, n_neighbors=100, n_samples=1000,
-                 metric='rmsd', algorithm='auto', sample_dist_metric=None, distances_=None, indices=None, parallel=True):
+                 metric='rmsd', algorithm='auto', sample_dist_metric=None, distances_=None, indices=None, parallel=True,
+                 knn_graph=None):
         self.rho_cutoff = rho_cutoff
         self.delta_cutoff = delta_cutoff
         self.percent = percent
@@ -384,13 +416,14 @@ class APLoD(BaseEstimator, ClusterMixin):
         self.distances_ = distances_
         self.indices = indices
         self.parallel = parallel
+        self.knn_graph = knn_graph
 
     def fit(self, X, weight=None):
         """Perform clustering.
         Parameters
         -----------
-        X : array-like, shape=[n_samples, n_features]
-            Samples to cluster.
+        X : array-like, shape=[n_samples, n_features], md.Trajectory or KNNGraph
+            Samples to cluster, or their precomputed neighbor graph.
         """
 #        X = check_array(X)
         print( "Doing APLoD clustering..." )
@@ -399,7 +432,8 @@ class APLoD(BaseEstimator, ClusterMixin):
             aplod_clustering(X, weight=weight, rho_cutoff=self.rho_cutoff, delta_cutoff=self.delta_cutoff,
                          percent=self.percent, n_neighbors=self.n_neighbors,n_samples=self.n_samples,
                          metric=self.metric, algorithm=self.algorithm,sample_dist_metric=self.sample_dist_metric,
-                         distances_=self.distances_, indices=self.indices, parallel=self.parallel)
+                         distances_=self.distances_, indices=self.indices, parallel=self.parallel,
+                         knn_graph=self.knn_graph)
         t1 = time.time()
         print( "APLoD Time Cost:", t1-t0 )
         return self
@@ -0,0 +1,120 @@
+__author__ = 'stephen'
+#===============================================================================
+# GLOBAL IMPORTS:
+import os
+import json
+import threading
+import numpy as np
+#===============================================================================
+
+class KCentersCheckpoint(object):
+    '''
+    On-disk checkpoint of a running k-centers job.
+
+    The directory holds
+      centers.bin            append-only int64 frame indices of the centers
+      distances.{0,1}.npy    two memory-mapped snapshot slots of distances_
+      labels.{0,1}.npy       and labels_
+      state.json             iteration counter, seed and active slot
+
+    Every new center is appended to centers.bin as soon as it is chosen.
+    ``commit`` copies distances_ and labels_ into the inactive slot and hands
+    the flush to a background thread, which then replaces state.json
+    atomically (write to a temporary file, fsync, os.replace). A crash at any
+    point leaves state.json pointing at a complete snapshot; centers appended
+    after it are discarded on resume.
+
+    :param path: checkpoint directory, created if needed
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        self._writer = None
+        self._centers_file = None
+        self._slots = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.isfile(self._file('state.json'))
+
+    def create(self, n_samples, distance_dtype, seed, **info):
+        '''Start a new checkpoint, discarding any previous one.'''
+        self.close()
+        if self.exists():
+            os.remove(self._file('state.json'))
+        self._slots = [(np.lib.format.open_memmap(self._file('distances.%d.npy' % slot), mode='w+',
+                                                  dtype=distance_dtype, shape=(n_samples,)),
+                        np.lib.format.open_memmap(self._file('labels.%d.npy' % slot), mode='w+',
+                                                  dtype=np.int32, shape=(n_samples,)))
+                       for slot in (0, 1)]
+        self._centers_file = open(self._file('centers.bin'), 'wb')
+        self.state = dict(info, n_samples=n_samples, seed=int(seed), iteration=0, n_centers=0, slot=-1)
+
+    def load(self):
+        '''
+        Reopen an existing checkpoint.
+
+        :return: (state, centers, distances, labels) of the last commit; the
+            arrays are in-memory copies
+        '''
+        with open(self._file('state.json')) as f:
+            self.state = json.load(f)
+        self._slots = [(np.lib.format.open_memmap(self._file('distances.%d.npy' % slot), mode='r+'),
+                        np.lib.format.open_memmap(self._file('labels.%d.npy' % slot), mode='r+'))
+                       for slot in (0, 1)]
+        n_centers = self.state['n_centers']
+        centers = np.fromfile(self._file('centers.bin'), dtype=np.int64)[:n_centers]
+        # drop centers appended after the last commit
+        self._centers_file = open(self._file('centers.bin'), 'r+b')
+        self._centers_file.truncate(n_centers * 8)
+        self._centers_file.seek(0, os.SEEK_END)
+        distances, labels = self._slots[self.state['slot']]
+        return self.state, [int(c) for c in centers], np.array(distances), np.array(labels)
+
+    def append(self, center):
+        '''Record a newly chosen center.'''
+        self._centers_file.write(np.int64(center).tobytes())
+
+    def commit(self, iteration, n_centers, distances, labels):
+        '''
+        Snapshot the state after ``iteration`` centers have been applied and
+        ``n_centers`` have been chosen. Returns once the arrays are copied;
+        the flush to disk runs in the background.
+        '''
+        self.wait()
+        slot = 1 - self.state['slot'] if self.state['slot'] >= 0 else 0
+        slot_distances, slot_labels = self._slots[slot]
+        slot_distances[:] = distances
+        slot_labels[:] = labels
+        self._centers_file.flush()
+        state = dict(self.state, iteration=int(iteration), n_centers=int(n_centers), slot=slot)
+        self._writer = threading.Thread(target=self._write, args=(state,))
+        self._writer.start()
+        self.state = state
+
+    def _write(self, state):
+        for slot_array in self._slots[state['slot']]:
+            slot_array.flush()
+        os.fsync(self._centers_file.fileno())
+        tmp = self._file('state.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file('state.json'))
+
+    def wait(self):
+        '''Block until the last commit is on disk.'''
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def close(self):
+        self.wait()
+        if self._centers_file is not None:
+            self._centers_file.close()
+            self._centers_file = None
@@ -9,20 +9,171 @@ DBSCAN: Density-Based Spatial Clustering of Applications with Noise
 #
 # License: BSD 3 clause
 
+import os
 import numpy as np
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy import sparse
 
 from sklearn.base import BaseEstimator, ClusterMixin
 from sklearn.utils import check_array, check_consistent_length
 from sklearn.neighbors import NearestNeighbors
 
-from sklearn.cluster._dbscan_inner import dbscan_inner
+
+from ..metrics.pairwise import radius_neighbors, requires_native
+from ..metrics.vptree_ import VPTree
+from ..metrics.knn_graph_ import KNNGraph
+from .dbscan_inner_ import dbscan_csr, neighborhoods_to_csr
+
+
+def _n_threads(n_jobs):
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+def block_radius_query(X, eps, metric='minkowski', metric_params=None, algorithm='auto', leaf_size=30, p=2,
+                       working_memory=1024):
+    """Prepare a radius search over X and return ``query(rows)``, giving
+    the eps-neighborhoods of the samples of the index array rows as an
+    object array of index arrays. The search structure is built once and
+    the queries may run concurrently.
+    """
+    if metric == 'rmsd' or algorithm == 'vp_tree':
+        tree = VPTree(X, metric=metric, leaf_size=leaf_size, metric_params=metric_params, p=p)
+        return lambda rows: tree.query_radius(tree.data[rows], eps)
+    if requires_native(metric):
+        return lambda rows: radius_neighbors(X[rows], eps, Y=X, metric=metric, working_memory=working_memory,
+                                             **(metric_params or {}))
+    neighbors_model = NearestNeighbors(radius=eps, algorithm=algorithm, leaf_size=leaf_size, metric=metric,
+                                       metric_params=metric_params, p=p)
+    neighbors_model.fit(X)
+    return lambda rows: neighbors_model.radius_neighbors(X[rows], eps, return_distance=False)
+
+
+def _chunked_map(function, rows, n_samples, working_memory, n_jobs):
+    """Apply ``function(block)`` to consecutive blocks of rows in a thread
+    pool and yield ``(block, result)`` in order. function returns its
+    result and the number of neighbors it went through, from which later
+    blocks are sized: the first blocks assume the worst case of every
+    sample in every neighborhood, and at most two blocks per thread are in
+    flight, so that their neighborhoods stay within working_memory (MiB).
+    """
+    n_threads = _n_threads(n_jobs)
+    budget = working_memory * 2 ** 20
+    # bytes of one neighborhood (8-byte indices), pessimistic until a
+    # block has been seen
+    row_bytes = 8.0 * n_samples
+    n_done = n_entries = 0
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        start = 0
+        while start < len(rows) or pending:
+            while start < len(rows) and len(pending) < 2 * n_threads:
+                stop = min(len(rows), start + max(1, int(budget // (2 * n_threads * row_bytes))))
+                block = rows[start:stop]
+                pending.append((block, executor.submit(function, block)))
+                start = stop
+            block, future = pending.popleft()
+            result, block_entries = future.result()
+            yield block, result
+            n_done += len(block)
+            n_entries += block_entries
+            # twice the mean size of the neighborhoods seen so far
+            row_bytes = max(8.0, 16.0 * n_entries / n_done)
+
+
+def chunked_neighbor_counts(query, n_samples, working_memory=1024, n_jobs=None, sample_weight=None):
+    """Size (or total sample_weight) of every eps-neighborhood, searched
+    block by block as in ``chunked_neighborhoods``; the neighbor indices
+    are dropped as soon as a block is counted.
+    """
+    def count(block):
+        neighborhoods = query(block)
+        sizes = np.fromiter((len(neighbors) for neighbors in neighborhoods), dtype=np.int64,
+                            count=len(neighborhoods))
+        if sample_weight is None:
+            return sizes, int(sizes.sum())
+        return np.array([np.sum(sample_weight[neighbors]) for neighbors in neighborhoods]), int(sizes.sum())
+
+    n_neighbors = np.zeros(n_samples, dtype=np.int64 if sample_weight is None else np.float64)
+    for block, counts in _chunked_map(count, np.arange(n_samples), n_samples, working_memory, n_jobs):
+        n_neighbors[block] = counts
+    return n_neighbors
+
+
+def chunked_neighborhoods(query, n_samples, working_memory=1024, n_jobs=None, rows=None):
+    """Run ``query`` over blocks of rows in a thread pool and append the
+    neighborhoods, in order, to a growing CSR buffer.
+
+    The blocks in flight stay within working_memory (MiB); the buffer
+    itself grows by doubling and is not bounded by the budget.
+
+    Parameters
+    ----------
+    rows : array, optional
+        Sorted samples whose neighborhoods are stored, all by default; the
+        other rows of the CSR arrays are left empty.
+
+    Returns
+    -------
+    indptr : array [n_samples + 1], int64
+    indices : array [n_entries], int32 (int64 beyond 2**31 samples)
+    """
+    if rows is None:
+        rows = np.arange(n_samples)
+
+    def search(block):
+        neighborhoods = query(block)
+        return neighborhoods, sum(len(neighbors) for neighbors in neighborhoods)
+
+    index_dtype = np.int32 if n_samples < 2 ** 31 else np.int64
+    counts = np.zeros(n_samples, dtype=np.int64)
+    # every sample is its own neighbor
+    indices = np.empty(max(len(rows), 1), dtype=index_dtype)
+    n_entries = 0
+    for block, neighborhoods in _chunked_map(search, rows, n_samples, working_memory, n_jobs):
+        counts[block] = [len(neighbors) for neighbors in neighborhoods]
+        block_entries = int(counts[block].sum())
+        if n_entries + block_entries > len(indices):
+            grown = np.empty(max(2 * len(indices), n_entries + block_entries), dtype=index_dtype)
+            grown[:n_entries] = indices[:n_entries]
+            indices = grown
+        if block_entries:
+            indices[n_entries:n_entries + block_entries] = np.concatenate(neighborhoods)
+        n_entries += block_entries
+    indptr = np.zeros(n_samples + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, indices[:n_entries]
+
+
+def chunked_dbscan(X, eps, min_samples, metric='minkowski', metric_params=None, algorithm='auto', leaf_size=30,
+                   p=2, sample_weight=None, n_jobs=None, working_memory=None, core_only=False):
+    """DBSCAN with the neighborhoods searched block by block into CSR
+    arrays, see the working_memory and core_only options of ``dbscan``.
+    """
+    if working_memory is None:
+        working_memory = 1024
+    query = block_radius_query(X, eps, metric=metric, metric_params=metric_params, algorithm=algorithm,
+                               leaf_size=leaf_size, p=p, working_memory=max(1, working_memory // _n_threads(n_jobs)))
+    if not core_only:
+        indptr, indices = chunked_neighborhoods(query, len(X), working_memory=working_memory, n_jobs=n_jobs)
+        return dbscan_csr(indptr, indices, min_samples, sample_weight)
+    # clusters only expand through core samples: count first, then store
+    # the neighborhoods of the core samples alone
+    n_neighbors = chunked_neighbor_counts(query, len(X), working_memory=working_memory, n_jobs=n_jobs,
+                                          sample_weight=sample_weight)
+    indptr, indices = chunked_neighborhoods(query, len(X), working_memory=working_memory, n_jobs=n_jobs,
+                                            rows=np.flatnonzero(n_neighbors >= min_samples))
+    return dbscan_csr(indptr, indices, min_samples, n_neighbors=n_neighbors)
 
 
 def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
            algorithm='auto', leaf_size=30, p=2, sample_weight=None,
-           n_jobs=None):
+           n_jobs=None, working_memory=None, core_only=False):
     """Perform DBSCAN clustering from vector array or distance matrix.
 
     Read more in the :ref:`User Guide <dbscan>`.
@@ -32,7 +183,7 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
             array of shape (n_samples, n_samples)
         A feature array, or array of distances between samples if
-        ``metric='precomputed'``.
+        ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
 
     eps : float, optional
         The maximum distance between two samples for one to be considered
@@ -49,7 +200,9 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by :func:`sklearn.metrics.pairwise_distances` for
-        its metric parameter.
+        its metric parameter, "periodic" for angles (minimum-image
+        distance, ``metric_params={'period': 360}`` by default), or "rmsd"
+        with an md.Trajectory as X.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square. X may be a sparse matrix, in which case only "nonzero"
         elements may be considered neighbors for DBSCAN.
@@ -59,7 +212,7 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
 
         .. versionadded:: 0.19
 
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
         See NearestNeighbors module documentation for details.
@@ -86,6 +239,19 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         ``-1`` means using all processors. See :term:`Glossary <n_jobs>`
         for more details.
 
+    working_memory : int or None, optional (default=None)
+        If given, neighborhoods are searched block by block in n_jobs
+        threads, with the blocks in flight bounded by working_memory (MiB),
+        and stored in CSR form with int32 indices instead of one array per
+        sample. Not used with a ``KNNGraph`` or a sparse precomputed X.
+
+    core_only : bool, optional (default=False)
+        Search the neighborhoods twice, block by block as with
+        working_memory (1024 MiB by default): first only counting them to
+        find the core samples, then storing those of the core samples
+        alone, through which clusters expand. Saves memory when most
+        samples are not core; the labels are the same.
+
     Returns
     -------
     core_samples : array [n_core_samples]
@@ -139,7 +305,8 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     if not eps > 0.0:
         raise ValueError("eps must be positive.")
 
-    X = check_array(X, accept_sparse='csr')
+    if metric != 'rmsd' and not isinstance(X, KNNGraph):
+        X = check_array(X, accept_sparse='csr')
     if sample_weight is not None:
         sample_weight = np.asarray(sample_weight)
         check_consistent_length(X, sample_weight)
@@ -147,7 +314,11 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     # Calculate neighborhood for all samples. This leaves the original point
     # in, which needs to be considered later (i.e. point i is in the
     # neighborhood of point i. While True, its useless information)
-    if metric == 'precomputed' and sparse.issparse(X):
+    if isinstance(X, KNNGraph):
+        # neighbors computed once, e.g. by KNNGraph.build; X's metric applies
+        indptr, indices = X.radius_csr(eps)
+        return dbscan_csr(indptr, indices, min_samples, sample_weight)
+    elif metric == 'precomputed' and sparse.issparse(X):
         neighborhoods = np.empty(X.shape[0], dtype=object)
         X.sum_duplicates()  # XXX: modifies X's internals in-place
 
@@ -163,6 +334,17 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
 
         # split into rows
         neighborhoods[:] = np.split(masked_indices, masked_indptr)
+    elif working_memory is not None or core_only:
+        return chunked_dbscan(X, eps, min_samples, metric=metric, metric_params=metric_params,
+                              algorithm=algorithm, leaf_size=leaf_size, p=p, sample_weight=sample_weight,
+                              n_jobs=n_jobs, working_memory=working_memory, core_only=core_only)
+    elif metric == 'rmsd' or algorithm == 'vp_tree':
+        # exact radius search with the built-in vantage-point tree
+        tree = VPTree(X, metric=metric, leaf_size=leaf_size, n_jobs=n_jobs or 1, metric_params=metric_params, p=p)
+        neighborhoods = tree.query_radius(X, eps)
+    elif requires_native(metric):
+        # metrics sklearn's neighbor searches do not know, e.g. "periodic"
+        neighborhoods = radius_neighbors(X, eps, metric=metric, n_jobs=n_jobs, **(metric_params or {}))
     else:
         neighbors_model = NearestNeighbors(radius=eps, algorithm=algorithm,
                                            leaf_size=leaf_size,
@@ -174,20 +356,8 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         neighborhoods = neighbors_model.radius_neighbors(X, eps,
                                                          return_distance=False)
         #np.savetxt('sklearn_neighborhoods', neighborhoods, fmt='%s')
-    if sample_weight is None:
-        n_neighbors = np.array([len(neighbors)
-                                for neighbors in neighborhoods])
-    else:
-        n_neighbors = np.array([np.sum(sample_weight[neighbors])
-                                for neighbors in neighborhoods])
-
-    # Initially, all samples are noise.
-    labels = np.full(X.shape[0], -1, dtype=np.intp)
-
-    # A list of all core samples found.
-    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
-    dbscan_inner(core_samples, neighborhoods, labels)
-    return np.where(core_samples)[0], labels
+    indptr, indices = neighborhoods_to_csr(neighborhoods)
+    return dbscan_csr(indptr, indices, min_samples, sample_weight)
 
 
 class DBSCAN(BaseEstimator, ClusterMixin):
@@ -216,7 +386,9 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by :func:`sklearn.metrics.pairwise_distances` for
-        its metric parameter.
+        its metric parameter, "periodic" for angles (minimum-image
+        distance, ``metric_params={'period': 360}`` by default), or "rmsd"
+        with an md.Trajectory as X.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square. X may be a sparse matrix, in which case only "nonzero"
         elements may be considered neighbors for DBSCAN.
@@ -229,7 +401,7 @@ class DBSCAN(BaseEstimator, ClusterMixin):
 
         .. versionadded:: 0.19
 
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
         See NearestNeighbors module documentation for details.
@@ -250,13 +422,22 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         ``-1`` means using all processors. See :term:`Glossary <n_jobs>`
         for more details.
 
+    working_memory : int or None, optional (default=None)
+        Memory budget (MiB) of the chunked neighborhood search, see
+        :func:`dbscan`; None searches all samples at once.
+
+    core_only : bool, optional (default=False)
+        Count the neighbors first and store the neighborhoods of the core
+        samples only, see :func:`dbscan`.
+
     Attributes
     ----------
     core_sample_indices_ : array, shape = [n_core_samples]
         Indices of core samples.
 
     components_ : array, shape = [n_core_samples, n_features]
-        Copy of each core sample found by training.
+        Copy of each core sample found by training, None if fit on a
+        ``KNNGraph``.
 
     labels_ : array, shape = [n_samples]
         Cluster labels for each point in the dataset given to fit().
@@ -318,7 +499,7 @@ class DBSCAN(BaseEstimator, ClusterMixin):
 
     def __init__(self, eps=0.5, min_samples=5, metric='euclidean',
                  metric_params=None, algorithm='auto', leaf_size=30, p=None,
-                 n_jobs=None):
+                 n_jobs=None, working_memory=None, core_only=False):
         self.eps = eps
         self.min_samples = min_samples
         self.metric = metric
@@ -327,6 +508,8 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         self.leaf_size = leaf_size
         self.p = p
         self.n_jobs = n_jobs
+        self.working_memory = working_memory
+        self.core_only = core_only
 
     def fit(self, X, y=None, sample_weight=None):
         """Perform DBSCAN clustering from features or distance matrix.
@@ -336,7 +519,7 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
                 array of shape (n_samples, n_samples)
             A feature array, or array of distances between samples if
-            ``metric='precomputed'``.
+            ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
         sample_weight : array, shape (n_samples,), optional
             Weight of each sample, such that a sample with a weight of at least
             ``min_samples`` is by itself a core sample; a sample with negative
@@ -346,6 +529,17 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         y : Ignored
 
         """
+        if isinstance(X, KNNGraph):
+            clust = dbscan(X, sample_weight=sample_weight, **self.get_params())
+            self.core_sample_indices_, self.labels_ = clust
+            # the graph does not hold the samples themselves
+            self.components_ = None
+            return self
+        if self.metric == 'rmsd':
+            clust = dbscan(X, sample_weight=sample_weight, **self.get_params())
+            self.core_sample_indices_, self.labels_ = clust
+            self.components_ = X[self.core_sample_indices_]
+            return self
         X = check_array(X, accept_sparse='csr')
         clust = dbscan(X, sample_weight=sample_weight,
                        **self.get_params())
@@ -366,7 +560,7 @@ class DBSCAN(BaseEstimator, ClusterMixin):
         X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
                 array of shape (n_samples, n_samples)
             A feature array, or array of distances between samples if
-            ``metric='precomputed'``.
+            ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
         sample_weight : array, shape (n_samples,), optional
             Weight of each sample, such that a sample with a weight of at least
             ``min_samples`` is by itself a core sample; a sample with negative
@@ -0,0 +1,179 @@
+__author__ = 'stephen'
+import numpy as np
+from numba import njit, prange
+from ..metrics.pairwise import _numba_lock
+
+
+def csr_neighbor_counts(indptr, indices, sample_weight=None):
+    '''
+    Size (or total weight) of every neighborhood of a CSR neighbor graph.
+
+    :param indptr: array [n_samples + 1,], row boundaries
+    :param indices: array [n_entries,], neighbor indices
+    :param sample_weight: array [n_samples,], optional
+    :return: array [n_samples,]
+    '''
+    if sample_weight is None:
+        return np.diff(indptr)
+    cumulative = np.concatenate(([0], np.cumsum(sample_weight[indices])))
+    return cumulative[indptr[1:]] - cumulative[indptr[:-1]]
+
+
+def neighborhoods_to_csr(neighborhoods):
+    '''
+    CSR arrays of an object array of neighbor index arrays, as returned by
+    sklearn's radius_neighbors.
+
+    :return: indptr [n_samples + 1,] int64, indices [n_entries,] int32
+        (int64 beyond 2**31 samples)
+    '''
+    n_samples = len(neighborhoods)
+    counts = np.fromiter((len(neighbors) for neighbors in neighborhoods), dtype=np.int64, count=n_samples)
+    indptr = np.zeros(n_samples + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    index_dtype = np.int32 if n_samples < 2 ** 31 else np.int64
+    if indptr[-1] == 0:
+        return indptr, np.empty(0, dtype=index_dtype)
+    return indptr, np.concatenate(list(neighborhoods)).astype(index_dtype)
+
+
+@njit
+def _find(parent, i):
+    root = parent[i]
+    while parent[root] != root:
+        root = parent[root]
+    return root
+
+
+@njit(parallel=True)
+def _core_components(is_core, indptr, indices, parent):
+    # batched union-find over the core-core edges: roots are hooked under
+    # the smaller root without locks. A concurrent hook may overwrite
+    # another one, so rounds are repeated until no edge joins two roots;
+    # parent only ever points to smaller indices, so no cycle can form and
+    # every component ends rooted at its smallest core sample.
+    while True:
+        changes = 0
+        for i in prange(len(parent)):
+            if not is_core[i]:
+                continue
+            for entry in range(indptr[i], indptr[i + 1]):
+                neighbor = indices[entry]
+                if not is_core[neighbor]:
+                    continue
+                root = _find(parent, i)
+                neighbor_root = _find(parent, neighbor)
+                if root < neighbor_root:
+                    parent[neighbor_root] = root
+                    changes += 1
+                elif neighbor_root < root:
+                    parent[root] = neighbor_root
+                    changes += 1
+        for i in prange(len(parent)):
+            parent[i] = _find(parent, i)
+        if changes == 0:
+            break
+
+
+@njit(parallel=True)
+def _border_candidates(is_core, indptr, indices, labels, offsets, targets, values):
+    # every core sample writes its own segment: (non-core neighbor, label)
+    for i in prange(len(labels)):
+        if not is_core[i]:
+            continue
+        position = offsets[i]
+        for entry in range(indptr[i], indptr[i + 1]):
+            neighbor = indices[entry]
+            if not is_core[neighbor]:
+                targets[position] = neighbor
+                values[position] = labels[i]
+                position += 1
+
+
+@njit(parallel=True)
+def _count_border_candidates(is_core, indptr, indices, counts):
+    for i in prange(len(counts)):
+        if not is_core[i]:
+            continue
+        count = 0
+        for entry in range(indptr[i], indptr[i + 1]):
+            if not is_core[indices[entry]]:
+                count += 1
+        counts[i] = count
+
+
+def dbscan_inner_csr(is_core, indptr, indices, labels):
+    '''
+    Expand clusters from the core samples, with the labels of sklearn's
+    dbscan_inner but on CSR neighborhoods and in parallel.
+
+    The core samples are joined into connected components by a parallel
+    union-find; clusters are numbered by their smallest core sample, the
+    order in which dbscan_inner meets them. A border sample takes the
+    smallest label among its core neighbors, the cluster dbscan_inner
+    expands first. Only the rows of core samples are read. Neighborhoods
+    are expected to be symmetric, as eps-neighborhoods are; a one-way
+    link between two core samples (e.g. from an approximate search)
+    still joins them.
+
+    :param is_core: array [n_samples,] uint8
+    :param indptr: array [n_samples + 1,], row boundaries
+    :param indices: array [n_entries,], neighbor indices
+    :param labels: array [n_samples,] intp, -1 on input, filled in place
+    '''
+    is_core = np.asarray(is_core, dtype=np.uint8)
+    n_samples = len(labels)
+    parent = np.arange(n_samples, dtype=np.int64)
+    with _numba_lock:
+        _core_components(is_core, indptr, indices, parent)
+    roots = np.flatnonzero(is_core & (parent == np.arange(n_samples)))
+    cluster = np.full(n_samples, -1, dtype=np.intp)
+    cluster[roots] = np.arange(len(roots))
+    core = np.flatnonzero(is_core)
+    labels[core] = cluster[parent[core]]
+
+    counts = np.zeros(n_samples, dtype=np.int64)
+    with _numba_lock:
+        _count_border_candidates(is_core, indptr, indices, counts)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    targets = np.empty(offsets[-1], dtype=np.int64)
+    values = np.empty(offsets[-1], dtype=np.intp)
+    with _numba_lock:
+        _border_candidates(is_core, indptr, indices, labels, offsets, targets, values)
+    border = np.full(n_samples, np.iinfo(np.intp).max, dtype=np.intp)
+    np.minimum.at(border, targets, values)
+    reached = border != np.iinfo(np.intp).max
+    labels[reached] = border[reached]
+
+
+def threshold_csr(indptr, indices, distances, radius):
+    '''
+    Sub-graph of the entries of a CSR neighbor graph within radius
+    (inclusive); the neighborhoods at a smaller eps are subsets of those
+    at a larger one.
+
+    :param distances: array [n_entries,], distance of every entry
+    :return: indptr, indices of the kept entries
+    '''
+    within = distances <= radius
+    cumulative = np.zeros(len(within) + 1, dtype=np.int64)
+    np.cumsum(within, out=cumulative[1:])
+    return cumulative[indptr], indices[within]
+
+
+def dbscan_csr(indptr, indices, min_samples, sample_weight=None, n_neighbors=None):
+    '''
+    DBSCAN on CSR eps-neighborhoods, the point itself included.
+
+    Only the rows of core samples are read, so the others may be left
+    empty when n_neighbors, the neighborhood sizes (or weights), is given.
+
+    :return: core_samples [n_core_samples,], labels [n_samples,]
+    '''
+    if n_neighbors is None:
+        n_neighbors = csr_neighbor_counts(indptr, indices, sample_weight)
+    # Initially, all samples are noise.
+    labels = np.full(len(indptr) - 1, -1, dtype=np.intp)
+    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
+    dbscan_inner_csr(core_samples, indptr, indices, labels)
+    return np.where(core_samples)[0], labels
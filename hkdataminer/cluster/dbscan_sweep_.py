@@ -0,0 +1,146 @@
+__author__ = 'stephen'
+import heapq
+import warnings
+import numpy as np
+from numba import njit
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+
+from ..metrics.pairwise import radius_neighbors, requires_native
+from ..metrics.vptree_ import VPTree
+from ..metrics.knn_graph_ import KNNGraph, data_fingerprint
+from .dbscan_inner_ import dbscan_csr
+
+
+def radius_graph(X, eps, metric='euclidean', metric_params=None, algorithm='auto', leaf_size=30, p=2, n_jobs=None):
+    '''
+    Neighbors within eps (inclusive) of every sample, with their distances,
+    as a KNNGraph whose rows are sorted by distance. The neighborhoods of
+    any smaller eps are prefixes of its rows, so the graph is queried once
+    and reused by ``dbscan_sweep`` and ``optics_ordering``.
+
+    :param X: data as accepted by ``dbscan``
+    :param eps: largest radius of interest
+    :param metric, metric_params, algorithm, leaf_size, p, n_jobs: as for ``dbscan``
+    :return: KNNGraph with radius eps
+    '''
+    fingerprint = data_fingerprint(X)
+    if metric == 'rmsd' or algorithm == 'vp_tree':
+        tree = VPTree(X, metric=metric, leaf_size=leaf_size, n_jobs=n_jobs or 1, metric_params=metric_params, p=p)
+        neighborhoods, distances = tree.query_radius(X, eps, return_distance=True)
+    elif requires_native(metric):
+        distances, neighborhoods = radius_neighbors(X, eps, metric=metric, return_distance=True, n_jobs=n_jobs,
+                                                    **(metric_params or {}))
+    else:
+        if metric == 'precomputed' and sparse.issparse(X):
+            # a point is its own neighbor: store the diagonal explicitly
+            X = X.tocsr(copy=True)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
+                X.setdiag(X.diagonal())
+        neighbors_model = NearestNeighbors(radius=eps, algorithm=algorithm, leaf_size=leaf_size, metric=metric,
+                                           metric_params=metric_params, p=p, n_jobs=n_jobs)
+        neighbors_model.fit(X)
+        distances, neighborhoods = neighbors_model.radius_neighbors(X, eps, return_distance=True)
+
+    counts = np.fromiter((len(neighbors) for neighbors in neighborhoods), dtype=np.int64, count=len(neighborhoods))
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate(neighborhoods) if len(counts) else np.empty(0, dtype=np.intp)
+    distances = np.concatenate(distances) if len(counts) else np.empty(0)
+    # by row, then distance, then index; distances keep their precision so
+    # that thresholds match those of dbscan exactly
+    ordering = np.lexsort((indices, distances, np.repeat(np.arange(len(counts)), counts)))
+    return KNNGraph(indptr, indices[ordering].astype(np.int32), distances[ordering], metric,
+                    fingerprint=fingerprint, radius=eps)
+
+
+def dbscan_sweep(X, eps, min_samples, sample_weight=None, **kwargs):
+    '''
+    DBSCAN labels for a grid of eps and min_samples from a single neighbor
+    query at the largest eps: the neighborhoods of every smaller eps are
+    obtained by thresholding the distance-sorted rows of the radius graph.
+
+    :param X: data as accepted by ``dbscan``, or a graph from ``radius_graph``
+    :param eps: sequence of radii
+    :param min_samples: sequence of core sample thresholds
+    :param sample_weight: array [n_samples,], optional
+    :param kwargs: metric, metric_params, algorithm, leaf_size, p, n_jobs,
+        passed to ``radius_graph``
+    :return: labels, array [n_eps, n_min_samples, n_samples]
+    '''
+    eps = np.atleast_1d(eps)
+    min_samples = np.atleast_1d(min_samples)
+    if not np.all(eps > 0.0):
+        raise ValueError("eps must be positive.")
+    graph = X if isinstance(X, KNNGraph) else radius_graph(X, eps.max(), **kwargs)
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight)
+    labels = np.empty((len(eps), len(min_samples), graph.n_points), dtype=np.intp)
+    for i, radius in enumerate(eps):
+        indptr, indices = graph.radius_csr(radius)
+        for j, threshold in enumerate(min_samples):
+            labels[i, j] = dbscan_csr(indptr, indices, threshold, sample_weight)[1]
+    return labels
+
+
+@njit
+def _optics_kernel(indptr, indices, distances, core_distances, reachability, predecessor, ordering):
+    n_samples = len(core_distances)
+    processed = np.zeros(n_samples, dtype=np.bool_)
+    heap = [(0.0, np.int64(0))]
+    heap.pop()
+    next_unprocessed = 0
+    for position in range(n_samples):
+        # smallest reachability first, smaller index on ties; stale heap
+        # entries are skipped
+        point = -1
+        while len(heap) > 0:
+            reach, candidate = heapq.heappop(heap)
+            if not processed[candidate] and reach == reachability[candidate]:
+                point = candidate
+                break
+        if point == -1:
+            while processed[next_unprocessed]:
+                next_unprocessed += 1
+            point = next_unprocessed
+        processed[point] = True
+        ordering[position] = point
+        core_distance = core_distances[point]
+        if core_distance == np.inf:
+            continue
+        for entry in range(indptr[point], indptr[point + 1]):
+            neighbor = indices[entry]
+            if processed[neighbor]:
+                continue
+            reach = max(distances[entry], core_distance)
+            if reach < reachability[neighbor]:
+                reachability[neighbor] = reach
+                predecessor[neighbor] = point
+                heapq.heappush(heap, (reach, np.int64(neighbor)))
+
+
+def optics_ordering(graph, min_samples):
+    '''
+    OPTICS reachability ordering of a radius graph, its radius acting as
+    max_eps. The graph is walked with a heap instead of sklearn's scan over
+    all unprocessed points, with the same tie-breaking.
+
+    :param graph: KNNGraph from ``radius_graph``
+    :param min_samples: neighbors (the point itself included) of a core point
+    :return: ordering, reachability, core_distances, predecessor, as the
+        ordering_, reachability_, core_distances_ and predecessor_
+        attributes of sklearn's OPTICS
+    '''
+    indptr = np.asarray(graph.indptr)
+    indices = np.asarray(graph.indices)
+    distances = np.asarray(graph.distances, dtype=np.float64)
+    n_samples = graph.n_points
+    has_core = np.diff(indptr) >= min_samples
+    core_distances = np.full(n_samples, np.inf)
+    core_distances[has_core] = distances[indptr[:-1][has_core] + min_samples - 1]
+    reachability = np.full(n_samples, np.inf)
+    predecessor = np.full(n_samples, -1, dtype=np.intp)
+    ordering = np.empty(n_samples, dtype=np.intp)
+    _optics_kernel(indptr, indices, distances, core_distances, reachability, predecessor, ordering)
+    return ordering, reachability, core_distances, predecessor
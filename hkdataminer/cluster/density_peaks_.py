@@ -1,23 +1,67 @@
 __author__ = 'stephen'
 #===============================================================================
 # GLOBAL IMPORTS:
-import os, sys
 import numpy as np
 import time
 import random
+import warnings
 from sklearn.base import BaseEstimator, ClusterMixin
 from sklearn.metrics.pairwise import pairwise_distances_argmin
 from sklearn.utils.validation import check_is_fitted
-from sklearn.metrics import pairwise_distances
+from scipy.spatial.distance import pdist, squareform
+from numba import njit, prange
 # ==============================================
 #===============================================================================
 # LOCAL IMPORTS:
-HK_DataMiner_Path = os.path.relpath(os.pardir)
-sys.path.append(HK_DataMiner_Path)
+from ..metrics.pairwise import pairwise_rmsd, _numba_lock
 #===============================================================================
 
-def density_peaks_clustering(X, n_clusters=3, rho_cutoff=1.0, delta_cutoff=1.0, percent=0.1,
-                     metric='eculidean', parallel=True):
+@njit(inline='always')
+def _condensed_index(n, i, j):
+    # entry (i, j), i != j, of the condensed matrix (scipy's squareform layout)
+    a, b = np.int64(min(i, j)), np.int64(max(i, j))
+    return n * a - a * (a + 1) // 2 + b - a - 1
+
+@njit(parallel=True)
+def _gaussian_rho_kernel(distances_, n, dc_2, rho):
+    for i in prange(n):
+        total = 0.0
+        for j in range(n):
+            if j != i:
+                dist = distances_[_condensed_index(n, i, j)]
+                total += np.exp(-(dist * dist / dc_2))
+        rho[i] = total
+
+@njit(parallel=True)
+def _nearest_denser_kernel(distances_, n, rank, delta, nneigh):
+    for i in prange(n):
+        best = np.inf
+        # stays -1 for the densest point, fixed up by the caller
+        best_j = -1
+        for j in range(n):
+            if rank[j] < rank[i]:
+                dist = distances_[_condensed_index(n, i, j)]
+                if dist < best:
+                    best = dist
+                    best_j = j
+        delta[i] = best
+        nneigh[i] = best_j
+
+def _gaussian_rho(distances_, n, dc_2):
+    rho = np.zeros(n, dtype=np.float32)
+    with _numba_lock:
+        _gaussian_rho_kernel(distances_, n, float(dc_2), rho)
+    return rho
+
+def _nearest_denser(distances_, n, rank):
+    delta = np.empty(n, dtype=np.float32)
+    nneigh = np.empty(n, dtype=np.intp)
+    with _numba_lock:
+        _nearest_denser_kernel(distances_, n, rank, delta, nneigh)
+    return delta, nneigh
+
+def density_peaks_clustering(X, n_clusters=3, rho_cutoff='deprecated', delta_cutoff='deprecated', percent=0.1,
+                     metric='euclidean', parallel=True):
     """Adaptive Partitioning by Local Density-peaks (density_peaks)
     We present an efficient density-based adaptive-resolution clustering method density_peaks
     for analyzing large-scale molecular dynamics (MD) trajectories. density_peaks performs the
@@ -39,11 +83,12 @@ def density_peaks_clustering(X, n_clusters=3, rho_cutoff=1.0, delta_cutoff=1.0,
         A feature array, or array of distances between samples if
         ``metric='precomputed'``.
 
-    rho_cutoff : float, optional
-        The cut-off of the local density rho
-
-    delta_cutoff : float, optional
-        The cut-off of the distance delta from points of higher density
+    n_clusters : int, optional
+        Number of centers: the points of largest rho * delta, ties broken
+        by decreasing rho.
+    rho_cutoff, delta_cutoff : deprecated
+        Have no effect and will be removed; the centers are chosen by
+        rho * delta alone.
     percent : float, optional
         Average percentage of neighbours
     n_neighbors : int, optional
@@ -53,7 +98,8 @@ def density_peaks_clustering(X, n_clusters=3, rho_cutoff=1.0, delta_cutoff=1.0,
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by metrics.pairwise.calculate_distance for its
-        metric parameter.
+        metric parameter. Use "rmsd" with an md.Trajectory; the distances
+        are computed once per pair by ``pairwise_rmsd``.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square.
     algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
@@ -84,70 +130,52 @@ def density_peaks_clustering(X, n_clusters=3, rho_cutoff=1.0, delta_cutoff=1.0,
     DOI: 10.1126/science.1242072
     """
 
-    if rho_cutoff < 0.0:
-        raise ValueError("rho must be non negative!")
-    if delta_cutoff < 0.0 and not delta_cutoff == None:
-        raise ValueError("delta must be non negative!")
+    if rho_cutoff != 'deprecated' or delta_cutoff != 'deprecated':
+        warnings.warn("rho_cutoff and delta_cutoff have no effect and will be removed: the centers are the "
+                      "n_clusters points of largest rho * delta", DeprecationWarning)
 
     X_len = len(X)
-    # Calculate distance and find dc
-    distances_ = pairwise_distances(X, X, metric=metric, n_jobs=1)
-
-    sorted_dist = np.sort(distances_)
-
-    index = int(round(X_len * percent))
-    dc = sorted_dist[index]
+    # Calculate distance and find dc. Only the upper triangle is kept, as a
+    # condensed float32 array (scipy's squareform layout).
+    if metric == 'rmsd':
+        distances_ = pairwise_rmsd(X, condensed=True)
+    elif metric == 'precomputed':
+        distances_ = squareform(np.asarray(X, dtype=np.float32), checks=False)
+    else:
+        distances_ = pdist(X, metric=metric).astype(np.float32)
+
+    index = min(int(round(len(distances_) * percent)), len(distances_) - 1)
+    dc = np.partition(distances_, index)[index]
 
     # ----Cal rho: Gaussian kernel with neighbors
     # Calculating Rho using Gaussian kernel.
-
-    rho = np.zeros(X_len, dtype=np.float32)
-    dc_2 = dc ** 2
-
-    for i in xrange(0, X_len-1):
-        for j in xrange(i+1, X_len):
-            dist = distances_[i, j]
-            gaussian = np.math.exp(-(dist ** 2 / dc_2))
-            rho[i] += gaussian
-            rho[j] += gaussian
-
-    # Calculating Highest Rho and Max Distance.
-    rho_argsorted = np.argsort(rho)[::-1]
-    max_rho = rho[rho_argsorted[0]]
+    rho = _gaussian_rho(distances_, X_len, dc ** 2)
+
+    # Calculating Delta: distance to the nearest point of higher density,
+    # ties broken by the order of rho_argsorted.
+    rho_argsorted = np.argsort(-rho, kind='stable')
+    rank = np.empty(X_len, dtype=np.intp)
+    rank[rho_argsorted] = np.arange(X_len)
+    delta, nneigh = _nearest_denser(distances_, X_len, rank)
     max_dist = np.max(distances_)
-
-    if delta_cutoff == None:
-        delta_cutoff = max_dist
-    delta = [max_dist for i in xrange(X_len)]
-    nneigh = [i for i in xrange(X_len)]
-
-    # Calculating Delta.
-    for i in xrange(0, X_len-1):
-        for j in xrange(i, X_len):
-            if rho[j] > rho[i]:
-                delta[i] = distances_[i, j]
-                nneigh[i] = j
-                break
+    delta[rho_argsorted[0]] = max_dist
+    nneigh[rho_argsorted[0]] = rho_argsorted[0]
 
     # Clustering Data.
-    # Initially, all samples are noise.
-
+    # Initially, all samples are noise. The centers are the n_clusters
+    # points of largest rho * delta (the decision graph's gamma), equal
+    # values ordered by rank, so exactly n_clusters are chosen.
     ratio = delta * rho
-    ratio_argsorted = np.argsort(ratio)[::-1]
-    cut_index = ratio_argsorted[n_clusters-1]
-
-    rho_cut = rho[cut_index]
-    delta_cut = delta[cut_index]
-    print "rho_cut:", rho_cut, cut_index
-    print "delta_cut", delta_cut, cut_index
+    is_center = np.zeros(X_len, dtype=bool)
+    is_center[np.lexsort((rank, -ratio))[:n_clusters]] = True
 
     labels_ = -np.ones(X_len, dtype=np.intp)
     cluster_centers_list = []
     cluster = 0
 
-    for i in xrange(len(rho_argsorted)):
+    for i in range(len(rho_argsorted)):
         index = rho_argsorted[i]
-        if labels_[index] == -1 and delta[index] >= delta_cut and rho[index] > rho_cut:
+        if labels_[index] == -1 and is_center[index]:
             labels_[index] = cluster
             cluster_centers_list.append(index)
             cluster += 1
@@ -176,11 +204,12 @@ class density_peaks(BaseEstimator, ClusterMixin):
 
     Parameters
     ----------
-    rho_cutoff : float, optional
-       The cut-off of the local density rho
-
-    delta_cutoff : float, optional
-        The cut-off of the distance delta from points of higher density
+    n_clusters : int, optional
+        Number of centers: the points of largest rho * delta, ties broken
+        by decreasing rho.
+    rho_cutoff, delta_cutoff : deprecated
+        Have no effect and will be removed; the centers are chosen by
+        rho * delta alone.
     percent : float, optional
         Average percentage of neighbours
     n_neighbors : int, optional
@@ -190,7 +219,8 @@ class density_peaks(BaseEstimator, ClusterMixin):
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by metrics.pairwise.calculate_distance for its
-        metric parameter.
+        metric parameter. Use "rmsd" with an md.Trajectory; the distances
+        are computed once per pair by ``pairwise_rmsd``.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square.
     algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
@@ -221,7 +251,7 @@ class density_peaks(BaseEstimator, ClusterMixin):
     DOI: 10.1126/science.1242072
     """
 
-    def __init__(self, n_clusters=3, rho_cutoff=1.0, delta_cutoff=1.0, percent=0.2,
+    def __init__(self, n_clusters=3, rho_cutoff='deprecated', delta_cutoff='deprecated', percent=0.2,
                  metric='rmsd', parallel=True):
         self.rho_cutoff = rho_cutoff
         self.delta_cutoff = delta_cutoff
@@ -238,13 +268,13 @@ class density_peaks(BaseEstimator, ClusterMixin):
             Samples to cluster.
         """
         #        X = check_array(X)
-        print "Doing density_peaks clustering..."
+        print("Doing density_peaks clustering...")
         t0 = time.time()
         self.cluster_centers_, self.labels_ = \
             density_peaks_clustering(X, n_clusters=self.n_clusters, rho_cutoff=self.rho_cutoff, delta_cutoff=self.delta_cutoff,
                              percent=self.percent, metric=self.metric, parallel=self.parallel)
         t1 = time.time()
-        print "density_peaks Time Cost:", t1 - t0
+        print("density_peaks Time Cost:", t1 - t0)
         return self
 
     def predict(self, X):
@@ -10,105 +10,280 @@ DBSCAN: Density-Based Spatial Clustering of Applications with Noise
 #
 # License: BSD 3 clause
 
+import os
+import re
 import numpy as np
 import time
+import warnings
 from scipy import sparse
-from numba import jit
-import numba
 
 from sklearn.base import BaseEstimator, ClusterMixin
 from sklearn.utils import check_array, check_consistent_length
 #from sklearn.neighbors import NearestNeighbors
 
-from sklearn.cluster._dbscan_inner import dbscan_inner
 import faiss
 
-@jit
+from contextlib import contextmanager
+
+from ..metrics.knn_graph_ import KNNGraph, data_fingerprint
+from .dbscan_inner_ import dbscan_csr, threshold_csr
+
+def _knn_mask(D, I, eps):
+    # entries of a faiss search result within eps, without the -1 padding
+    mask = D <= np.float32(eps) ** 2
+    mask &= I >= 0
+    return mask
+
+def _warn_truncated(truncated, k, eps):
+    if truncated:
+        warnings.warn("%d points have all %d searched neighbors within eps=%g; their neighborhoods are "
+                      "truncated, use search='range'" % (truncated, k, eps))
+
 def get_neighborhoods(D, I, eps):
-    neighborhoods = []
-    for i in range(len(D)):
-        distances = D[i]
-        #print(distances)
-        distances = np.delete(distances, 0)
-        indices = I[i]
-        indices = np.delete(indices, 0)
-        #print(indices)
-        index = indices[distances <= eps]
-        neighborhoods.append(index)
-    #neighborhoods = np.asarray(neighborhoods)
-    #np.savetxt('faiss_neighborhoods', np.asarray(neighborhoods), fmt='%s')
-    return np.asarray(neighborhoods)
-
-def cpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True):
-    dimension = X.shape[1]
-    if IVFFlat is True:
-        quantizer = faiss.IndexFlatL2(dimension)
-        index_cpu = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
-        # here we specify METRIC_L2, by default it performs inner-product search
-        assert not index_cpu.is_trained
-        index_cpu.train(X)
-        assert index_cpu.is_trained
-        # here we specify METRIC_L2, by default it performs inner-product search
-    else:
-        index_cpu = faiss.IndexFlatL2(dimension)
-    index_cpu.add(X)
+    """Neighborhoods of a faiss search result (D, I) [n_queries, k] as CSR
+    arrays (indptr int64, indices int32), in one masking step.
+
+    eps is a Euclidean distance and D holds squared L2 distances; the query
+    point itself is kept, as in ``dbscan``. Rows padded by faiss with -1
+    labels are dropped.
+    """
+    mask = _knn_mask(D, I, eps)
+    _warn_truncated(np.count_nonzero(mask[:, -1]), D.shape[1], eps)
+    indptr = np.zeros(len(D) + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(mask, axis=1), out=indptr[1:])
+    indices = I[mask].astype(np.int32)
+    return indptr, indices
+
+def _range_radius(eps):
+    # faiss keeps squared distances strictly below the radius
+    return float(np.nextafter(np.float32(eps) ** 2, np.float32(np.inf)))
+
+def _exact_sqdistances(X, queries, I):
+    # squared L2 distances between the queries and the rows I of X
+    diff = X[I] - queries
+    return np.einsum('...j,...j->...', diff, diff)
+
+def _range_search_batches(index, X, eps, batch_size=65536, rows=None, refine_factor=None):
+    """Range-search the rows of X (all, or the sorted rows) in batches of
+    batch_size, yielding (batch, lims, D, I) for each.
+
+    With refine_factor, candidates are searched within refine_factor * eps
+    and re-ranked: their exact distances are recomputed from X, which the
+    index must hold, and only those within eps are kept. This recovers
+    the neighbors misplaced by a compressed index (PQ, SQ) and drops the
+    false ones; D then holds the exact squared distances.
+    """
+    radius = _range_radius(eps if refine_factor is None else eps * refine_factor)
+    n_queries = len(X) if rows is None else len(rows)
+    for start in range(0, n_queries, batch_size):
+        if rows is None:
+            batch = slice(start, start + batch_size)
+        else:
+            batch = rows[start:start + batch_size]
+        queries = X[batch]
+        lims, D, I = index.range_search(queries, radius)
+        lims = lims.astype(np.int64)
+        if refine_factor is not None:
+            owners = np.repeat(np.arange(len(queries)), np.diff(lims))
+            D = _exact_sqdistances(X, queries[owners], I)
+            keep = D <= np.float32(eps) ** 2
+            kept = np.zeros(len(keep) + 1, dtype=np.int64)
+            np.cumsum(keep, out=kept[1:])
+            lims, D, I = kept[lims], D[keep], I[keep]
+        yield batch, lims, D, I
+
+def range_search_neighbors(index, X, eps, batch_size=65536, return_distance=False, rows=None, refine_factor=None):
+    """Exact eps-neighborhoods (inclusive, the point itself included) of the
+    rows of X in a faiss index, as CSR arrays (indptr int64, indices int32,
+    and with return_distance the squared distances, float32).
+
+    Queries are sent in batches of batch_size rows, so only one batch of
+    faiss results is alive at a time. If rows (sorted) is given, only
+    those neighborhoods are searched and the other rows are left empty.
+    See ``_range_search_batches`` for refine_factor.
+    """
+    counts = np.zeros(len(X), dtype=np.int64)
+    chunks, distance_chunks = [], []
+    for batch, lims, D, I in _range_search_batches(index, X, eps, batch_size, rows, refine_factor):
+        counts[batch] = np.diff(lims)
+        chunks.append(I.astype(np.int32))
+        if return_distance:
+            distance_chunks.append(D)
+    indptr = np.zeros(len(X) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+    if return_distance:
+        distances = np.concatenate(distance_chunks) if distance_chunks else np.empty(0, dtype=np.float32)
+        return indptr, indices, distances
+    return indptr, indices
+
+def range_search_counts(index, X, eps, batch_size=65536, sample_weight=None, refine_factor=None):
+    """Size (or total sample_weight) of the eps-neighborhoods of the rows
+    of X, searched in batches without keeping the neighbors."""
+    n_neighbors = np.empty(len(X), dtype=np.int64 if sample_weight is None else np.float64)
+    for batch, lims, _, I in _range_search_batches(index, X, eps, batch_size, refine_factor=refine_factor):
+        if sample_weight is None:
+            n_neighbors[batch] = np.diff(lims)
+        else:
+            cumulative = np.concatenate(([0], np.cumsum(sample_weight[I])))
+            n_neighbors[batch] = cumulative[lims[1:]] - cumulative[lims[:-1]]
+    return n_neighbors
+
+def _knn_batches(index, X, k, batch_size=65536, refine_factor=None):
+    """Search the k nearest neighbors of the rows of X in batches of
+    batch_size, yielding (batch, D, I) for each. With refine_factor,
+    k * refine_factor candidates are searched and the k nearest by exact
+    distance, recomputed from X, which the index must hold, are kept: the
+    re-ranking of faiss.IndexRefineFlat without a second copy of the
+    vectors in the index.
+    """
+    for start in range(0, len(X), batch_size):
+        batch = slice(start, start + batch_size)
+        queries = X[batch]
+        if refine_factor is None:
+            D, I = index.search(queries, k)
+        else:
+            _, I = index.search(queries, max(k, int(np.ceil(k * refine_factor))))
+            D = _exact_sqdistances(X, queries[:, None, :], I)
+            # faiss pads missing neighbors with -1
+            D[I < 0] = np.inf
+            order = np.argsort(D, axis=1, kind='stable')[:, :k]
+            D, I = np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+        yield batch, D, I
+
+def knn_search(index, X, k, refine_factor=None, batch_size=65536):
+    """The k nearest neighbors (squared distances D, indices I) of the
+    rows of X in a faiss index, searched in batches of batch_size rows.
+    See ``_knn_batches`` for refine_factor.
+    """
+    D = np.empty((len(X), k), dtype=np.float32)
+    I = np.empty((len(X), k), dtype=np.int64)
+    for batch, D_batch, I_batch in _knn_batches(index, X, k, batch_size, refine_factor):
+        D[batch], I[batch] = D_batch, I_batch
+    return D, I
+
+def knn_probe_neighbors(index, X, eps, min_samples, refine_factor=None, batch_size=65536):
+    """Neighborhoods from a k-nearest-neighbor search, k doubled on 1000
+    random probes until it covers eps (capped at 1000), for indexes
+    without range search such as the GPU ones.
+
+    Queries are sent in batches of batch_size rows and every batch is
+    reduced to its eps-neighborhoods before the next, so the memory
+    follows the neighborhoods, not len(X) * k.
+    """
     n_samples = 1000
     k = min_samples
     samples = np.random.choice(len(X), n_samples)
-    # print(samples)
-    D, I = index_cpu.search(X[samples], k)  # sanity check
-    while np.min(np.amax(D, axis=1)) < eps:
-        k = k * 2
-       # D, I = index_gpu.search(X[samples], k)
-        #print(np.min(np.amax(D, axis=1)), eps, k)
-        D, I = index_cpu.search(X[samples], k)
-    if k > 1024:
-        k = 1000
-        #print(np.max(D[:, k - 1]), k, eps)
-    index_cpu.nprobe = nprobe
-    D, I = index_cpu.search(X, k)  # actual search
-
-    return get_neighborhoods(D, I, eps)
-
-
-def gpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True):
-    dimension = X.shape[1]
+    D, I = index.search(X[samples], k)  # sanity check
+    while np.min(np.amax(D, axis=1)) < eps ** 2 and k < 1000:
+        k = min(k * 2, 1000)
+        D, I = index.search(X[samples], k)
+    # actual search
+    counts = np.zeros(len(X), dtype=np.int64)
+    chunks = []
+    truncated = 0
+    for batch, D, I in _knn_batches(index, X, k, batch_size, refine_factor):
+        mask = _knn_mask(D, I, eps)
+        truncated += np.count_nonzero(mask[:, -1])
+        counts[batch] = np.count_nonzero(mask, axis=1)
+        chunks.append(I[mask].astype(np.int32))
+    _warn_truncated(truncated, k, eps)
+    indptr = np.zeros(len(X) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+    return indptr, indices
+
+def new_index(dimension, nlist=100, IVFFlat=True, index_factory=None):
+    """Empty CPU faiss L2 index: IVFFlat with nlist lists, flat, or
+    described by an index_factory string, e.g. 'IVF4096,PQ16' (product
+    quantization), 'IVF4096,SQ8' (8-bit scalar quantization) or 'HNSW32',
+    which then replaces nlist and IVFFlat."""
+    if index_factory is not None:
+        return faiss.index_factory(dimension, index_factory, faiss.METRIC_L2)
     if IVFFlat is True:
         quantizer = faiss.IndexFlatL2(dimension)
-        index_cpu = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
         # here we specify METRIC_L2, by default it performs inner-product search
-        res = faiss.StandardGpuResources() # use a single GPU
-        flat_config = faiss.GpuIndexFlatConfig()
-        flat_config.device = 0
-        # make it an IVF GPU index
-        index_gpu = faiss.index_cpu_to_gpu(res, 0, index_cpu)
-        assert not index_gpu.is_trained
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+    return faiss.IndexFlatL2(dimension)
+
+def index_report(index, build_time=None):
+    """Type, size, memory (bytes, as serialized) and build time (seconds)
+    of a CPU faiss index."""
+    return dict(index=type(index).__name__, n_vectors=index.ntotal,
+                memory=faiss.serialize_index(index).nbytes, build_time=build_time)
+
+def print_index_report(report):
+    print("Faiss index build time:", report['build_time'])
+    print("Faiss index %s memory: %.1f MB for %d vectors" % (report['index'], report['memory'] / 2.0 ** 20,
+                                                             report['n_vectors']))
+
+def build_index(X, nlist=100, IVFFlat=True, index_factory=None, report=None):
+    """Train (if needed) and fill a CPU faiss L2 index with the rows of X,
+    see ``new_index``. report, if given, is called with the
+    ``index_report`` of the new index, e.g. ``print_index_report``."""
+    t0 = time.time()
+    index_cpu = new_index(X.shape[1], nlist, IVFFlat, index_factory)
+    if not index_cpu.is_trained:
+        index_cpu.train(X)
+    index_cpu.add(X)
+    if report is not None:
+        report(index_report(index_cpu, time.time() - t0))
+    return index_cpu
+
+@contextmanager
+def faiss_threads(n_jobs):
+    """Run the faiss calls of the block with n_jobs OpenMP threads (all
+    cores if negative, faiss's default if None), restored on exit."""
+    if n_jobs is None:
+        yield
+        return
+    previous = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(os.cpu_count() or 1 if n_jobs < 0 else n_jobs)
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(previous)
+
+def set_nprobe(index, nprobe):
+    """Set the number of probed inverted lists; a no-op on non-IVF indexes."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = nprobe
+
+def cpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True, search='range',
+                         batch_size=65536, index=None, index_factory=None, refine_factor=None, report=None):
+    if index is None:
+        index = build_index(X, nlist, IVFFlat, index_factory, report)
+    set_nprobe(index, nprobe)
+    if search == 'range':
+        return range_search_neighbors(index, X, eps, batch_size=batch_size, refine_factor=refine_factor)
+    elif search == 'knn':
+        return knn_probe_neighbors(index, X, eps, min_samples, refine_factor, batch_size)
+    raise ValueError("search must be 'range' or 'knn', got %r" % (search,))
+
+
+def gpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=True,
+                         index_factory=None, refine_factor=None, batch_size=65536):
+    index_cpu = new_index(X.shape[1], nlist, IVFFlat, index_factory)
+    res = faiss.StandardGpuResources() # use a single GPU
+    flat_config = faiss.GpuIndexFlatConfig()
+    flat_config.device = 0
+    index_gpu = faiss.index_cpu_to_gpu(res, 0, index_cpu)
+    if not index_gpu.is_trained:
         index_gpu.train(X)
-        assert index_gpu.is_trained
-        # here we specify METRIC_L2, by default it performs inner-product search
-    else:
-        index_cpu = faiss.IndexFlatL2(dimension)
-        res = faiss.StandardGpuResources()
-        flat_config = faiss.GpuIndexFlatConfig()
-        flat_config.device = 0
-        index_gpu = faiss.index_cpu_to_gpu(res, 0, index_cpu)
     index_gpu.add(X)
-    n_samples = 1000
-    k = min_samples
-    samples = np.random.choice(len(X), n_samples)
-    # print(samples)
-    D, I = index_gpu.search(X[samples], k)  # sanity check
-    while np.max(D[:, k - 1]) < eps:
-        k = k * 2
-        D, I = index_gpu.search(X[samples], k)
-        #print(np.max(D[:, k - 1]), k, eps)
-    index_gpu.nprobe = nprobe
-    D, I = index_gpu.search(X, k)  # actual search
-
-    return get_neighborhoods(D, I, eps)
+    if index_factory is None:
+        if IVFFlat is True:
+            index_gpu.nprobe = nprobe
+    elif 'IVF' in index_factory:
+        faiss.GpuParameterSpace().set_index_parameter(index_gpu, 'nprobe', nprobe)
+    # GPU indexes have no range search
+    return knn_probe_neighbors(index_gpu, X, eps, min_samples, refine_factor, batch_size)
 
 def faiss_dbscan(X, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', metric_params=None,
-           algorithm='auto', leaf_size=30, p=2, sample_weight=None, n_jobs=1, GPU=False, IVFFlat=True):
+           algorithm='auto', leaf_size=30, p=2, sample_weight=None, n_jobs=None, GPU=False, IVFFlat=True,
+           search='range', batch_size=65536, index=None, core_only=False, index_factory=None, refine_factor=None,
+           report=None):
     """Perform DBSCAN clustering from vector array or distance matrix.
 
     Read more in the :ref:`User Guide <dbscan>`.
@@ -118,7 +293,7 @@ def faiss_dbscan(X, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', me
     X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
             array of shape (n_samples, n_samples)
         A feature array, or array of distances between samples if
-        ``metric='precomputed'``.
+        ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
 
     eps : float, optional
         The maximum distance between two samples for them to be considered
@@ -163,9 +338,52 @@ def faiss_dbscan(X, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', me
         weight may inhibit its eps-neighbor from being core.
         Note that weights are absolute, and default to 1.
 
-    n_jobs : int, optional (default = 1)
-        The number of parallel jobs to run for neighbors search.
-        If ``-1``, then the number of jobs is set to the number of CPU cores.
+    n_jobs : int, optional (default = None)
+        The number of faiss threads for the index build and the neighbors
+        search, set with ``faiss.omp_set_num_threads`` for the call.
+        If ``-1``, then the number of jobs is set to the number of CPU cores;
+        None keeps faiss's default.
+
+    search : {'range', 'knn'}, optional (default = 'range')
+        'range' finds the exact eps-neighborhoods with faiss range search
+        (exact on a flat index, restricted to the nprobe probed lists on an
+        IVF index). 'knn' searches a number of nearest neighbors guessed
+        from random probes, which may truncate dense neighborhoods; GPU
+        indexes always use it. In both, eps is a Euclidean distance.
+
+    batch_size : int, optional (default = 65536)
+        Number of queries per faiss search call. Every batch is reduced to
+        its eps-neighborhoods before the next is searched, so this bounds
+        the memory of the intermediate faiss results (batch_size * k
+        distances and labels for search='knn').
+
+    index : faiss index, optional
+        CPU index already holding X, e.g. from ``build_index``, reused
+        instead of building a new one.
+
+    index_factory : string, optional
+        faiss index_factory description of the index to build, replacing
+        nlist and IVFFlat, e.g. 'IVF4096,PQ16' or 'IVF4096,SQ8' to store
+        compressed vectors, or 'HNSW32' for a graph index (whose search
+        may miss some neighbors). Distances from compressed codes are
+        approximate; see refine_factor.
+
+    refine_factor : float, optional
+        Re-rank the neighbors with exact distances recomputed from X:
+        candidates are searched within refine_factor * eps (range search)
+        or among refine_factor * k (knn search), and only the true
+        eps-neighbors kept. A factor slightly above 1 recovers most
+        neighbors lost to quantization.
+
+    report : callable, optional
+        Called with the ``index_report`` (type, memory, build time) of an
+        index built here, e.g. ``print_index_report``.
+
+    core_only : bool, optional (default = False)
+        Range-search twice: first only counting the neighbors to find the
+        core samples, then storing the neighborhoods of the core samples
+        alone, through which clusters expand. Same labels, less memory
+        when most samples are not core. Needs search='range' on the CPU.
 
     Returns
     -------
@@ -205,24 +423,36 @@ def faiss_dbscan(X, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', me
     # Calculate neighborhood for all samples. This leaves the original point
     # in, which needs to be considered later (i.e. point i is in the
     # neighborhood of point i. While True, its useless information)
-    if GPU is True:
-        neighborhoods = gpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=IVFFlat)
-    else:
-        neighborhoods = cpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False, IVFFlat=IVFFlat)
-    if sample_weight is None:
-        n_neighbors = np.array([len(neighbors)
-                                for neighbors in neighborhoods])
-    else:
-        n_neighbors = np.array([np.sum(sample_weight[neighbors])
-                                for neighbors in neighborhoods])
-
-    # Initially, all samples are noise.
-    labels = -np.ones(X.shape[0], dtype=np.intp)
-
-    # A list of all core samples found.
-    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
-    dbscan_inner(core_samples, neighborhoods, labels)
-    return np.where(core_samples)[0], labels
+    n_neighbors = None
+    with faiss_threads(n_jobs):
+        if isinstance(X, KNNGraph):
+            # neighbors computed once, e.g. by KNNGraph.build; X's metric applies
+            indptr, indices = X.radius_csr(eps)
+        elif core_only:
+            if GPU is True or search != 'range':
+                raise ValueError("core_only needs search='range' on the CPU")
+            X = np.ascontiguousarray(X, dtype=np.float32)
+            if index is None:
+                index = build_index(X, nlist, IVFFlat, index_factory, report)
+            set_nprobe(index, nprobe)
+            n_neighbors = range_search_counts(index, X, eps, batch_size=batch_size, sample_weight=sample_weight,
+                                              refine_factor=refine_factor)
+            indptr, indices = range_search_neighbors(index, X, eps, batch_size=batch_size,
+                                                     rows=np.flatnonzero(n_neighbors >= min_samples),
+                                                     refine_factor=refine_factor)
+        elif GPU is True:
+            X = np.ascontiguousarray(X, dtype=np.float32)
+            indptr, indices = gpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False,
+                                                   IVFFlat=IVFFlat, index_factory=index_factory,
+                                                   refine_factor=refine_factor, batch_size=batch_size)
+        else:
+            X = np.ascontiguousarray(X, dtype=np.float32)
+            indptr, indices = cpu_radius_neighbors(X, eps, min_samples, nlist, nprobe, return_distance=False,
+                                                   IVFFlat=IVFFlat, search=search, batch_size=batch_size, index=index,
+                                                   index_factory=index_factory, refine_factor=refine_factor,
+                                                   report=report)
+    # with core_only, only the rows of core samples were searched
+    return dbscan_csr(indptr, indices, min_samples, sample_weight, n_neighbors=n_neighbors)
 
 class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
     """Perform DBSCAN clustering from vector array or distance matrix.
@@ -275,9 +505,36 @@ class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
         The power of the Minkowski metric to be used to calculate distance
         between points.
 
-    n_jobs : int, optional (default = 1)
-        The number of parallel jobs to run.
-        If ``-1``, then the number of jobs is set to the number of CPU cores.
+    n_jobs : int, optional (default = None)
+        The number of faiss threads, see ``faiss_dbscan``.
+
+    search : {'range', 'knn'}, optional (default = 'range')
+        Exact faiss range search, or k-nearest-neighbor search with k
+        guessed from random probes. See ``faiss_dbscan``.
+
+    batch_size : int, optional (default = 65536)
+        Number of queries per faiss search call.
+
+    core_only : bool, optional (default = False)
+        Count the neighbors first and store the neighborhoods of the core
+        samples only, see ``faiss_dbscan``.
+
+    index_factory : string, optional
+        faiss index_factory description of the index, e.g. 'IVF4096,PQ16',
+        'IVF4096,SQ8' or 'HNSW32'; replaces nlist and IVFFlat. See
+        ``faiss_dbscan``.
+
+    refine_factor : float, optional
+        Re-rank neighbors with exact distances, see ``faiss_dbscan``.
+
+    report : callable, optional
+        Called with the ``index_report`` of every index built, instead of
+        printing it with ``print_index_report``.
+
+    index_dir : string, optional
+        Directory where the built CPU index is written with
+        ``faiss.write_index`` and read back by later fits on the same data,
+        under a name made of the data fingerprint and the index type.
 
     Attributes
     ----------
@@ -285,12 +542,22 @@ class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
         Indices of core samples.
 
     components_ : array, shape = [n_core_samples, n_features]
-        Copy of each core sample found by training.
+        Copy of each core sample found by training, None if fit on a
+        ``KNNGraph``.
 
     labels_ : array, shape = [n_samples]
         Cluster labels for each point in the dataset given to fit().
         Noisy samples are given the label -1.
 
+    index_ : faiss index
+        CPU index of the last data fit, reused by later ``fit`` and
+        ``fit_sweep`` calls while the data fingerprint and the index
+        parameters are unchanged.
+
+    index_report_ : dict
+        ``index_report`` of ``index_``; its build_time is None if the
+        index was read from index_dir.
+
     Notes
     -----
     See examples/cluster/plot_dbscan.py for an example.
@@ -312,7 +579,9 @@ class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
     and Data Mining, Portland, OR, AAAI Press, pp. 226-231. 1996
     """
 
-    def __init__(self, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', n_jobs=1, GPU=False, IVFFlat=True):
+    def __init__(self, eps=0.5, min_samples=5, nlist=100, nprobe=5, metric='l2', n_jobs=None, GPU=False, IVFFlat=True,
+                 search='range', batch_size=65536, index_dir=None, core_only=False, index_factory=None,
+                 refine_factor=None, report=None):
         self.eps = eps
         self.min_samples = min_samples
         self.metric = metric
@@ -321,6 +590,42 @@ class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
         self.IVFFlat = IVFFlat
         self.nlist = nlist
         self.nprobe = nprobe
+        self.search = search
+        self.batch_size = batch_size
+        self.index_dir = index_dir
+        self.core_only = core_only
+        self.index_factory = index_factory
+        self.refine_factor = refine_factor
+        self.report = report
+
+    def _fit_index(self, X):
+        """The CPU index of X: cached on the estimator, read from index_dir,
+        or built (and written to index_dir)."""
+        if self.index_factory is not None:
+            index_type = re.sub('[^0-9A-Za-z]+', '-', self.index_factory)
+        else:
+            index_type = 'ivf%d' % self.nlist if self.IVFFlat else 'flat'
+        key = '%s_%s' % (data_fingerprint(X), index_type)
+        if getattr(self, 'index_key_', None) == key:
+            return self.index_
+        path = None
+        if self.index_dir is not None:
+            path = os.path.join(self.index_dir, key + '.faissindex')
+        if path is not None and os.path.exists(path):
+            index = faiss.read_index(path)
+            self.index_report_ = index_report(index)
+        else:
+            reports = []
+            with faiss_threads(self.n_jobs):
+                index = build_index(X, self.nlist, self.IVFFlat, self.index_factory, report=reports.append)
+            self.index_report_ = reports[0]
+            (self.report or print_index_report)(self.index_report_)
+            if path is not None:
+                if not os.path.isdir(self.index_dir):
+                    os.makedirs(self.index_dir)
+                faiss.write_index(index, path)
+        self.index_, self.index_key_ = index, key
+        return index
 
     def fit(self, X, y=None, sample_weight=None):
         """Perform DBSCAN clustering from features or distance matrix.
@@ -330,24 +635,75 @@ class Faiss_DBSCAN(BaseEstimator, ClusterMixin):
         X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
                 array of shape (n_samples, n_samples)
             A feature array, or array of distances between samples if
-            ``metric='precomputed'``.
+            ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
         sample_weight : array, shape (n_samples,), optional
             Weight of each sample, such that a sample with a weight of at least
             ``min_samples`` is by itself a core sample; a sample with negative
             weight may inhibit its eps-neighbor from being core.
             Note that weights are absolute, and default to 1.
         """
-        #if metric is not "rmsd":
-        #    X = check_array(X, accept_sparse='csr')
-        #t0 = time.time()
-        clust = faiss_dbscan(X, eps=self.eps, min_samples=self.min_samples, nlist=self.nlist, nprobe=self.nprobe, sample_weight=sample_weight, GPU=self.GPU, IVFFlat=self.IVFFlat)
-        #t1 = time.time()
-        #print("Faiss DBSCAN clustering Time Cost:", t1 - t0)
+        index = None
+        if not isinstance(X, KNNGraph) and self.GPU is not True:
+            X = np.ascontiguousarray(X, dtype=np.float32)
+            index = self._fit_index(X)
+        clust = faiss_dbscan(X, eps=self.eps, min_samples=self.min_samples, nlist=self.nlist, nprobe=self.nprobe,
+                             sample_weight=sample_weight, GPU=self.GPU, IVFFlat=self.IVFFlat, search=self.search,
+                             batch_size=self.batch_size, index=index, core_only=self.core_only,
+                             index_factory=self.index_factory, refine_factor=self.refine_factor,
+                             n_jobs=self.n_jobs)
         self.core_sample_indices_, self.labels_ = clust
-        if len(self.core_sample_indices_):
+        if isinstance(X, KNNGraph):
+            # the graph does not hold the samples themselves
+            self.components_ = None
+        elif len(self.core_sample_indices_):
             # fix for scipy sparse indexing issue
             self.components_ = X[self.core_sample_indices_].copy()
         else:
             # no core samples
             self.components_ = np.empty((0, X.shape[1]))
         return self
+
+    def fit_sweep(self, X, params, sample_weight=None):
+        """Cluster X for many parameter combinations with one index.
+
+        The index is built (or reused) once. For every nprobe, the
+        neighborhoods are range-searched once at the largest eps, with
+        distances; those of smaller eps are obtained by thresholding them.
+
+        Parameters
+        ----------
+        X : array of shape (n_samples, n_features)
+        params : list of dict
+            Each with any of 'eps', 'min_samples' and 'nprobe'; missing
+            keys take the estimator's values.
+        sample_weight : array, shape (n_samples,), optional
+
+        Returns
+        -------
+        results : list of (core_sample_indices, labels), in the order of params
+        """
+        if self.GPU is True:
+            raise ValueError("fit_sweep needs range search, which GPU indexes do not support")
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight)
+            check_consistent_length(X, sample_weight)
+        defaults = dict(eps=self.eps, min_samples=self.min_samples, nprobe=self.nprobe)
+        params = [dict(defaults, **param) for param in params]
+        for param in params:
+            if not param['eps'] > 0.0:
+                raise ValueError("eps must be positive.")
+        index = self._fit_index(X)
+        results = [None] * len(params)
+        for nprobe in sorted(set(param['nprobe'] for param in params)):
+            group = [i for i, param in enumerate(params) if param['nprobe'] == nprobe]
+            set_nprobe(index, nprobe)
+            eps_max = max(params[i]['eps'] for i in group)
+            with faiss_threads(self.n_jobs):
+                indptr, indices, distances = range_search_neighbors(index, X, eps_max, batch_size=self.batch_size,
+                                                                    return_distance=True,
+                                                                    refine_factor=self.refine_factor)
+            for i in group:
+                sub_indptr, sub_indices = threshold_csr(indptr, indices, distances, np.float32(params[i]['eps']) ** 2)
+                results[i] = dbscan_csr(sub_indptr, sub_indices, params[i]['min_samples'], sample_weight)
+        return results
@@ -4,15 +4,293 @@ __author__ = 'stephen'
 import os, sys
 import numpy as np
 import time
+import queue
+import threading
 import mdtraj as md
+import numba
+import faiss
+from numba import njit, prange
 from sklearn.base import BaseEstimator, ClusterMixin
 from sklearn.utils import check_array, check_random_state
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 #===============================================================================
 # LOCAL IMPORTS:
-from ..metrics.pairwise import pairwise_distances
+from ..metrics.pairwise import pairwise_distances, pairwise_distances_argmin_min, _numba_lock
+from ..metrics.rmsd_ import RMSDDataset, as_rmsd_dataset
+from ..metrics.vptree_ import VPTree
+from .checkpoint_ import KCentersCheckpoint
 #===============================================================================
 
-def k_centers(X, n_clusters=8, metric='rmsd', random_state=None):
+# Distances are rounded (float32 RMSD in particular), so a frame is only
+# pruned when the triangle bound clears it by this relative margin.
+_PRUNE_SLACK = 1.0 + 1e-4
+# Metrics for which the triangle inequality holds, with the factor of the
+# pruning bound d(new, c) >= factor * d(x, c) in the units of the metric.
+PRUNE_FACTORS = {'rmsd': 2.0, 'euclidean': 2.0, 'sqeuclidean': 4.0, 'cityblock': 2.0, 'manhattan': 2.0,
+                 'chebyshev': 2.0, 'canberra': 2.0, 'hamming': 2.0, 'periodic': 2.0}
+
+@njit(parallel=True)
+def farthest_point_update(X, center, distances_, labels_, label, n_chunks):
+    """Fused k-centers update for (squared) euclidean feature arrays.
+    Compute the squared euclidean distance of every row of X to ``center``,
+    lower ``distances_`` and relabel ``labels_`` in place where the new
+    center is strictly closer, and return the index of the farthest point
+    after the update. The work is split into ``n_chunks`` blocks that run on
+    numba threads; ties in the running argmax resolve to the lowest index,
+    as with ``np.argmax``.
+    Parameters
+    ----------
+    X : array, [n_samples, n_features], float32 or float64, C-contiguous
+    center : array, [n_features,], float64
+    distances_ : array, [n_samples,]
+        Squared distance of each sample to its current center. Updated in place.
+    labels_ : array, [n_samples,]
+        Current center label of each sample. Updated in place.
+    label : int
+        Label of the new center.
+    n_chunks : int
+        Number of blocks the samples are split into.
+    Returns
+    -------
+    max_index : int
+        Index of the sample farthest from all centers.
+    """
+    n_samples, n_features = X.shape
+    chunk_size = (n_samples + n_chunks - 1) // n_chunks
+    chunk_max = np.full(n_chunks, -np.inf)
+    chunk_argmax = np.zeros(n_chunks, dtype=np.int64)
+    for c in prange(n_chunks):
+        start = c * chunk_size
+        stop = min(start + chunk_size, n_samples)
+        best = -np.inf
+        best_index = start
+        for i in range(start, stop):
+            d = 0.0
+            for j in range(n_features):
+                diff = np.float64(X[i, j]) - center[j]
+                d += diff * diff
+            if d < distances_[i]:
+                distances_[i] = d
+                labels_[i] = label
+            if distances_[i] > best:
+                best = distances_[i]
+                best_index = i
+        chunk_max[c] = best
+        chunk_argmax[c] = best_index
+    max_index = 0
+    best = -np.inf
+    for c in range(n_chunks):
+        if chunk_max[c] > best:
+            best = chunk_max[c]
+            max_index = chunk_argmax[c]
+    return max_index
+
+@njit(parallel=True)
+def pruned_farthest_point_update(X, center, distances_, labels_, label, center_distances, n_chunks):
+    """``farthest_point_update`` with triangle-inequality pruning.
+    ``center_distances[j]`` is the squared distance of the new center to
+    center j. A sample of cluster j can only move to the new center if
+    d(new, j) < 2 d(sample, j), i.e. ``center_distances[j] < 4 * distances_``
+    in squared units; all other samples are skipped without computing their
+    distance. Returns the index of the farthest sample and the number of
+    skipped distance evaluations.
+    """
+    n_samples, n_features = X.shape
+    chunk_size = (n_samples + n_chunks - 1) // n_chunks
+    chunk_max = np.full(n_chunks, -np.inf)
+    chunk_argmax = np.zeros(n_chunks, dtype=np.int64)
+    chunk_skipped = np.zeros(n_chunks, dtype=np.int64)
+    for c in prange(n_chunks):
+        start = c * chunk_size
+        stop = min(start + chunk_size, n_samples)
+        best = -np.inf
+        best_index = start
+        skipped = 0
+        for i in range(start, stop):
+            if center_distances[labels_[i]] > _PRUNE_SLACK * 4.0 * distances_[i]:
+                skipped += 1
+            else:
+                d = 0.0
+                for j in range(n_features):
+                    diff = np.float64(X[i, j]) - center[j]
+                    d += diff * diff
+                if d < distances_[i]:
+                    distances_[i] = d
+                    labels_[i] = label
+            if distances_[i] > best:
+                best = distances_[i]
+                best_index = i
+        chunk_max[c] = best
+        chunk_argmax[c] = best_index
+        chunk_skipped[c] = skipped
+    max_index = 0
+    best = -np.inf
+    for c in range(n_chunks):
+        if chunk_max[c] > best:
+            best = chunk_max[c]
+            max_index = chunk_argmax[c]
+    return max_index, chunk_skipped.sum()
+
+# numba's default (workqueue) threading layer must not be entered by two
+# Python threads at once; the fused kernel already uses every core anyway.
+# Shared with the kernels of metrics.pairwise.
+_kernel_lock = _numba_lock
+
+def _get_n_threads(n_jobs):
+    if n_jobs is None or n_jobs < 0:
+        return numba.config.NUMBA_NUM_THREADS
+    return max(1, min(n_jobs, numba.config.NUMBA_NUM_THREADS))
+
+def fused_k_centers(X, seed, n_clusters=8, metric='euclidean', n_jobs=None):
+    """Farthest-point k-centers on a feature array with the fused kernel.
+    Distances, labels and the running argmax are kept in preallocated
+    buffers of the same floating point type as X (float32 inputs stay
+    float32) and updated in place by ``farthest_point_update``.
+    Parameters
+    ----------
+    X : array, [n_samples, n_features]
+    seed : int
+        Index of the first center.
+    n_clusters : int, optional, default: 8
+    metric : {"euclidean", "sqeuclidean"}
+    n_jobs : int or None, optional
+        Number of threads. ``None`` or ``-1`` uses all numba threads.
+    Returns
+    -------
+    cluster_centers_ : list of int
+    labels_ : array, [n_samples,]
+    distances_ : array, [n_samples,]
+        Distance of each sample to its center, in the units of ``metric``.
+    """
+    if X.dtype != np.float32:
+        X = X.astype(np.float64, copy=False)
+    X = np.ascontiguousarray(X)
+    n_samples = len(X)
+    distances_ = np.full(n_samples, np.inf, dtype=X.dtype)
+    labels_ = np.zeros(n_samples, dtype=np.int32)
+
+    n_threads = _get_n_threads(n_jobs)
+    old_n_threads = numba.get_num_threads()
+    numba.set_num_threads(n_threads)
+    try:
+        n_chunks = min(n_samples, 4 * n_threads)
+        cluster_centers_ = [seed]
+        with _kernel_lock:
+            MaxIndex = farthest_point_update(X, X[seed].astype(np.float64), distances_, labels_, 0, n_chunks)
+            for i in range(1, n_clusters):
+                cluster_centers_.append(int(MaxIndex))
+                #set the furthest point from existing center as a new center
+                MaxIndex = farthest_point_update(X, X[MaxIndex].astype(np.float64), distances_, labels_, i, n_chunks)
+    finally:
+        numba.set_num_threads(old_n_threads)
+
+    if metric == 'euclidean':
+        np.sqrt(distances_, out=distances_)
+    return cluster_centers_, labels_, distances_
+
+def _distances_to(X, center, metric, frames=None):
+    """Distances from the single frame ``center`` (an RMSDDataset for RMSD,
+    a [1, n_features] array otherwise) to all frames of X, or to ``frames``."""
+    if metric == 'rmsd':
+        return X.rmsd(center, 0, frames=frames)
+    if frames is not None:
+        X = X[frames]
+    if metric in ('euclidean', 'sqeuclidean'):
+        # same arithmetic as the fused kernel
+        diff = X.astype(np.float64) - center.astype(np.float64)
+        distances = np.einsum('ij,ij->i', diff, diff).astype(X.dtype)
+        return np.sqrt(distances) if metric == 'euclidean' else distances
+    return pairwise_distances(X, center, index=0, metric=metric)
+
+def _frame_distances(X, index, metric, frames=None):
+    """Distances from frame ``index`` of X to all frames, or to ``frames`` only."""
+    return _distances_to(X, X[[index]], metric, frames=frames)
+
+def pruned_k_centers(X, seed, n_clusters=8, metric='rmsd', n_jobs=None):
+    """K-Centers with triangle-inequality pruning.
+    A frame x with center c can only be claimed by a new center n if
+    d(n, c) < 2 d(x, c): otherwise d(n, x) >= d(n, c) - d(x, c) >= d(x, c).
+    Every step computes the distances from the new center to the previous
+    centers and evaluates the new center only against the frames that pass
+    this test, so clusters far from the new center, and all small clusters
+    late in the run, are skipped. Centers and labels are identical to
+    ``k_centers``.
+    Parameters
+    ----------
+    X : array, [n_samples, n_features], md.Trajectory or RMSDDataset
+    seed : int
+        Index of the first center.
+    n_clusters : int, optional, default: 8
+    metric : string, optional, default: "rmsd"
+        One of ``PRUNE_FACTORS``, the metrics obeying the triangle inequality
+        (for sqeuclidean the bound is applied to the squared distances).
+    n_jobs : int or None, optional
+        Threads for euclidean/sqeuclidean, as in ``fused_k_centers``.
+    Returns
+    -------
+    cluster_centers_ : list of int
+    labels_ : array, [n_samples,]
+    distances_ : array, [n_samples,]
+    n_skipped : int
+        Number of frame-to-center distance evaluations that were skipped.
+        The n_clusters * (n_clusters - 1) / 2 center-to-center distances
+        the pruning needs are not subtracted.
+    """
+    if metric not in PRUNE_FACTORS:
+        raise ValueError("Triangle-inequality pruning is not valid for metric %r" % metric)
+    n_samples = len(X)
+    labels_ = np.zeros(n_samples, dtype=np.int32)
+    n_skipped = 0
+    cluster_centers_ = [seed]
+    if metric in ('euclidean', 'sqeuclidean'):
+        if X.dtype != np.float32:
+            X = X.astype(np.float64, copy=False)
+        X = np.ascontiguousarray(X)
+        distances_ = np.full(n_samples, np.inf, dtype=X.dtype)
+        n_threads = _get_n_threads(n_jobs)
+        old_n_threads = numba.get_num_threads()
+        numba.set_num_threads(n_threads)
+        try:
+            n_chunks = min(n_samples, 4 * n_threads)
+            with _kernel_lock:
+                MaxIndex = farthest_point_update(X, X[seed].astype(np.float64), distances_, labels_, 0, n_chunks)
+                for i in range(1, n_clusters):
+                    cluster_centers_.append(int(MaxIndex))
+                    center = X[MaxIndex].astype(np.float64)
+                    # squared center-to-center distances, the kernel's units
+                    diff = X[cluster_centers_[:-1]].astype(np.float64) - center
+                    center_distances = np.einsum('ij,ij->i', diff, diff)
+                    MaxIndex, skipped = pruned_farthest_point_update(X, center, distances_, labels_, i,
+                                                                     center_distances, n_chunks)
+                    n_skipped += int(skipped)
+        finally:
+            numba.set_num_threads(old_n_threads)
+        if metric == 'euclidean':
+            np.sqrt(distances_, out=distances_)
+        return cluster_centers_, labels_, distances_, n_skipped
+
+    if metric == 'rmsd':
+        X = as_rmsd_dataset(X)
+    factor = PRUNE_FACTORS[metric] * _PRUNE_SLACK
+    distances_ = _frame_distances(X, seed, metric)
+    for i in range(1, n_clusters):
+        MaxIndex = int(np.argmax(distances_))
+        cluster_centers_.append(MaxIndex)
+        #set the furthest point from existing center as a new center
+        center_distances = _frame_distances(X, MaxIndex, metric, frames=np.array(cluster_centers_[:-1]))
+        candidates = np.where(center_distances[labels_] <= factor * distances_)[0]
+        n_skipped += n_samples - len(candidates)
+        if len(candidates) == 0:
+            continue
+        new_distance_list = _frame_distances(X, MaxIndex, metric, frames=candidates)
+        updated = new_distance_list < distances_[candidates]
+        updated_indices = candidates[updated]
+        distances_[updated_indices] = new_distance_list[updated]
+        labels_[updated_indices] = i
+    return cluster_centers_, labels_, distances_, n_skipped
+
+def k_centers(X, n_clusters=8, metric='rmsd', random_state=None, n_jobs=None, prune=False,
+              return_distance=False, return_n_skipped=False):
     """K-Centers clustering
     Cluster a vector or Trajectory dataset using a simple heuristic to minimize
     the maximum distance from any data point to its assigned cluster center.
@@ -25,14 +303,25 @@ def k_centers(X, n_clusters=8, metric='rmsd', random_state=None):
         The number of clusters to form as well as the number of
         centroids to generate.
     metric : {"euclidean", "sqeuclidean", "cityblock", "chebyshev", "canberra",
-              "braycurtis", "hamming", "jaccard", "cityblock", "rmsd"}
+              "braycurtis", "hamming", "jaccard", "cityblock", "periodic", "rmsd"}
         The distance metric to use. metric = "rmsd" requires that sequences
         passed to ``fit()`` be ```md.Trajectory```; other distance metrics
-        require ``np.ndarray``s.
+        require ``np.ndarray``s. "periodic" treats the features as angles
+        in degrees (e.g. phi/psi dihedrals), see ``metrics.pairwise``.
     random_state : integer or numpy.RandomState, optional
         The generator used to initialize the centers. If an integer is
         given, it fixes the seed. Defaults to the global numpy random
         number generator.
+    n_jobs : int or None, optional
+        Number of threads used by the fused euclidean/sqeuclidean kernel.
+        ``None`` or ``-1`` uses all available threads.
+    prune : bool, optional, default: False
+        Skip frames that the triangle inequality rules out, see
+        ``pruned_k_centers``. Same centers and labels, fewer distances.
+    return_distance : bool, optional, default: False
+        Also return the distance of each sample to its center.
+    return_n_skipped : bool, optional, default: False
+        Also return the number of skipped distance evaluations.
     References
     ----------
     .. [1] Gonzalez, Teofilo F. "Clustering to minimize the maximum
@@ -40,12 +329,18 @@ def k_centers(X, n_clusters=8, metric='rmsd', random_state=None):
     .. [2] Beauchamp, Kyle A., et al. "MSMBuilder2: modeling conformational
        dynamics on the picosecond to millisecond scale." J. Chem. Theory.
        Comput. 7.10 (2011): 3412-3419.
+    .. [3] Elkan, Charles. "Using the triangle inequality to accelerate
+       k-means." ICML (2003): 147-153.
     Attributes
     ----------
     cluster_centers_ : array, [n_clusters, n_features] or md.Trajectory
         Coordinates of cluster centers
     labels_ : array, [n_samples,]
         The label of each point is an integer in [0, n_clusters).
+    distances_ : array, [n_samples,]
+        Only returned if ``return_distance`` is True.
+    n_skipped : int
+        Only returned if ``return_n_skipped`` is True.
     """
     n_samples = len(X)
     if random_state == -1:
@@ -53,6 +348,19 @@ def k_centers(X, n_clusters=8, metric='rmsd', random_state=None):
     else:
         seed = random_state
     print("seed=", seed)
+    if prune:
+        cluster_centers_, labels_, distances_, n_skipped = pruned_k_centers(X, seed, n_clusters=n_clusters,
+                                                                            metric=metric, n_jobs=n_jobs)
+        print("Pruned distance evaluations:", n_skipped, "of", n_samples * (n_clusters - 1))
+        return _k_centers_result(cluster_centers_, labels_, distances_, n_skipped, return_distance, return_n_skipped)
+    if metric in ('euclidean', 'sqeuclidean') and isinstance(X, np.ndarray) and X.ndim == 2:
+        cluster_centers_, labels_, distances_ = fused_k_centers(X, seed, n_clusters=n_clusters, metric=metric,
+                                                                n_jobs=n_jobs)
+        return _k_centers_result(cluster_centers_, labels_, distances_, 0, return_distance, return_n_skipped)
+    if metric == 'rmsd':
+        # center the frames and compute their traces once, not per center
+        X = as_rmsd_dataset(X)
+
     cluster_centers_ = []
     cluster_centers_.append(seed)  #seed = random
     distances_ = pairwise_distances(X, index=seed, metric=metric)
@@ -71,59 +379,434 @@ def k_centers(X, n_clusters=8, metric='rmsd', random_state=None):
         distances_[ updated_indices ] = new_distance_list[ updated_indices ]
         labels_[ updated_indices ] = i
 
-    return cluster_centers_, labels_
+    return _k_centers_result(cluster_centers_, labels_, distances_, 0, return_distance, return_n_skipped)
 
-def k_centers_assign(X, centers=None, n_clusters=8, metric='rmsd', random_state=None):
-    """K-Centers clustering
-    Cluster a vector or Trajectory dataset using a simple heuristic to minimize
-    the maximum distance from any data point to its assigned cluster center.
-    The runtime of this algorithm is O(kN), where k is the number of
-    clusters and N is the size of the dataset, making it one of the least
-    expensive clustering algorithms available.
+def _k_centers_result(cluster_centers_, labels_, distances_, n_skipped, return_distance, return_n_skipped):
+    result = (cluster_centers_, labels_)
+    if return_distance:
+        result += (distances_,)
+    if return_n_skipped:
+        result += (n_skipped,)
+    return result
+
+def _slice_frames(X, start, stop):
+    """Slice frames [start, stop) of an array or md.Trajectory, keeping the
+    RMSD traces of a precentered trajectory aligned with the sliced frames."""
+    X_chunk = X[start:stop]
+    if isinstance(X, md.Trajectory) and X._rmsd_traces is not None:
+        X_chunk._rmsd_traces = X._rmsd_traces[start:stop]
+    return X_chunk
+
+def assign_chunk(X_chunk, centers, metric='rmsd', parallel=True):
+    """Assign one block of frames to the nearest of ``centers``.
+    For metric = "rmsd" the loop runs over centers, not frames: every
+    ``md.rmsd`` call measures the whole block against one center and a
+    running min/argmin is kept per frame. Other metrics are handled by
+    ``metrics.pairwise.pairwise_distances_argmin_min``.
+    Returns
+    -------
+    labels_ : array, [n_frames,], int32
+    distances_ : array, [n_frames,], float32
+    """
+    if metric != "rmsd":
+        labels_, distances_ = pairwise_distances_argmin_min(X_chunk, centers, metric=metric)
+        return labels_, distances_.astype(np.float32)
+    X_chunk = as_rmsd_dataset(X_chunk)
+    centers = as_rmsd_dataset(centers)
+    n_frames = len(X_chunk)
+    labels_ = np.zeros(n_frames, dtype=np.int32)
+    distances_ = np.full(n_frames, np.inf, dtype=np.float32)
+    for j in range(len(centers)):
+        new_distances = X_chunk.rmsd(centers, j, parallel=parallel)
+        updated_indices = new_distances < distances_
+        distances_[updated_indices] = new_distances[updated_indices]
+        labels_[updated_indices] = j
+    return labels_, distances_
+
+def _assign_chunk_star(args):
+    return assign_chunk(*args)
+
+def k_centers_assign(X, centers=None, n_clusters=8, metric='rmsd', random_state=None,
+                     chunk_size=10000, n_jobs=None, pool='thread', return_distance=False):
+    """K-Centers assignment
+    Assign every frame of a vector or Trajectory dataset to its nearest
+    cluster center. The frames are split into blocks of ``chunk_size``; each
+    block is compared against the centers one at a time (one ``md.rmsd``
+    call per block and center instead of one per frame) and a running
+    min/argmin is kept per frame. Blocks are dispatched to a thread or
+    process pool.
     Parameters
     ----------
+    X : array, [n_samples, n_features] or md.Trajectory
+        Frames to assign.
+    centers : array, [n_centers, n_features] or md.Trajectory
+        Coordinates of the cluster centers.
     n_clusters : int, optional, default: 8
-        The number of clusters to form as well as the number of
-        centroids to generate.
+        Unused, kept for backward compatibility.
     metric : {"euclidean", "sqeuclidean", "cityblock", "chebyshev", "canberra",
-              "braycurtis", "hamming", "jaccard", "cityblock", "rmsd"}
+              "braycurtis", "hamming", "jaccard", "cityblock", "periodic", "rmsd"}
         The distance metric to use. metric = "rmsd" requires that sequences
         passed to ``fit()`` be ```md.Trajectory```; other distance metrics
-        require ``np.ndarray``s.
+        require ``np.ndarray``s. "periodic" treats the features as angles
+        in degrees (e.g. phi/psi dihedrals), see ``metrics.pairwise``.
     random_state : integer or numpy.RandomState, optional
-        The generator used to initialize the centers. If an integer is
-        given, it fixes the seed. Defaults to the global numpy random
-        number generator.
-    References
-    ----------
-    .. [1] Gonzalez, Teofilo F. "Clustering to minimize the maximum
-       intercluster distance." Theor. Comput. Sci. 38 (1985): 293-306.
-    .. [2] Beauchamp, Kyle A., et al. "MSMBuilder2: modeling conformational
-       dynamics on the picosecond to millisecond scale." J. Chem. Theory.
-       Comput. 7.10 (2011): 3412-3419.
-    Attributes
-    ----------
-    cluster_centers_ : array, [n_clusters, n_features] or md.Trajectory
-        Coordinates of cluster centers
+        Unused, kept for backward compatibility.
+    chunk_size : int, optional, default: 10000
+        Number of frames per block. Bounds the memory of one task to
+        O(chunk_size) distances.
+    n_jobs : int or None, optional
+        Number of workers in the pool. ``None`` runs the blocks serially,
+        ``-1`` uses all CPUs.
+    pool : {"thread", "process"}, optional, default: "thread"
+        Kind of pool the blocks are dispatched to.
+    return_distance : bool, optional, default: False
+        Also return the distance of each frame to its assigned center.
+    Returns
+    -------
     labels_ : array, [n_samples,]
-        The label of each point is an integer in [0, n_clusters).
+        Index of the nearest center of each frame.
+    distances_ : array, [n_samples,], float32
+        Distance of each frame to its assigned center. Only returned if
+        ``return_distance`` is True.
     """
     n_samples = len(X)
     if centers is None:
-        print("No Cluster Centers found!")
+        raise ValueError("No Cluster Centers found!")
 
+    if metric == 'rmsd':
+        X = as_rmsd_dataset(X)
+        centers = as_rmsd_dataset(centers)
     n_centers = len(centers)
     print("N_Centers:", n_centers)
     print("N_samples:", n_samples)
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    bounds = [(start, min(start + chunk_size, n_samples)) for start in range(0, n_samples, chunk_size)]
+    # md.rmsd is already OpenMP parallel; only let it spawn threads when
+    # the blocks themselves run serially.
+    parallel = n_jobs is None or n_jobs == 1
+    tasks = ((_slice_frames(X, start, stop), centers, metric, parallel) for start, stop in bounds)
+
     labels_ = np.zeros(n_samples, dtype=np.int32)
-    #distances_ = np.zeros(n_centers, dtype=np.float32)
-    for i in range(0, n_samples):
-        distances_ = pairwise_distances(X=centers, Y=X, index=i, metric=metric)
-        #distances_ = md.rmsd(centers, X, i, parallel=True, precentered=True)
-        cluster_num = np.argmin(distances_)
-        labels_[ i ] = cluster_num
+    distances_ = np.zeros(n_samples, dtype=np.float32)
+    if parallel:
+        results = map(_assign_chunk_star, tasks)
+        executor = None
+    elif pool == 'thread':
+        executor = ThreadPoolExecutor(max_workers=n_jobs)
+        results = executor.map(_assign_chunk_star, tasks)
+    elif pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+        results = executor.map(_assign_chunk_star, tasks)
+    else:
+        raise ValueError("pool must be 'thread' or 'process', got %r" % pool)
+    try:
+        for (start, stop), (chunk_labels, chunk_distances) in zip(bounds, results):
+            labels_[start:stop] = chunk_labels
+            distances_[start:stop] = chunk_distances
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if return_distance:
+        return labels_, distances_
     return labels_
 
+def _prefetch(iterable, depth=1):
+    """Iterate over ``iterable`` while a background thread decodes up to
+    ``depth`` items ahead, so reading the next chunk overlaps with the
+    distance computation on the current one."""
+    if depth < 1:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            items.put((done, e))
+            return
+        items.put((done, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+def iter_chunks(X, chunk_size=10000):
+    """Return a fresh iterator over the chunks of a streaming data source.
+    ``X`` may be a callable returning an iterable of chunks (for example
+    ``lambda: md.iterload(filename, top=top, chunk=1000)``), an array or
+    np.memmap or RMSDDataset that is read ``chunk_size`` frames at a time, or any
+    re-iterable sequence of arrays / md.Trajectory chunks."""
+    if callable(X):
+        return iter(X())
+    if isinstance(X, (np.ndarray, md.Trajectory, RMSDDataset)):
+        return (X[start:start + chunk_size] for start in range(0, len(X), chunk_size))
+    it = iter(X)
+    if it is X:
+        raise ValueError("Streaming k-centers makes one pass over the data per center; pass a callable "
+                         "returning a fresh iterator (e.g. lambda: md.iterload(...)) instead of an iterator.")
+    return it
+
+def _copy_frame(X_chunk, index):
+    # copy, so a kept center frame does not pin the whole decoded chunk
+    if isinstance(X_chunk, RMSDDataset):
+        return X_chunk[[index]].to_trajectory(topology=X_chunk.topology)
+    if isinstance(X_chunk, md.Trajectory):
+        return X_chunk[index:index + 1]
+    return np.array(X_chunk[index:index + 1])
+
+def _take_frames(X, indices):
+    # the center frames of an RMSDDataset are returned as a (precentered) md.Trajectory
+    if isinstance(X, RMSDDataset):
+        return X.to_trajectory(frames=indices, topology=X.topology)
+    return X[indices]
+
+def distance_dtype(X, metric):
+    """Floating point type of the min-distance buffer for data like X."""
+    if metric in ('euclidean', 'sqeuclidean') and getattr(X, 'dtype', None) != np.float32:
+        return np.float64
+    return np.float32
+
+def _as_block(X_chunk, dtype, metric, copy=True):
+    if metric in ('euclidean', 'sqeuclidean'):
+        return np.ascontiguousarray(X_chunk, dtype=dtype)
+    if metric == 'rmsd':
+        # memory-mapped (n_frames, n_atoms, 3) coordinate stores are accepted too
+        return as_rmsd_dataset(X_chunk, copy=copy)
+    return X_chunk
+
+def update_distances(X, center, distances_, labels_, label, metric='rmsd', n_chunks=1):
+    """One k-centers step on a block of frames.
+    Lower ``distances_`` and set ``labels_`` to ``label`` in place wherever
+    the single frame ``center`` is strictly closer, then return the (local)
+    index of the frame farthest from all centers. For euclidean and
+    sqeuclidean the fused kernel is used: X must be C-contiguous with the
+    dtype of ``distances_``, which holds *squared* distances.
+    """
+    if metric in ('euclidean', 'sqeuclidean'):
+        with _kernel_lock:
+            return farthest_point_update(X, np.asarray(center, dtype=np.float64).ravel(),
+                                         distances_, labels_, label, n_chunks)
+    if metric == 'rmsd':
+        new_distance_list = X.rmsd(as_rmsd_dataset(center))
+    else:
+        new_distance_list = pairwise_distances(X, center, index=0, metric=metric)
+    updated_indices = np.where(new_distance_list < distances_)[0]
+    distances_[updated_indices] = new_distance_list[updated_indices]
+    labels_[updated_indices] = label
+    return int(np.argmax(distances_))
+
+def _fetch_frames(X, chunk_size, indices):
+    """Copies of the frames at the global ``indices`` of a streaming source, in that order."""
+    frames = {}
+    wanted = set(int(index) for index in indices)
+    offset = 0
+    for X_chunk in iter_chunks(X, chunk_size):
+        for index in wanted:
+            if offset <= index < offset + len(X_chunk):
+                frames[index] = _copy_frame(X_chunk, index - offset)
+        offset += len(X_chunk)
+        if len(frames) == len(wanted):
+            break
+    missing = wanted.difference(frames)
+    if missing:
+        raise ValueError("frames %s are out of range for %d frames" % (sorted(missing), offset))
+    return [frames[int(index)] for index in indices]
+
+def k_centers_streaming(X, n_clusters=8, metric='rmsd', random_state=None, chunk_size=10000, prefetch=1,
+                        n_jobs=None, checkpoint=None, checkpoint_interval=100, resume=False):
+    """Out-of-core K-Centers clustering
+    Same farthest-point heuristic as ``k_centers``, but the data are never
+    held in memory at once. Every new center costs one pass over the chunks
+    of X; only the per-frame minimum distances and labels (O(N) scalars)
+    and the center frames stay resident. A background thread decodes the
+    next chunk while distances are computed for the current one.
+    Parameters
+    ----------
+    X : callable, array, np.memmap or re-iterable of chunks
+        The streaming data source, see ``iter_chunks``. Chunks are
+        md.Trajectory for metric = "rmsd" (or arrays of shape
+        [n_frames, n_atoms, 3]) and [n_frames, n_features] arrays otherwise.
+    n_clusters : int, optional, default: 8
+    metric : string, optional, default: "rmsd"
+    random_state : integer, optional
+        Global index of the first center, or -1 for a random frame.
+    chunk_size : int, optional, default: 10000
+        Frames per chunk when X is an array or np.memmap.
+    prefetch : int, optional, default: 1
+        Number of chunks decoded ahead of the computation. 0 disables
+        the background reader.
+    n_jobs : int or None, optional
+        Threads for the fused euclidean/sqeuclidean kernel.
+    checkpoint : string or KCentersCheckpoint, optional
+        Directory the run is checkpointed to, see ``KCentersCheckpoint``.
+    checkpoint_interval : int, optional, default: 100
+        Number of centers between two checkpoint commits.
+    resume : bool, optional, default: False
+        Continue from the last commit in ``checkpoint`` if there is one.
+        ``n_clusters`` may be larger than in the interrupted run, but not
+        smaller than the number of centers it applied.
+    Returns
+    -------
+    cluster_centers_ : list of int
+        Global indices of the centers.
+    labels_ : array, [n_samples,]
+    distances_ : array, [n_samples,]
+        Distance of each frame to its center.
+    center_frames : md.Trajectory or array, [n_clusters, ...]
+        Coordinates of the centers.
+    """
+    def chunks():
+        return _prefetch(iter_chunks(X, chunk_size), prefetch)
+
+    # First pass: count the frames.
+    n_samples = 0
+    dtype = None
+    for X_chunk in iter_chunks(X, chunk_size):
+        if dtype is None:
+            dtype = distance_dtype(X_chunk, metric)
+        n_samples += len(X_chunk)
+
+    state = None
+    if checkpoint is not None:
+        if not isinstance(checkpoint, KCentersCheckpoint):
+            checkpoint = KCentersCheckpoint(checkpoint)
+        if resume and checkpoint.exists():
+            state, cluster_centers_, distances_, labels_ = checkpoint.load()
+            if state['n_samples'] != n_samples or state['metric'] != metric:
+                checkpoint.close()
+                raise ValueError("Checkpoint in %s is for %d frames with metric %r, not %d frames with %r"
+                                 % (checkpoint.path, state['n_samples'], state['metric'], n_samples, metric))
+            start = state['iteration']
+            if start > n_clusters:
+                # labels_ and distances_ already refer to the later centers
+                checkpoint.close()
+                raise ValueError("Checkpoint in %s has %d centers applied, more than n_clusters=%d"
+                                 % (checkpoint.path, start, n_clusters))
+            print("Resuming k-centers from iteration", start)
+    if state is None:
+        if random_state == -1:
+            seed = int(check_random_state(None).randint(0, n_samples))
+        else:
+            seed = random_state
+        print("seed=", seed)
+        if not 0 <= seed < n_samples:
+            raise ValueError("seed %d is out of range for %d frames" % (seed, n_samples))
+        start = 0
+        cluster_centers_ = [seed]
+        labels_ = np.zeros(n_samples, dtype=np.int32)
+        distances_ = np.full(n_samples, np.inf, dtype=dtype)
+        if checkpoint is not None:
+            checkpoint.create(n_samples, dtype, seed, metric=metric)
+            checkpoint.append(seed)
+    if start < n_clusters and len(cluster_centers_) == start:
+        # resumed a finished run with more clusters
+        cluster_centers_.append(int(np.argmax(distances_)))
+        if checkpoint is not None:
+            checkpoint.append(cluster_centers_[-1])
+    # prepared like the frames picked from the chunks below, so all are of one type
+    center_frames = [_copy_frame(_as_block(frame, distances_.dtype, metric), 0)
+                     for frame in _fetch_frames(X, chunk_size, cluster_centers_)]
+    center = center_frames[-1]
+
+    fused = metric in ('euclidean', 'sqeuclidean')
+    if fused:
+        n_threads = _get_n_threads(n_jobs)
+        old_n_threads = numba.get_num_threads()
+        numba.set_num_threads(n_threads)
+    try:
+        for i in range(start, n_clusters):
+            max_distance = -np.inf
+            offset = 0
+            for X_chunk in chunks():
+                stop = offset + len(X_chunk)
+                # chunks of a callable source are decoded fresh on every pass and may be
+                # centered in place; anything else belongs to the caller and is copied
+                X_chunk = _as_block(X_chunk, distances_.dtype, metric, copy=not callable(X))
+                n_chunks = min(len(X_chunk), 4 * n_threads) if fused else 1
+                local_max = update_distances(X_chunk, center, distances_[offset:stop], labels_[offset:stop], i,
+                                             metric=metric, n_chunks=n_chunks)
+                if distances_[offset + local_max] > max_distance:
+                    max_distance = distances_[offset + local_max]
+                    next_center = _copy_frame(X_chunk, local_max)
+                    next_index = offset + int(local_max)
+                offset = stop
+            if i + 1 < n_clusters:
+                #set the furthest point from existing center as a new center
+                center = next_center
+                cluster_centers_.append(next_index)
+                center_frames.append(center)
+                if checkpoint is not None:
+                    checkpoint.append(next_index)
+            if checkpoint is not None and ((i + 1) % checkpoint_interval == 0 or i + 1 == n_clusters):
+                checkpoint.commit(i + 1, len(cluster_centers_), distances_, labels_)
+    finally:
+        if fused:
+            numba.set_num_threads(old_n_threads)
+        if checkpoint is not None:
+            checkpoint.close()
+
+    cluster_centers_ = cluster_centers_[:n_clusters]
+    center_frames = center_frames[:n_clusters]
+    if metric == 'euclidean':
+        distances_ = np.sqrt(distances_)
+    if isinstance(center_frames[0], md.Trajectory):
+        center_frames = md.join(center_frames, check_topology=False)
+    else:
+        center_frames = np.concatenate(center_frames)
+    return cluster_centers_, labels_, distances_, center_frames
+
+class _StreamedFrames(object):
+    """The frames of a streaming source clustered by ``KCenters.fit``, read
+    back chunk by chunk when ``partial_fit`` relabels them."""
+    def __init__(self, source, chunk_size, metric):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.metric = metric
+
+    def __getitem__(self, indices):
+        frames = _fetch_frames(self.source, self.chunk_size, indices)
+        frames = md.join(frames, check_topology=False) if isinstance(frames[0], md.Trajectory) \
+            else np.concatenate(frames)
+        return _as_block(frames, distance_dtype(frames, self.metric), self.metric)
+
+    def distances(self, center, frames):
+        """Distances from ``center`` to the (sorted) ``frames``, in one pass."""
+        distances = np.empty(len(frames))
+        offset = 0
+        for X_chunk in iter_chunks(self.source, self.chunk_size):
+            stop = offset + len(X_chunk)
+            inside = (frames >= offset) & (frames < stop)
+            if inside.any():
+                block = _as_block(X_chunk, distance_dtype(X_chunk, self.metric), self.metric,
+                                  copy=not callable(self.source))
+                distances[inside] = _distances_to(block, center, self.metric, frames=frames[inside] - offset)
+            offset = stop
+            if offset > frames[-1]:
+                break
+        return distances
+
 class KCenters(BaseEstimator, ClusterMixin):
     """K-Centers clustering
     Cluster a vector or Trajectory dataset using a simple heuristic to minimize
@@ -137,14 +820,40 @@ class KCenters(BaseEstimator, ClusterMixin):
         The number of clusters to form as well as the number of
         centroids to generate.
     metric : {"euclidean", "sqeuclidean", "cityblock", "chebyshev", "canberra",
-              "braycurtis", "hamming", "jaccard", "cityblock", "rmsd"}
+              "braycurtis", "hamming", "jaccard", "cityblock", "periodic", "rmsd"}
         The distance metric to use. metric = "rmsd" requires that sequences
         passed to ``fit()`` be ```md.Trajectory```; other distance metrics
-        require ``np.ndarray``s.
+        require ``np.ndarray``s. "periodic" treats the features as angles
+        in degrees (e.g. phi/psi dihedrals), see ``metrics.pairwise``.
     random_state : integer or numpy.RandomState, optional
         The generator used to initialize the centers. If an integer is
         given, it fixes the seed. Defaults to the global numpy random
         number generator.
+    n_jobs : int or None, optional
+        Number of threads used by the fused euclidean/sqeuclidean kernel.
+        ``None`` or ``-1`` uses all available threads.
+    chunk_size : int, optional, default: 10000
+        Frames per block in ``assign`` and per chunk when ``fit`` streams
+        over an np.memmap.
+    prefetch : int, optional, default: 1
+        Number of chunks decoded ahead of the computation when ``fit``
+        streams over chunked data.
+    prune : bool, optional, default: False
+        Use triangle-inequality pruning when fitting in-memory data, see
+        ``pruned_k_centers``.
+    checkpoint : string, optional
+        Directory ``fit`` checkpoints to every ``checkpoint_interval``
+        centers. Checkpointed fits run the unpruned loop of
+        ``k_centers_streaming``.
+    checkpoint_interval : int, optional, default: 100
+    resume : bool, optional, default: False
+        Continue from the checkpoint if one exists, otherwise start over.
+    search_index : {"flat", "ivf"}, optional, default: "flat"
+        faiss index ``predict`` uses for euclidean/sqeuclidean features:
+        exact ``IndexFlatL2`` or approximate ``IndexIVFFlat``. RMSD and the
+        other metrics use a ``VPTree`` over the centers.
+    nprobe : int, optional, default: 8
+        Number of inverted lists an "ivf" search visits.
     References
     ----------
     .. [1] Gonzalez, Teofilo F. "Clustering to minimize the maximum
@@ -158,39 +867,288 @@ class KCenters(BaseEstimator, ClusterMixin):
         Coordinates of cluster centers
     labels_ : array, [n_samples,]
         The label of each point is an integer in [0, n_clusters).
+    cluster_center_frames_ : array, [n_clusters, n_features] or md.Trajectory
+        Coordinates of the cluster centers.
+    n_skipped_ : int
+        Distance evaluations skipped by the pruning in the last ``fit``.
+    index_ : faiss.Index or VPTree
+        Search index over the centers, built by the first ``predict``. It is
+        pickled with the estimator.
     """
-    def __init__(self, n_clusters=8, metric='rmsd', random_state=None, centers=None):
+    def __init__(self, n_clusters=8, metric='rmsd', random_state=None, centers=None, n_jobs=None,
+                 chunk_size=10000, prefetch=1, prune=False, checkpoint=None, checkpoint_interval=100,
+                 resume=False, search_index='flat', nprobe=8):
         self.n_clusters = n_clusters
         self.random_state = random_state
         self.metric = metric
         self.centers = centers
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.prune = prune
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.search_index = search_index
+        self.nprobe = nprobe
     def fit(self, X, y=None):
         """Perform clustering.
         Parameters
         -----------
-        X : array-like, shape=[n_samples, n_features]
-            Samples to cluster.
+        X : array-like, shape=[n_samples, n_features], md.Trajectory, RMSDDataset, or streaming source
+            Samples to cluster. An np.memmap, a callable returning an
+            iterable of chunks (e.g. ``lambda: md.iterload(...)``) or a
+            re-iterable sequence of chunks is clustered out-of-core by
+            ``k_centers_streaming``.
         """
         #X = check_array(X)
         t0 = time.time()
-        self.cluster_centers_, self.labels_ = \
-            k_centers(X, n_clusters=self.n_clusters,  metric=self.metric, random_state=self.random_state)
+        self.index_ = None
+        in_memory = isinstance(X, (md.Trajectory, RMSDDataset)) or \
+            (isinstance(X, np.ndarray) and not isinstance(X, np.memmap))
+        if in_memory:
+            # prepared once, for the clustering and for later partial_fit calls
+            block = _as_block(X, distance_dtype(X, self.metric), self.metric)
+        if self.checkpoint is not None:
+            # the in-memory data become a single, prepared chunk
+            source = [block] if in_memory else X
+            self.cluster_centers_, self.labels_, self.distances_, self.cluster_center_frames_ = \
+                k_centers_streaming(source, n_clusters=self.n_clusters, metric=self.metric,
+                                    random_state=self.random_state, chunk_size=self.chunk_size,
+                                    prefetch=0 if in_memory else self.prefetch, n_jobs=self.n_jobs,
+                                    checkpoint=self.checkpoint, checkpoint_interval=self.checkpoint_interval,
+                                    resume=self.resume)
+            if in_memory:
+                self.cluster_center_frames_ = _take_frames(X, self.cluster_centers_)
+            self.n_skipped_ = 0
+        elif in_memory:
+            self.cluster_centers_, self.labels_, self.distances_, self.n_skipped_ = \
+                k_centers(block, n_clusters=self.n_clusters,  metric=self.metric, random_state=self.random_state,
+                          n_jobs=self.n_jobs, prune=self.prune, return_distance=True, return_n_skipped=True)
+            self.cluster_center_frames_ = _take_frames(X, self.cluster_centers_)
+        else:
+            self.cluster_centers_, self.labels_, self.distances_, self.cluster_center_frames_ = \
+                k_centers_streaming(X, n_clusters=self.n_clusters, metric=self.metric,
+                                    random_state=self.random_state, chunk_size=self.chunk_size,
+                                    prefetch=self.prefetch, n_jobs=self.n_jobs)
+            self.n_skipped_ = 0
+        # the state partial_fit continues from; the frames themselves are only
+        # referenced, and prepared again by the first partial_fit
+        self.cluster_centers_ = [int(center) for center in self.cluster_centers_]
+        self._fit_X = X if in_memory else _StreamedFrames(X, self.chunk_size, self.metric)
+        self._blocks = None
+        self._offsets = [0, len(self.labels_)]
+        if in_memory:
+            self._center_blocks = [block[[center]] for center in self.cluster_centers_]
+        else:
+            frames = self.cluster_center_frames_
+            self._center_blocks = [_as_block(frames[j:j + 1], distance_dtype(frames, self.metric), self.metric)
+                                   for j in range(len(self.cluster_centers_))]
         t1 = time.time()
         print("K-Centers clustering Time Cost:", t1 - t0)
         return self
 
-    def assign(self, X, cluster_centers_frames):
+    def assign(self, X, cluster_centers_frames=None, chunk_size=None, pool='thread'):
         """ Perform K-Centers Assign
-        :param X:
-        :return:
+        Assign every frame of X to its nearest center with the block-wise
+        ``k_centers_assign``. Sets ``labels_`` and ``distances_`` (distance
+        of each frame to its assigned center).
+        :param X: array, [n_samples, n_features] or md.Trajectory
+        :param cluster_centers_frames: coordinates of the centers, defaults to ``self.centers``
+        :param chunk_size: number of frames per block, defaults to ``self.chunk_size``
+        :param pool: 'thread' or 'process', the pool the blocks run in when n_jobs > 1
+        :return: self
         """
+        if cluster_centers_frames is None:
+            cluster_centers_frames = self.centers
+        if chunk_size is None:
+            chunk_size = self.chunk_size
 
         t0 = time.time()
-        self.labels_ = k_centers_assign(X, centers=self.centers, n_clusters=self.n_clusters,  metric=self.metric, random_state=self.random_state)
+        self.labels_, self.distances_ = k_centers_assign(X, centers=cluster_centers_frames, n_clusters=self.n_clusters,
+                                                         metric=self.metric, random_state=self.random_state,
+                                                         chunk_size=chunk_size, n_jobs=self.n_jobs, pool=pool,
+                                                         return_distance=True)
         t1 = time.time()
         print("K-Centers assigning Time Cost:", t1 - t0)
         return self
 
+    def _build_index(self):
+        centers = getattr(self, 'cluster_center_frames_', None)
+        if centers is None:
+            centers = self.centers
+        if centers is None:
+            raise ValueError("predict needs a fitted model or centers")
+        if self.metric in ('euclidean', 'sqeuclidean'):
+            centers = np.ascontiguousarray(centers, dtype=np.float32)
+            n_centers, dimension = centers.shape
+            if self.search_index == 'ivf':
+                nlist = max(1, int(np.sqrt(n_centers)))
+                index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist, faiss.METRIC_L2)
+                index.train(centers)
+                index.nprobe = self.nprobe
+            elif self.search_index == 'flat':
+                index = faiss.IndexFlatL2(dimension)
+            else:
+                raise ValueError("Unknown search_index %r" % self.search_index)
+            index.add(centers)
+            return index
+        if self.metric in PRUNE_FACTORS:
+            return VPTree(centers, metric=self.metric)
+        # no triangle inequality, no tree: scan the centers
+        return centers
+
+    def predict(self, X, batch_size=10000, return_distance=False):
+        """ Predict the closest center of each frame of X.
+        The search index over the centers is built on the first call and
+        reused: a faiss index for euclidean/sqeuclidean features, a VP-tree
+        for RMSD. Frames are searched ``batch_size`` at a time.
+        :param X: array, [n_samples, n_features], md.Trajectory or a streaming source (see ``iter_chunks``)
+        :param batch_size: number of frames per search batch
+        :param return_distance: also return the distance of each frame to its center
+        :return: labels, array [n_samples,], and optionally distances, array [n_samples,]
+        """
+        if getattr(self, 'index_', None) is None:
+            self.index_ = self._build_index()
+        labels, distances = [], []
+        for X_batch in iter_chunks(X, batch_size):
+            if isinstance(self.index_, faiss.Index):
+                D, I = self.index_.search(np.ascontiguousarray(X_batch, dtype=np.float32), 1)
+                D = D[:, 0]
+                if self.metric == 'euclidean':
+                    D = np.sqrt(np.maximum(D, 0))
+                labels.append(I[:, 0].astype(np.int32))
+                distances.append(D)
+            elif isinstance(self.index_, VPTree):
+                D, I = self.index_.query(X_batch, k=1)
+                labels.append(I[:, 0].astype(np.int32))
+                distances.append(D[:, 0].astype(np.float32))
+            else:
+                batch_labels, batch_distances = assign_chunk(X_batch, self.index_, metric=self.metric)
+                labels.append(batch_labels)
+                distances.append(batch_distances)
+        labels = np.concatenate(labels)
+        if return_distance:
+            return labels, np.concatenate(distances)
+        return labels
+
+    def partial_fit(self, X, y=None):
+        """Add frames to the clustering without refitting the frames seen before.
+        The first call runs k-centers on X. Every later call measures only
+        the new frames against the existing centers, then promotes the
+        farthest frame to a new center for as long as some frame is farther
+        from its center than the radius before the call (the largest
+        distance of the old frames). Old frames are relabeled only when a
+        new center is closer; the triangle inequality restricts the
+        distances computed for them to frames the new center can claim.
+        The number of clusters grows by the number of promoted centers.
+
+        A model fitted with ``fit`` is continued the same way: the frames
+        ``fit`` clustered are prepared again on the first call (frames that
+        ``fit`` streamed are read back from their source when a new center
+        may claim them). ``fit`` only references its data, which is not
+        pickled, so an unpickled fitted model cannot be continued. The
+        frames passed to ``partial_fit`` and the per-frame distances are
+        kept on the estimator (and pickled with it) between calls.
+        :param X: array, [n_samples, n_features] or md.Trajectory
+        :return: self
+        """
+        t0 = time.time()
+        block = _as_block(X, distance_dtype(X, self.metric), self.metric)
+        fit_X = getattr(self, '_fit_X', None)
+        if getattr(self, '_blocks', None) is None and fit_X is not None:
+            self._blocks = [fit_X if isinstance(fit_X, _StreamedFrames)
+                            else _as_block(fit_X, distance_dtype(fit_X, self.metric), self.metric)]
+            self._fit_X = None
+        elif getattr(self, '_blocks', None) is None and getattr(self, '_offsets', None) is not None:
+            raise ValueError("The frames clustered by fit are not pickled with the model; "
+                             "fit it again before calling partial_fit")
+        if getattr(self, '_blocks', None) is None:
+            self._blocks, self._offsets = [], [0]
+            self.labels_ = np.zeros(0, dtype=np.int32)
+            self.distances_ = np.zeros(0, dtype=np.float64)
+            self.cluster_centers_ = []
+        n_old = self._offsets[-1]
+        self._blocks.append(block)
+        self._offsets.append(n_old + len(block))
+        if n_old == 0:
+            seed = check_random_state(None).randint(0, len(block)) if self.random_state in (None, -1) \
+                else self.random_state
+            print("seed=", seed)
+            self.labels_ = np.zeros(len(block), dtype=np.int32)
+            self.distances_ = np.full(len(block), np.inf)
+            self.cluster_centers_ = []
+            self._center_blocks = []
+            radius = None
+            promote = seed
+        else:
+            radius = self.distances_.max() if n_old else 0.0
+            labels, distances = self.predict(block, batch_size=self.chunk_size, return_distance=True)
+            self.labels_ = np.concatenate([self.labels_, labels])
+            self.distances_ = np.concatenate([self.distances_, distances])
+            promote = int(np.argmax(self.distances_))
+            if self.distances_[promote] <= radius:
+                promote = None
+        n_promoted = 0
+        while promote is not None:
+            self._add_center(promote)
+            n_promoted += 1
+            promote = int(np.argmax(self.distances_))
+            if radius is None:
+                if len(self.cluster_centers_) >= self.n_clusters:
+                    promote = None
+            elif self.distances_[promote] <= radius:
+                promote = None
+        self.cluster_center_frames_ = self._center_frames()
+        self.index_ = None
+        t1 = time.time()
+        print("K-Centers partial fit:", len(block), "new frames,", n_promoted, "new centers, Time Cost:", t1 - t0)
+        return self
+
+    def _add_center(self, index):
+        """Make global frame ``index`` a center and relabel the frames it claims."""
+        label = len(self.cluster_centers_)
+        block_index = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        center = self._blocks[block_index][[index - self._offsets[block_index]]]
+        if self.metric in PRUNE_FACTORS and label > 0:
+            center_distances = np.array([_distances_to(frame, center, self.metric)[0]
+                                         for frame in self._center_blocks])
+            factor = PRUNE_FACTORS[self.metric] * _PRUNE_SLACK
+            candidates = np.where(center_distances[self.labels_] <= factor * self.distances_)[0]
+        else:
+            candidates = np.arange(len(self.distances_))
+        for block, start, stop in zip(self._blocks, self._offsets[:-1], self._offsets[1:]):
+            frames = candidates[(candidates >= start) & (candidates < stop)]
+            if len(frames) == 0:
+                continue
+            if isinstance(block, _StreamedFrames):
+                new_distances = block.distances(center, frames - start)
+            else:
+                new_distances = _distances_to(block, center, self.metric, frames=frames - start)
+            updated = new_distances < self.distances_[frames]
+            self.distances_[frames[updated]] = new_distances[updated]
+            self.labels_[frames[updated]] = label
+        self.cluster_centers_.append(int(index))
+        self._center_blocks.append(center)
 
+    def _center_frames(self):
+        if self.metric == 'rmsd':
+            return md.join([center.to_trajectory(topology=center.topology) for center in self._center_blocks],
+                           check_topology=False)
+        return np.concatenate(self._center_blocks)
 
+    def __getstate__(self):
+        # a copy: on Python 3.11+ the base class returns the instance __dict__ itself
+        state = dict(super(KCenters, self).__getstate__())
+        # a reference to the data fit clustered, not part of the model
+        state.pop('_fit_X', None)
+        if isinstance(state.get('index_'), faiss.Index):
+            # tagged, so it is not mistaken for the plain centers array
+            state['index_'] = ('faiss', faiss.serialize_index(state['index_']))
+        return state
 
+    def __setstate__(self, state):
+        index = state.get('index_')
+        if isinstance(index, tuple) and len(index) == 2 and index[0] == 'faiss':
+            state['index_'] = faiss.deserialize_index(index[1])
+        super(KCenters, self).__setstate__(state)
@@ -0,0 +1,253 @@
+__author__ = 'stephen'
+#===============================================================================
+# GLOBAL IMPORTS:
+import time
+import numpy as np
+from sklearn.base import BaseEstimator, ClusterMixin
+from sklearn.utils import check_random_state
+from concurrent.futures import ThreadPoolExecutor
+#===============================================================================
+# LOCAL IMPORTS:
+from .kcenters_ import pruned_k_centers, k_centers, k_centers_assign, PRUNE_FACTORS, _PRUNE_SLACK, _frame_distances
+from ..metrics.rmsd_ import as_rmsd_dataset
+#===============================================================================
+
+def _trial_frames(X, medoids, labels_, distances_, cluster, trial, metric):
+    """Frames whose assignment can change if ``trial`` replaces medoid
+    ``cluster``, and the distances from the trial medoid to them.
+    These are the members of ``cluster`` and, for the metrics of
+    ``PRUNE_FACTORS``, the frames x of another medoid m with
+    d(trial, m) < 2 d(x, m): otherwise d(trial, x) >= d(trial, m) - d(x, m)
+    >= d(x, m) and x stays. Without the triangle inequality every frame
+    is evaluated.
+    Returns
+    -------
+    frames : array, sorted frame indices
+    trial_distances : array, distances from ``trial`` to ``frames``
+    """
+    if metric not in PRUNE_FACTORS:
+        trial_distances = _frame_distances(X, trial, metric)
+        return np.arange(len(labels_)), trial_distances
+    medoid_distances = _frame_distances(X, trial, metric, frames=medoids)
+    factor = PRUNE_FACTORS[metric] * _PRUNE_SLACK
+    frames = np.where((labels_ == cluster) | (medoid_distances[labels_] <= factor * distances_))[0]
+    return frames, _frame_distances(X, trial, metric, frames=frames)
+
+def _swap(X, medoids, labels_, distances_, cluster, trial, frames, trial_distances, metric):
+    """Evaluate replacing medoid ``cluster`` by frame ``trial``.
+    ``frames`` (sorted) must hold every frame that can change, see
+    ``_trial_frames``, and ``trial_distances`` their distances to the trial
+    medoid. Frames of other clusters can only move to the trial medoid,
+    and frames of ``cluster`` that are at least as close to the trial
+    medoid as to the old one stay. Only the remaining members of
+    ``cluster`` are compared against every medoid again.
+    Returns
+    -------
+    changed : array of frame indices whose label or distance changes
+    new_labels, new_distances : arrays, values for ``changed``
+    """
+    closer = trial_distances < distances_[frames]
+    members = labels_[frames] == cluster
+    ambiguous = frames[members & ~closer]
+    kept = closer | members
+    moved = frames[kept]
+    new_labels = np.full(len(moved), cluster, dtype=labels_.dtype)
+    new_distances = trial_distances[kept].astype(distances_.dtype)
+    if len(ambiguous):
+        new_medoids = medoids.copy()
+        new_medoids[cluster] = trial
+        best = np.full(len(ambiguous), np.inf)
+        best_label = np.zeros(len(ambiguous), dtype=labels_.dtype)
+        for j, medoid in enumerate(new_medoids):
+            d = _frame_distances(X, medoid, metric, frames=ambiguous)
+            updated = d < best
+            best[updated] = d[updated]
+            best_label[updated] = j
+        position = np.searchsorted(moved, ambiguous)
+        new_labels[position] = best_label
+        new_distances[position] = best
+    return moved, new_labels, new_distances
+
+def hybrid_k_medoids(X, medoids, labels_, distances_, metric='rmsd', n_sweeps=5, random_state=None,
+                     n_jobs=1, return_n_skipped=False):
+    """Refine a k-centers partition by randomized medoid swaps.
+    Every sweep proposes, for each cluster, a random member as its new
+    medoid. The distances from the trial medoid to the frames that can
+    change (see ``_trial_frames``: the members of the cluster and, where
+    the triangle inequality holds, the frames of nearby clusters) are
+    computed in a thread pool, ``n_jobs`` proposals at a time; the swaps
+    are then evaluated one after another against the current assignment
+    and accepted if they lower the total distance of the frames to their
+    medoids. Only the frames whose assignment changes are touched, and the
+    per-cluster costs are updated from them alone.
+    Parameters
+    ----------
+    X : array, [n_samples, n_features] or RMSDDataset
+    medoids : array, [n_clusters,]
+        Frame indices of the initial medoids, e.g. the k-centers.
+    labels_ : array, [n_samples,]
+        Index into ``medoids`` of the nearest medoid of each frame.
+    distances_ : array, [n_samples,]
+        Distance of each frame to its medoid.
+    metric : string, optional, default: "rmsd"
+    n_sweeps : int, optional, default: 5
+    random_state : integer or numpy.RandomState, optional
+        Generator of the trial medoids.
+    n_jobs : int, optional, default: 1
+        Number of trial medoids whose distances are computed in parallel.
+    return_n_skipped : bool, optional, default: False
+        Also return the number of trial-to-frame distance evaluations that
+        the triangle inequality skipped.
+    Returns
+    -------
+    medoids : array, [n_clusters,]
+    labels_ : array, [n_samples,]
+    distances_ : array, [n_samples,]
+    cluster_costs : array, [n_clusters,]
+        Sum of the distances of the members of each cluster to its medoid.
+    n_skipped : int, only if ``return_n_skipped``
+        The n_clusters trial-to-medoid distances the pruning needs are not
+        subtracted.
+    """
+    random_state = check_random_state(random_state)
+    medoids = np.array(medoids, dtype=np.intp)
+    labels_ = np.array(labels_, dtype=np.int32)
+    distances_ = np.array(distances_)
+    n_clusters = len(medoids)
+    n_jobs = max(1, n_jobs or 1)
+    n_samples = len(labels_)
+    n_skipped = 0
+    cluster_costs = np.bincount(labels_, weights=distances_, minlength=n_clusters)
+    print("Initial cost:", cluster_costs.sum())
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for sweep in range(n_sweeps):
+            n_accepted = 0
+            # most expensive clusters first
+            order = np.argsort(-cluster_costs)
+            for batch_start in range(0, n_clusters, n_jobs):
+                proposals = []
+                for cluster in order[batch_start:batch_start + n_jobs]:
+                    members = np.where(labels_ == cluster)[0]
+                    if len(members) < 2:
+                        continue
+                    trial = random_state.choice(members)
+                    if trial != medoids[cluster]:
+                        proposals.append((cluster, trial))
+                # all read the assignment as it is before this batch
+                trials = list(pool.map(lambda proposal: _trial_frames(X, medoids, labels_, distances_, proposal[0],
+                                                                      proposal[1], metric), proposals))
+                # frames changed by the swaps accepted in this batch; the
+                # bounds of all other frames still hold
+                changed = []
+                for (cluster, trial), (frames, trial_distance) in zip(proposals, trials):
+                    if changed:
+                        stale = np.setdiff1d(np.concatenate(changed), frames)
+                        if len(stale):
+                            frames = np.concatenate((frames, stale))
+                            trial_distance = np.concatenate((trial_distance,
+                                                             _frame_distances(X, trial, metric, frames=stale)))
+                            by_frame = np.argsort(frames)
+                            frames, trial_distance = frames[by_frame], trial_distance[by_frame]
+                    n_skipped += n_samples - len(frames)
+                    moved, new_labels, new_distances = _swap(X, medoids, labels_, distances_, cluster, trial,
+                                                             frames, trial_distance, metric)
+                    old_cost = distances_[moved].sum()
+                    if new_distances.sum() < old_cost:
+                        cluster_costs -= np.bincount(labels_[moved], weights=distances_[moved],
+                                                     minlength=n_clusters)
+                        cluster_costs += np.bincount(new_labels, weights=new_distances, minlength=n_clusters)
+                        medoids[cluster] = trial
+                        labels_[moved] = new_labels
+                        distances_[moved] = new_distances
+                        n_accepted += 1
+                        changed.append(moved)
+            print("Sweep", sweep, "accepted swaps:", n_accepted, "cost:", cluster_costs.sum())
+    if return_n_skipped:
+        return medoids, labels_, distances_, cluster_costs, n_skipped
+    return medoids, labels_, distances_, cluster_costs
+
+class HybridKMedoids(BaseEstimator, ClusterMixin):
+    """Hybrid K-Centers / K-Medoids clustering
+    Seed the medoids with ``k_centers`` (triangle-pruned where the metric
+    allows it), then refine them with ``hybrid_k_medoids``: random medoid
+    swaps that are accepted when they lower the total distance of the
+    frames to their medoids. A trial medoid is only compared with the
+    members of its cluster and the frames of clusters close enough for
+    the triangle inequality to allow a change (every frame for other
+    metrics), plus a full reassignment of only the members of a cluster
+    that moved away from the new medoid.
+    Parameters
+    ----------
+    n_clusters : int, optional, default: 8
+        The number of clusters to form.
+    metric : {"euclidean", "sqeuclidean", "cityblock", "chebyshev", "rmsd", ...}
+        The distance metric to use. metric = "rmsd" requires md.Trajectory
+        input; other distance metrics require ``np.ndarray``s.
+    random_state : integer, optional, default: 0
+        Index of the first k-centers seed, or -1 for a random frame. Also
+        seeds the swap proposals.
+    n_sweeps : int, optional, default: 5
+        Number of refinement sweeps over all clusters.
+    n_jobs : int, optional, default: 1
+        Number of trial medoids evaluated in parallel.
+    References
+    ----------
+    .. [1] Beauchamp, Kyle A., et al. "MSMBuilder2: modeling conformational
+       dynamics on the picosecond to millisecond scale." J. Chem. Theory.
+       Comput. 7.10 (2011): 3412-3419.
+    Attributes
+    ----------
+    cluster_centers_ : array, [n_clusters,]
+        Frame indices of the medoids.
+    cluster_center_frames_ : array, [n_clusters, n_features] or md.Trajectory
+        Coordinates of the medoids.
+    labels_ : array, [n_samples,]
+        The label of each point is an integer in [0, n_clusters).
+    distances_ : array, [n_samples,]
+        Distance of each point to its medoid.
+    cluster_costs_ : array, [n_clusters,]
+        Sum of the distances of the members of each cluster to its medoid.
+    inertia_ : float
+        Sum of the distances of all points to their medoids.
+    n_skipped_ : int
+        Number of trial-to-frame distance evaluations skipped by the
+        triangle inequality during the refinement.
+    """
+    def __init__(self, n_clusters=8, metric='rmsd', random_state=0, n_sweeps=5, n_jobs=1):
+        self.n_clusters = n_clusters
+        self.metric = metric
+        self.random_state = random_state
+        self.n_sweeps = n_sweeps
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y=None):
+        """Perform clustering.
+        Parameters
+        -----------
+        X : array-like, shape=[n_samples, n_features] or md.Trajectory
+            Samples to cluster.
+        """
+        t0 = time.time()
+        data = as_rmsd_dataset(X) if self.metric == 'rmsd' else np.asarray(X)
+        n_samples = len(data)
+        if self.random_state == -1:
+            seed = check_random_state(None).randint(0, n_samples)
+        else:
+            seed = self.random_state
+        if self.metric in PRUNE_FACTORS:
+            medoids, labels, distances, _ = pruned_k_centers(data, seed, n_clusters=self.n_clusters,
+                                                             metric=self.metric)
+        else:
+            medoids, _ = k_centers(data, n_clusters=self.n_clusters, metric=self.metric, random_state=seed)
+            labels, distances = k_centers_assign(data, centers=data[medoids], metric=self.metric,
+                                                 return_distance=True)
+        rng = check_random_state(None if self.random_state == -1 else self.random_state)
+        self.cluster_centers_, self.labels_, self.distances_, self.cluster_costs_, self.n_skipped_ = \
+            hybrid_k_medoids(data, medoids, labels, distances, metric=self.metric, n_sweeps=self.n_sweeps,
+                             random_state=rng, n_jobs=self.n_jobs, return_n_skipped=True)
+        self.inertia_ = float(self.cluster_costs_.sum())
+        self.cluster_center_frames_ = X[self.cluster_centers_]
+        t1 = time.time()
+        print("Hybrid K-Medoids clustering Time Cost:", t1 - t0)
+        return self
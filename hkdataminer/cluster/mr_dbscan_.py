@@ -17,52 +17,50 @@ from sklearn.utils import check_array, check_consistent_length
 #from sklearn.utils.fixes import astype
 from sklearn.neighbors import NearestNeighbors
 
-from sklearn.cluster._dbscan_inner import dbscan_inner
 
 # Local imports
-#import knn as knnn # imports the shared library knn.so
+from ..metrics.vptree_ import VPTree
+from ..metrics.pairwise import radius_neighbors, requires_native
+from ..metrics.knn_graph_ import KNNGraph
+from .dbscan_ import chunked_dbscan
+from .dbscan_inner_ import dbscan_csr, neighborhoods_to_csr, csr_neighbor_counts
+from .dbscan_sweep_ import radius_graph
 
 outliers = -1
 
 
-def merge_assignments(new_assignments, old_assignments):
+def merge_assignments(new_assignments, old_assignments, coverage=0.7):
+    """Refine old_assignments (in place) with the finer new_assignments.
+
+    A cluster of old_assignments keeps its label if at least coverage of
+    its points are clustered in new_assignments; otherwise its points
+    that are clustered there take their new label, shifted past the old
+    labels, and the others keep the old one.
+    """
+    old_assignments = np.asarray(old_assignments)
+    new_assignments = np.asarray(new_assignments)
     # Number of clusters in assignments, ignoring noise if present.
-    # clusters_size = len(set(old_assignments)) - (1 if -1 in old_assignments else 0)
-    clusters_size = np.max(old_assignments) + 1
+    clusters_size = np.max(old_assignments) + 1 if len(old_assignments) else 0
     max_clust_id = clusters_size
-    print "max_clust_id:", max_clust_id
-    count_first = [0] * clusters_size
-    count_second = [0] * clusters_size
-
-    old_assignments_size = len(old_assignments)
-    # new_assignments_size = len(new_assignments)
-    for i in xrange(0, old_assignments_size):
-        if old_assignments[i] != outliers:
-            if new_assignments[i] != outliers:
-                count_first[old_assignments[i]] += 1
-            count_second[old_assignments[i]] += 1
+    print("max_clust_id:", max_clust_id)
 
+    clustered = old_assignments != outliers
+    kept = clustered & (new_assignments != outliers)
+    count_first = np.bincount(old_assignments[kept], minlength=clusters_size)
+    count_second = np.bincount(old_assignments[clustered], minlength=clusters_size)
     # Percentage
-    percentage = [0.0] * clusters_size
-    for i in xrange(0, clusters_size):
-        if count_second[i] is 0:
-            percentage[i] = 0.0
-        else:
-            percentage[i] = float(count_first[i])/float(count_second[i])
-
-    # Starting assignment
-    for i in xrange(0, old_assignments_size):
-        if old_assignments[i] != outliers and percentage[old_assignments[i]] < 0.7:
-            if new_assignments[i] != outliers:
-                old_assignments[i] = new_assignments[i] + max_clust_id
-                # print old_assignments[i]
-            # else:
-            #    old_assignments[i] = outliers
+    percentage = np.zeros(clusters_size)
+    np.divide(count_first, count_second, out=percentage, where=count_second > 0)
+
+    refined = kept
+    refined[kept] = percentage[old_assignments[kept]] < coverage
+    old_assignments[refined] = new_assignments[refined] + max_clust_id
     return old_assignments
 
 
 def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
-           algorithm='auto', leaf_size=30, p=2, sample_weight=None, n_jobs=1):
+           algorithm='auto', leaf_size=30, p=2, sample_weight=None, n_jobs=1, working_memory=None,
+           core_only=False):
     """Perform DBSCAN clustering from vector array or distance matrix.
     Read more in the :ref:`User Guide <dbscan>`.
     Parameters
@@ -70,7 +68,7 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
             array of shape (n_samples, n_samples)
         A feature array, or array of distances between samples if
-        ``metric='precomputed'``.
+        ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
     eps : float, optional
         The maximum distance between two samples for them to be considered
         as in the same neighborhood.
@@ -81,17 +79,18 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by :func:`sklearn.metrics.pairwise_distances` for
-        its metric parameter.
+        its metric parameter, or "rmsd" with an md.Trajectory as X.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square. X may be a sparse matrix, in which case only "nonzero"
         elements may be considered neighbors for DBSCAN.
     metric_params : dict, optional
         Additional keyword arguments for the metric function.
         .. versionadded:: 0.19
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
-        See NearestNeighbors module documentation for details.
+        See NearestNeighbors module documentation for details. 'vp_tree'
+        (always used for metric="rmsd") selects the built-in VPTree.
     leaf_size : int, optional (default = 30)
         Leaf size passed to BallTree or cKDTree. This can affect the speed
         of the construction and query, as well as the memory required
@@ -108,6 +107,12 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     n_jobs : int, optional (default = 1)
         The number of parallel jobs to run for neighbors search.
         If ``-1``, then the number of jobs is set to the number of CPU cores.
+    working_memory : int or None, optional (default=None)
+        Search the neighborhoods block by block within this budget (MiB)
+        into CSR arrays, see :func:`hkdataminer.cluster.dbscan`.
+    core_only : bool, optional (default=False)
+        Count the neighbors first and store the neighborhoods of the core
+        samples only, see :func:`hkdataminer.cluster.dbscan`.
     Returns
     -------
     core_samples : array [n_core_samples]
@@ -135,7 +140,8 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     if not eps > 0.0:
         raise ValueError("eps must be positive.")
 
-    X = check_array(X, accept_sparse='csr')
+    if metric != 'rmsd' and not isinstance(X, KNNGraph):
+        X = check_array(X, accept_sparse='csr')
     if sample_weight is not None:
         sample_weight = np.asarray(sample_weight)
         check_consistent_length(X, sample_weight)
@@ -143,7 +149,11 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
     # Calculate neighborhood for all samples. This leaves the original point
     # in, which needs to be considered later (i.e. point i is in the
     # neighborhood of point i. While True, its useless information)
-    if metric == 'precomputed' and sparse.issparse(X):
+    if isinstance(X, KNNGraph):
+        # neighbors computed once, e.g. by KNNGraph.build; X's metric applies
+        indptr, indices = X.radius_csr(eps)
+        return dbscan_csr(indptr, indices, min_samples, sample_weight)
+    elif metric == 'precomputed' and sparse.issparse(X):
         neighborhoods = np.empty(X.shape[0], dtype=object)
         X.sum_duplicates()  # XXX: modifies X's internals in-place
         X_mask = X.data <= eps
@@ -157,6 +167,17 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         masked_indptr = masked_indptr[:-1] + np.arange(1, X.shape[0])
         # split into rows
         neighborhoods[:] = np.split(masked_indices, masked_indptr)
+    elif working_memory is not None or core_only:
+        return chunked_dbscan(X, eps, min_samples, metric=metric, metric_params=metric_params,
+                              algorithm=algorithm, leaf_size=leaf_size, p=p, sample_weight=sample_weight,
+                              n_jobs=n_jobs, working_memory=working_memory, core_only=core_only)
+    elif metric == 'rmsd' or algorithm == 'vp_tree':
+        # exact radius search with the built-in vantage-point tree
+        tree = VPTree(X, metric=metric, leaf_size=leaf_size, n_jobs=n_jobs, metric_params=metric_params, p=p)
+        neighborhoods = tree.query_radius(X, eps)
+    elif requires_native(metric):
+        # metrics sklearn's neighbor searches do not know, e.g. "periodic"
+        neighborhoods = radius_neighbors(X, eps, metric=metric, n_jobs=n_jobs, **(metric_params or {}))
     else:
         neighbors_model = NearestNeighbors(radius=eps, algorithm=algorithm,
                                            leaf_size=leaf_size,
@@ -168,178 +189,9 @@ def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
         neighborhoods = neighbors_model.radius_neighbors(X, eps,
                                                          return_distance=False)
 
-    if sample_weight is None:
-        n_neighbors = np.array([len(neighbors)
-                                for neighbors in neighborhoods])
-    else:
-        n_neighbors = np.array([np.sum(sample_weight[neighbors])
-                                for neighbors in neighborhoods])
-
-    # Initially, all samples are noise.
-    labels = -np.ones(X.shape[0], dtype=np.intp)
-
-    # A list of all core samples found.
-    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
-    dbscan_inner(core_samples, neighborhoods, labels)
-    return np.where(core_samples)[0], labels
-
-'''
-
-def dbscan(X, eps=0.5, min_samples=5, metric='minkowski', metric_params=None,
-           algorithm='auto', leaf_size=30, p=2, sample_weight=None, n_jobs=1):
-    """Perform DBSCAN clustering from vector array or distance matrix.
-
-    Read more in the :ref:`User Guide <dbscan>`.
-
-    Parameters
-    ----------
-    X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
-            array of shape (n_samples, n_samples)
-        A feature array, or array of distances between samples if
-        ``metric='precomputed'``.
-
-    eps : float, optional
-        The maximum distance between two samples for them to be considered
-        as in the same neighborhood.
-
-    min_samples : int, optional
-        The number of samples (or total weight) in a neighborhood for a point
-        to be considered as a core point. This includes the point itself.
-
-    metric : string, or callable
-        The metric to use when calculating distance between instances in a
-        feature array. If metric is a string or callable, it must be one of
-        the options allowed by metrics.pairwise.pairwise_distances for its
-        metric parameter.
-        If metric is "precomputed", X is assumed to be a distance matrix and
-        must be square. X may be a sparse matrix, in which case only "nonzero"
-        elements may be considered neighbors for DBSCAN.
-
-    metric_params : dict, optional
-        Additional keyword arguments for the metric function.
-
-        .. versionadded:: 0.19
-
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
-        The algorithm to be used by the NearestNeighbors module
-        to compute pointwise distances and find nearest neighbors.
-        See NearestNeighbors module documentation for details.
-
-    leaf_size : int, optional (default = 30)
-        Leaf size passed to BallTree or cKDTree. This can affect the speed
-        of the construction and query, as well as the memory required
-        to store the tree. The optimal value depends
-        on the nature of the problem.
-
-    p : float, optional
-        The power of the Minkowski metric to be used to calculate distance
-        between points.
-
-    sample_weight : array, shape (n_samples,), optional
-        Weight of each sample, such that a sample with a weight of at least
-        ``min_samples`` is by itself a core sample; a sample with negative
-        weight may inhibit its eps-neighbor from being core.
-        Note that weights are absolute, and default to 1.
-
-    n_jobs : int, optional (default = 1)
-        The number of parallel jobs to run for neighbors search.
-        If ``-1``, then the number of jobs is set to the number of CPU cores.
-
-    Returns
-    -------
-    core_samples : array [n_core_samples]
-        Indices of core samples.
-
-    labels : array [n_samples]
-        Cluster labels for each point.  Noisy samples are given the label -1.
-
-    Notes
-    -----
-    See examples/cluster/plot_dbscan.py for an example.
-
-    This implementation bulk-computes all neighborhood queries, which increases
-    the memory complexity to O(n.d) where d is the average number of neighbors,
-    while original DBSCAN had memory complexity O(n).
-
-    Sparse neighborhoods can be precomputed using
-    :func:`NearestNeighbors.radius_neighbors_graph
-    <sklearn.neighbors.NearestNeighbors.radius_neighbors_graph>`
-    with ``mode='distance'``.
-
-    References
-    ----------
-    Ester, M., H. P. Kriegel, J. Sander, and X. Xu, "A Density-Based
-    Algorithm for Discovering Clusters in Large Spatial Databases with Noise".
-    In: Proceedings of the 2nd International Conference on Knowledge Discovery
-    and Data Mining, Portland, OR, AAAI Press, pp. 226-231. 1996
-    """
-    if not eps > 0.0:
-        raise ValueError("eps must be positive.")
-
-    X = check_array(X, accept_sparse='csr')
-    if sample_weight is not None:
-        sample_weight = np.asarray(sample_weight)
-        check_consistent_length(X, sample_weight)
-
-    # Calculate neighborhood for all samples. This leaves the original point
-    # in, which needs to be considered later (i.e. point i is in the
-    # neighborhood of point i. While True, its useless information)
-    if metric == 'precomputed' and sparse.issparse(X):
-        neighborhoods = np.empty(X.shape[0], dtype=object)
-        X.sum_duplicates()  # XXX: modifies X's internals in-place
-        X_mask = X.data <= eps
-        masked_indices = astype(X.indices, np.intp, copy=False)[X_mask]
-        masked_indptr = np.concatenate(([0], np.cumsum(X_mask)))[X.indptr[1:]]
-
-        # insert the diagonal: a point is its own neighbor, but 0 distance
-        # means absence from sparse matrix data
-        masked_indices = np.insert(masked_indices, masked_indptr,
-                                   np.arange(X.shape[0]))
-        masked_indptr = masked_indptr[:-1] + np.arange(1, X.shape[0])
-        # split into rows
-        neighborhoods[:] = np.split(masked_indices, masked_indptr)
-    elif algorithm != 'vp_tree':
-        neighbors_model = NearestNeighbors(radius=eps, algorithm=algorithm,
-                                           leaf_size=leaf_size,
-                                           metric=metric,
-                                           metric_params=metric_params, p=p,
-                                           n_jobs=n_jobs)
-        neighbors_model.fit(X)
-        # This has worst case O(n^2) memory complexity
-        neighborhoods = neighbors_model.radius_neighbors(X, eps,
-                                                         return_distance=False)
-    #else:
-        # Creates a parallel CPU VP-Tree based search
-
-        #print "Calculating knn..."
-        #t0 = time.time()
-        if metric is 'rmsd':
-            shape_x = np.shape(X.xyz)
-            knn = knnn.vp_tree_parallel(np.reshape(X.xyz, (shape_x[0] * shape_x[1] * shape_x[2])), shape_x[1] * 3,
-                                        "rmsd_serial")
-            # This has worst case O(n^2) memory complexity
-            queries = np.linspace(0, len(X.xyz) - 1, len(X.xyz), dtype='int')
-            distances, neighborhoods = knn.query_radius(queries, eps)
-
-    if sample_weight is None:
-        n_neighbors = np.array([len(neighbors)
-                                for neighbors in neighborhoods])
-    else:
-        n_neighbors = np.array([np.sum(sample_weight[neighbors])
-                                for neighbors in neighborhoods])
-
-    # Initially, all samples are noise.
-    if metric is "rmsd:":
-        labels = -np.ones(X.xyz.shape[0], dtype=np.intp)
-    else:
-        labels = -np.ones(X.shape[0], dtype=np.intp)
-    #labels = -np.ones(X.shape[0], dtype=np.intp)
+    indptr, indices = neighborhoods_to_csr(neighborhoods)
+    return dbscan_csr(indptr, indices, min_samples, sample_weight)
 
-    # A list of all core samples found.
-    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
-    dbscan_inner(core_samples, neighborhoods, labels)
-    return np.where(core_samples)[0], labels
-'''
 
 class MR_DBSCAN(BaseEstimator, ClusterMixin):
     """Perform DBSCAN clustering from vector array or distance matrix.
@@ -364,7 +216,7 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
         The metric to use when calculating distance between instances in a
         feature array. If metric is a string or callable, it must be one of
         the options allowed by metrics.pairwise.calculate_distance for its
-        metric parameter.
+        metric parameter, or "rmsd" with an md.Trajectory as X.
         If metric is "precomputed", X is assumed to be a distance matrix and
         must be square. X may be a sparse matrix, in which case only "nonzero"
         elements may be considered neighbors for DBSCAN.
@@ -377,10 +229,11 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
 
         .. versionadded:: 0.19
 
-    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute'}, optional
+    algorithm : {'auto', 'ball_tree', 'kd_tree', 'brute', 'vp_tree'}, optional
         The algorithm to be used by the NearestNeighbors module
         to compute pointwise distances and find nearest neighbors.
-        See NearestNeighbors module documentation for details.
+        See NearestNeighbors module documentation for details. 'vp_tree'
+        (always used for metric="rmsd") selects the built-in VPTree.
 
     leaf_size : int, optional (default = 30)
         Leaf size passed to BallTree or cKDTree. This can affect the speed
@@ -396,17 +249,41 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
         The number of parallel jobs to run.
         If ``-1``, then the number of jobs is set to the number of CPU cores.
 
+    working_memory : int or None, optional (default=None)
+        Memory budget (MiB) of a chunked neighborhood search, None
+        searches all samples at once.
+
+    core_only : bool, optional (default=False)
+        Count the neighbors first and store the neighborhoods of the core
+        samples only. Single-level runs only.
+
+    eps_levels : sequence of float, optional
+        Finer resolutions, decreasing and below eps. The neighbor graph is
+        computed once at eps, with distances, and every level thresholds
+        it; the clusters of the previous level in which less than coverage
+        of the points are still clustered at the finer eps are refined
+        with the finer clusters (see ``merge_assignments``). Only those
+        clusters are clustered again at the finer eps.
+
+    coverage : float, optional (default = 0.7)
+        Fraction of a cluster's points that must stay clustered at the next
+        level for the cluster to be kept as it is.
+
     Attributes
     ----------
     core_sample_indices_ : array, shape = [n_core_samples]
         Indices of core samples.
 
     components_ : array, shape = [n_core_samples, n_features]
-        Copy of each core sample found by training.
+        Copy of each core sample found by training, None if fit on a
+        ``KNNGraph``.
 
     labels_ : array, shape = [n_samples]
-        Cluster labels for each point in the dataset given to fit().
-        Noisy samples are given the label -1.
+        Cluster labels for each point in the dataset given to fit(), those
+        of the finest level. Noisy samples are given the label -1.
+
+    hierarchy_ : array, shape = [n_levels, n_samples], int32
+        Labels after each level, the coarsest first.
 
     Notes
     -----
@@ -421,6 +298,9 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
     <sklearn.neighbors.NearestNeighbors.radius_neighbors_graph>`
     with ``mode='distance'``.
 
+    With eps_levels, core_sample_indices_ and components_ are those of the
+    coarsest level.
+
     References
     ----------
     Ester, M., H. P. Kriegel, J. Sander, and X. Xu, "A Density-Based
@@ -431,7 +311,7 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
 
     def __init__(self, eps=0.5, min_samples=5, metric='euclidean',
                  metric_params=None, algorithm='auto', leaf_size=30, p=None,
-                 n_jobs=1):
+                 n_jobs=1, working_memory=None, core_only=False, eps_levels=None, coverage=0.7):
         self.eps = eps
         self.min_samples = min_samples
         self.metric = metric
@@ -440,6 +320,10 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
         self.leaf_size = leaf_size
         self.p = p
         self.n_jobs = n_jobs
+        self.working_memory = working_memory
+        self.core_only = core_only
+        self.eps_levels = eps_levels
+        self.coverage = coverage
 
     def fit(self, X, y=None, sample_weight=None):
         """Perform DBSCAN clustering from features or distance matrix.
@@ -449,18 +333,31 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
         X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
                 array of shape (n_samples, n_samples)
             A feature array, or array of distances between samples if
-            ``metric='precomputed'``.
+            ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
         sample_weight : array, shape (n_samples,), optional
             Weight of each sample, such that a sample with a weight of at least
             ``min_samples`` is by itself a core sample; a sample with negative
             weight may inhibit its eps-neighbor from being core.
             Note that weights are absolute, and default to 1.
         """
-        X = check_array(X, accept_sparse='csr')
-        clust = dbscan(X, sample_weight=sample_weight,
-                       **self.get_params())
-        self.core_sample_indices_, self.labels_ = clust
-
+        if self.metric != 'rmsd' and not isinstance(X, KNNGraph):
+            X = check_array(X, accept_sparse='csr')
+        if self.eps_levels is None:
+            clust = dbscan(X, eps=self.eps, min_samples=self.min_samples, metric=self.metric,
+                           metric_params=self.metric_params, algorithm=self.algorithm, leaf_size=self.leaf_size,
+                           p=self.p, sample_weight=sample_weight, n_jobs=self.n_jobs,
+                           working_memory=self.working_memory, core_only=self.core_only)
+            self.core_sample_indices_, self.labels_ = clust
+            self.hierarchy_ = self.labels_[np.newaxis].astype(np.int32)
+        else:
+            self._fit_levels(X, sample_weight)
+        if isinstance(X, KNNGraph):
+            # the graph does not hold the samples themselves
+            self.components_ = None
+            return self
+        if self.metric == 'rmsd':
+            self.components_ = X[self.core_sample_indices_]
+            return self
 
         if len(self.core_sample_indices_):
             # fix for scipy sparse indexing issue
@@ -470,6 +367,73 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
             self.components_ = np.empty((0, X.shape[1]))
         return self
 
+    def _fit_levels(self, X, sample_weight=None):
+        levels = np.concatenate(([self.eps], np.asarray(self.eps_levels, dtype=float)))
+        if not np.all(np.diff(levels) < 0):
+            raise ValueError("eps_levels must decrease from eps, got %s" % (levels,))
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight)
+        # neighbors and distances queried once, at the coarsest eps
+        if isinstance(X, KNNGraph):
+            graph = X
+        else:
+            graph = radius_graph(X, self.eps, metric=self.metric, metric_params=self.metric_params,
+                                 algorithm=self.algorithm, leaf_size=self.leaf_size, p=self.p, n_jobs=self.n_jobs)
+        self.hierarchy_ = np.empty((len(levels), graph.n_points), dtype=np.int32)
+        for level, eps in enumerate(levels):
+            if level == 0:
+                indptr, indices = graph.radius_csr(eps)
+                self.core_sample_indices_, self.labels_ = dbscan_csr(indptr, indices, self.min_samples,
+                                                                     sample_weight)
+            else:
+                self.labels_ = self._refine_level(graph, eps, self.labels_, sample_weight)
+            self.hierarchy_[level] = self.labels_
+
+    def _refine_level(self, graph, eps, labels, sample_weight=None):
+        """Refine labels (in place) with the clusters at the finer eps.
+
+        Same rule as ``merge_assignments``, without clustering the whole
+        graph at eps. A core sample at eps is a core sample at any larger
+        eps, so only clustered points can be clustered at eps, and the
+        core samples of a finer cluster all lie in one cluster of labels.
+        The coverage of each cluster is computed first, from the points'
+        neighborhoods at eps; DBSCAN then runs on the sub-graph of the
+        members of the under-covered clusters only. A border point whose
+        only core neighbors at eps lie outside that sub-graph keeps its
+        label.
+        """
+        clusters_size = np.max(labels) + 1 if len(labels) else 0
+        max_clust_id = clusters_size
+        print("max_clust_id:", max_clust_id)
+        clustered = np.flatnonzero(labels != outliers)
+        indptr, indices = graph.radius_csr(eps, rows=clustered)
+        n_neighbors = csr_neighbor_counts(indptr, indices, sample_weight)
+        is_core = n_neighbors >= self.min_samples
+        # clustered at eps: core samples and neighbors of one
+        core_hits = np.concatenate(([0], np.cumsum(is_core[indices])))
+        covered = is_core | (core_hits[indptr[1:]] > core_hits[indptr[:-1]])
+        count_first = np.bincount(labels[clustered[covered[clustered]]], minlength=clusters_size)
+        count_second = np.bincount(labels[clustered], minlength=clusters_size)
+        percentage = np.zeros(clusters_size)
+        np.divide(count_first, count_second, out=percentage, where=count_second > 0)
+
+        members = clustered[percentage[labels[clustered]] < self.coverage]
+        if not len(members):
+            return labels
+        # sub-graph of the members, in their own numbering
+        local = np.full(graph.n_points, -1, dtype=np.intp)
+        local[members] = np.arange(len(members))
+        sub_indptr, sub_indices = graph.radius_csr(eps, rows=members)
+        sub_indices = local[sub_indices]
+        inside = sub_indices != -1
+        cumulative = np.concatenate(([0], np.cumsum(inside)))
+        rows = sub_indptr[np.concatenate((members, [graph.n_points]))]
+        _, sub_labels = dbscan_csr(cumulative[rows], sub_indices[inside], self.min_samples,
+                                   n_neighbors=n_neighbors[members])
+        refined = sub_labels != outliers
+        labels[members[refined]] = sub_labels[refined] + max_clust_id
+        return labels
+
     def fit_predict(self, X, y=None, sample_weight=None):
         """Performs clustering on X and returns cluster labels.
 
@@ -478,7 +442,7 @@ class MR_DBSCAN(BaseEstimator, ClusterMixin):
         X : array or sparse (CSR) matrix of shape (n_samples, n_features), or \
                 array of shape (n_samples, n_samples)
             A feature array, or array of distances between samples if
-            ``metric='precomputed'``.
+            ``metric='precomputed'``, or a ``KNNGraph`` of the samples.
         sample_weight : array, shape (n_samples,), optional
             Weight of each sample, such that a sample with a weight of at least
             ``min_samples`` is by itself a core sample; a sample with negative
@@ -0,0 +1,251 @@
+__author__ = 'stephen'
+#===============================================================================
+# GLOBAL IMPORTS:
+import time
+import numpy as np
+import mdtraj as md
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from sklearn.base import BaseEstimator, ClusterMixin
+from sklearn.utils import check_random_state
+#===============================================================================
+# LOCAL IMPORTS:
+from .kcenters_ import update_distances, distance_dtype, _as_block
+from ..metrics.rmsd_ import RMSDDataset
+#===============================================================================
+
+def _frame_coordinates(X, index):
+    if isinstance(X, (md.Trajectory, RMSDDataset)):
+        return np.array(X.xyz[index])
+    return np.array(X[index])
+
+def _center_from_coordinates(coordinates, metric):
+    if metric == 'rmsd':
+        return md.Trajectory(coordinates[np.newaxis], None)
+    return coordinates[np.newaxis]
+
+def shard_worker(conn, X, metric='rmsd'):
+    """Serve one shard of a sharded k-centers run over ``conn``.
+    The shard keeps its own min-distance and label arrays. Messages are
+    tuples whose first element is the command:
+    ``('info',)`` -> number of frames in the shard,
+    ``('frame', i)`` -> coordinates of local frame i,
+    ``('update', coordinates, label)`` -> apply a new center, reply with
+    (local max distance, local argmax),
+    ``('result',)`` -> (labels, distances) of the shard,
+    ``('close',)`` -> stop serving.
+    ``conn`` is any ``multiprocessing.connection.Connection``: one end of a
+    Pipe for local workers or a socket connection for remote ones.
+    """
+    n_samples = len(X)
+    X = _as_block(X, distance_dtype(X, metric), metric)
+    distances_ = np.full(n_samples, np.inf, dtype=distance_dtype(X, metric))
+    labels_ = np.zeros(n_samples, dtype=np.int32)
+    try:
+        while True:
+            message = conn.recv()
+            command = message[0]
+            if command == 'update' and n_samples == 0:
+                conn.send((-np.inf, 0))
+            elif command == 'update':
+                coordinates, label = message[1], message[2]
+                center = _center_from_coordinates(coordinates, metric)
+                local_max = update_distances(X, center, distances_, labels_, label, metric=metric,
+                                             n_chunks=min(n_samples, 4))
+                conn.send((float(distances_[local_max]), local_max))
+            elif command == 'frame':
+                conn.send(_frame_coordinates(X, message[1]))
+            elif command == 'info':
+                conn.send(n_samples)
+            elif command == 'result':
+                if metric == 'euclidean':
+                    conn.send((labels_, np.sqrt(distances_)))
+                else:
+                    conn.send((labels_, distances_))
+            elif command == 'close':
+                break
+            else:
+                raise ValueError("Unknown command %r" % (command,))
+    finally:
+        conn.close()
+
+def serve_shard(X, address, authkey, metric='rmsd'):
+    """Serve one shard of a sharded k-centers run on a socket.
+    Run this on every node that holds part of the data, then pass the
+    addresses to ``ShardedKCenters(workers=...)`` on the coordinator. Only
+    center coordinates and a couple of scalars per iteration cross the
+    network; the frames never leave the node.
+    Parameters
+    ----------
+    X : array, [n_samples, n_features] or md.Trajectory
+        The frames of this shard.
+    address : tuple (host, port)
+        Address to listen on, e.g. ('0.0.0.0', 6000).
+    authkey : bytes
+        Shared secret, must match the coordinator's.
+    metric : string, optional, default: "rmsd"
+    """
+    with Listener(address, authkey=authkey) as listener:
+        print("Serving k-centers shard of", len(X), "frames on", listener.address)
+        conn = listener.accept()
+        shard_worker(conn, X, metric=metric)
+
+def sharded_k_centers(connections, n_clusters=8, metric='rmsd', random_state=None):
+    """K-Centers clustering over frames partitioned across workers.
+    Each worker holds a contiguous shard of the data, updates its own
+    min-distance and label arrays and reports its local farthest frame.
+    The coordinator picks the global farthest frame (ties go to the lowest
+    global index, as in ``k_centers``), fetches its coordinates from the
+    owning shard and broadcasts them as the next center. Labels and centers
+    are identical to the serial ``k_centers`` with the same seed.
+    Parameters
+    ----------
+    connections : list of multiprocessing.connection.Connection
+        One connection per shard, in the order of the global frame indices.
+    n_clusters : int, optional, default: 8
+    metric : string, optional, default: "rmsd"
+    random_state : integer, optional
+        Global index of the first center, or -1 for a random frame.
+    Returns
+    -------
+    cluster_centers_ : list of int
+        Global indices of the centers.
+    labels_ : array, [n_samples,]
+    distances_ : array, [n_samples,]
+    center_coordinates : array, [n_clusters, ...]
+    """
+    for conn in connections:
+        conn.send(('info',))
+    sizes = [conn.recv() for conn in connections]
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    n_samples = int(offsets[-1])
+    if random_state == -1:
+        seed = check_random_state(None).randint(0, n_samples)
+    else:
+        seed = random_state
+    print("seed=", seed)
+
+    def fetch(index):
+        shard = int(np.searchsorted(offsets, index, side='right')) - 1
+        connections[shard].send(('frame', int(index - offsets[shard])))
+        return connections[shard].recv()
+
+    cluster_centers_ = [seed]
+    center_coordinates = [fetch(seed)]
+    for i in range(n_clusters):
+        for conn in connections:
+            conn.send(('update', center_coordinates[-1], i))
+        replies = [conn.recv() for conn in connections]
+        max_distance = -np.inf
+        for shard, (local_max_distance, local_max) in enumerate(replies):
+            if sizes[shard] and local_max_distance > max_distance:
+                max_distance = local_max_distance
+                MaxIndex = int(offsets[shard]) + local_max
+        if i + 1 < n_clusters:
+            #set the furthest point from existing center as a new center
+            cluster_centers_.append(MaxIndex)
+            center_coordinates.append(fetch(MaxIndex))
+
+    for conn in connections:
+        conn.send(('result',))
+    results = [conn.recv() for conn in connections]
+    labels_ = np.concatenate([labels for labels, _ in results])
+    distances_ = np.concatenate([distances for _, distances in results])
+    return cluster_centers_, labels_, distances_, np.asarray(center_coordinates)
+
+class ShardedKCenters(BaseEstimator, ClusterMixin):
+    """Sharded K-Centers clustering
+    Farthest-point clustering with the frames partitioned across a pool of
+    local worker processes, or across nodes that each serve their own part
+    of the data with ``serve_shard``. Produces the same centers and labels
+    as ``KCenters`` for the same seed.
+    Parameters
+    ----------
+    n_clusters : int, optional, default: 8
+        The number of clusters to form as well as the number of
+        centroids to generate.
+    metric : {"euclidean", "sqeuclidean", "cityblock", "chebyshev", "rmsd", ...}
+        The distance metric to use. metric = "rmsd" requires md.Trajectory
+        shards; other distance metrics require ``np.ndarray``s.
+    random_state : integer, optional
+        Global index of the first center, or -1 for a random frame.
+    n_workers : int, optional
+        Number of local worker processes ``fit`` splits X across.
+        Defaults to the number of CPUs.
+    workers : list of (host, port), optional
+        Addresses of remote shards started with ``serve_shard``, in the
+        order of the global frame indices. If given, ``fit`` takes no data.
+    authkey : bytes, optional
+        Shared secret for the remote shards.
+    Attributes
+    ----------
+    cluster_centers_ : list of int
+        Global indices of the cluster centers.
+    cluster_center_frames_ : array or md.Trajectory
+        Coordinates of the cluster centers.
+    labels_ : array, [n_samples,]
+        The label of each point is an integer in [0, n_clusters).
+    distances_ : array, [n_samples,]
+        Distance of each point to its cluster center.
+    """
+    def __init__(self, n_clusters=8, metric='rmsd', random_state=None, n_workers=None, workers=None,
+                 authkey=None):
+        self.n_clusters = n_clusters
+        self.metric = metric
+        self.random_state = random_state
+        self.n_workers = n_workers
+        self.workers = workers
+        self.authkey = authkey
+
+    def fit(self, X=None, y=None):
+        """Perform clustering.
+        Parameters
+        -----------
+        X : array-like, shape=[n_samples, n_features] or md.Trajectory, optional
+            Samples to cluster on local workers. Must be None when
+            ``workers`` point to remote shards.
+        """
+        t0 = time.time()
+        processes = []
+        if self.workers is not None:
+            if X is not None:
+                raise ValueError("X must be None when clustering remote shards")
+            if self.authkey is None:
+                raise ValueError("authkey is required to connect to remote shards")
+            connections = [Client(tuple(address), authkey=self.authkey) for address in self.workers]
+        else:
+            n_workers = self.n_workers or multiprocessing.cpu_count()
+            bounds = np.linspace(0, len(X), min(n_workers, len(X)) + 1).astype(int)
+            # spawn, not fork: a forked child inherits numba's already running
+            # thread pool and can deadlock in the fused kernel
+            context = multiprocessing.get_context('spawn')
+            connections = []
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(target=shard_worker, args=(child_conn, X[start:stop], self.metric),
+                                                  daemon=True)
+                process.start()
+                child_conn.close()
+                connections.append(parent_conn)
+                processes.append(process)
+        try:
+            self.cluster_centers_, self.labels_, self.distances_, center_coordinates = \
+                sharded_k_centers(connections, n_clusters=self.n_clusters, metric=self.metric,
+                                  random_state=self.random_state)
+        finally:
+            for conn in connections:
+                try:
+                    conn.send(('close',))
+                except (OSError, EOFError):
+                    pass
+                conn.close()
+            for process in processes:
+                process.join()
+        if self.metric == 'rmsd':
+            topology = X.topology if isinstance(X, md.Trajectory) else None
+            self.cluster_center_frames_ = md.Trajectory(center_coordinates, topology)
+        else:
+            self.cluster_center_frames_ = center_coordinates
+        t1 = time.time()
+        print("Sharded K-Centers clustering Time Cost:", t1 - t0)
+        return self
@@ -11,9 +11,12 @@ from hkdataminer.msm import MarkovStateModel
 from .lumper_ import *
 # ===============================================================================
 class Ward(MarkovStateModel):
-    def __init__(self, n_macro_states=None, lag_time=1, homedir=None, traj_len=None):
+    def __init__(self, n_macro_states=None, lag_time=1, homedir=None, traj_len=None, knn_graph=None):
         # lag time in number of entries in assignment file (int).
+        # knn_graph: optional KNNGraph of the rows of tProb_, reused as the
+        # connectivity instead of recomputing kneighbors_graph.
         self.n_macro_states = n_macro_states
+        self.knn_graph = knn_graph
         self.assignments = None
         self.microstate_mapping_ = None
         self.MacroAssignments_ = None
@@ -37,7 +40,11 @@ class Ward(MarkovStateModel):
 
         t0 = time.time()
 
-        connectivity = kneighbors_graph(self.tProb_, n_neighbors=self.n_neighbors)
+        if self.knn_graph is not None:
+            self.knn_graph.check(self.tProb_)
+            connectivity = self.knn_graph.to_csr()
+        else:
+            connectivity = kneighbors_graph(self.tProb_, n_neighbors=self.n_neighbors)
         # make connectivity symmetric
         #connectivity = 0.5 * (connectivity + connectivity.T)
         #print("Connectivity=", connectivity, "N_Neighbors="), self.n_fneighbors
@@ -1 +1,4 @@
-from .pairwise import *
\ No newline at end of file
+from .pairwise import *
+from .rmsd_ import *
+from .vptree_ import *
+from .knn_graph_ import *
@@ -0,0 +1,259 @@
+__author__ = 'stephen'
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+import mdtraj as md
+from scipy import sparse
+from .rmsd_ import RMSDDataset
+from .pairwise import pairwise_distances, kneighbors
+from .vptree_ import VPTree
+
+
+def data_fingerprint(X, block_size=2 ** 16):
+    '''
+    Content hash of a dataset: shape, dtype and values of a feature array
+    or sparse matrix (hashed like its dense equivalent), or of the
+    coordinates of an md.Trajectory / RMSDDataset (the centered ones for
+    the latter).
+
+    :param X: array, sparse matrix, md.Trajectory or RMSDDataset
+    :param block_size: rows hashed per step, bounds the temporary copies
+    :return: hex string
+    '''
+    if sparse.issparse(X):
+        data = X.tocsr()
+    elif isinstance(X, (md.Trajectory, RMSDDataset)):
+        data = X.xyz
+    else:
+        data = np.asarray(X)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((data.shape, data.dtype.str)).encode())
+    for start in range(0, data.shape[0], block_size):
+        block = data[start:start + block_size]
+        # a sparse matrix hashes like its dense equivalent
+        block = block.toarray() if sparse.issparse(block) else block
+        digest.update(np.ascontiguousarray(block).data)
+    return digest.hexdigest()
+
+
+class KNNGraph(object):
+    '''
+    Precomputed neighbor graph of a dataset, reusable by every density and
+    graph based method.
+
+    Row i of the CSR arrays lists the neighbors of point i, itself included,
+    in order of increasing distance. A kNN graph has k entries per row; the
+    structure also holds graphs with a variable number of neighbors per row.
+    The metric, k and a content hash of the input are recorded, so a graph
+    can be checked against the data it is used with. APLoD also needs the
+    pairwise distances of a random subset of the frames; ``build`` stores
+    them when ``n_samples`` is given.
+
+    The DBSCAN estimators, APLoD and Ward accept a KNNGraph in place of X.
+
+    :param indptr: array [n_points + 1,] int64, row boundaries
+    :param indices: array [n_entries,] int32, neighbor indices
+    :param distances: array [n_entries,], neighbor distances (float32 in kNN graphs)
+    :param metric: metric of the distances
+    :param n_neighbors: neighbors per row of a kNN graph, None otherwise
+    :param radius: search radius of a radius graph, None otherwise
+    :param fingerprint: ``data_fingerprint`` of the input
+    :param samples: indices of the sampled frames, optional
+    :param sample_distances: array [n_samples, n_samples] float32, optional
+    '''
+    _arrays = ('indptr', 'indices', 'distances', 'samples', 'sample_distances')
+
+    def __init__(self, indptr, indices, distances, metric, n_neighbors=None, fingerprint=None,
+                 samples=None, sample_distances=None, radius=None):
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+        self.metric = metric
+        self.n_neighbors = n_neighbors
+        self.radius = radius
+        self.fingerprint = fingerprint
+        self.samples = samples
+        self.sample_distances = sample_distances
+
+    @classmethod
+    def from_kneighbors(cls, distances, indices, metric, fingerprint=None, **kwargs):
+        '''Wrap dense kNN results [n_points, k], rows sorted by distance.'''
+        n_points, k = indices.shape
+        indptr = np.arange(0, (n_points + 1) * k, k, dtype=np.int64)
+        return cls(indptr, np.ascontiguousarray(indices, dtype=np.int32).ravel(),
+                   np.ascontiguousarray(distances, dtype=np.float32).ravel(), metric, n_neighbors=k,
+                   fingerprint=fingerprint, **kwargs)
+
+    @classmethod
+    def build(cls, X, n_neighbors, metric='euclidean', n_samples=None, random_state=None, n_jobs=1):
+        '''
+        Compute the exact kNN graph of X.
+
+        :param X: array [n_points, n_features], or md.Trajectory for metric='rmsd'
+        :param n_neighbors: neighbors per point, the point itself included
+        :param metric: 'rmsd' (VP-tree search) or a metric of ``pairwise_distances``
+        :param n_samples: also store the pairwise distances of this many
+            random frames, as needed by APLoD
+        :param random_state: seed for the choice of the samples
+        :param n_jobs: threads for the neighbor search
+        :return: KNNGraph
+        '''
+        fingerprint = data_fingerprint(X)
+        if metric == 'rmsd':
+            tree = VPTree(X, metric=metric, n_jobs=n_jobs)
+            points = tree.data
+            distances, indices = tree.query(points, k=n_neighbors)
+        else:
+            points = np.asarray(X)
+            distances, indices = kneighbors(points, n_neighbors, metric=metric, n_jobs=n_jobs)
+        samples = sample_distances = None
+        if n_samples is not None:
+            random_state = np.random.RandomState(random_state)
+            samples = np.sort(random_state.choice(len(points), n_samples, replace=False))
+            sample_distances = np.asarray(pairwise_distances(points[samples], metric=metric), dtype=np.float32)
+        return cls.from_kneighbors(distances, indices, metric, fingerprint=fingerprint, samples=samples,
+                                   sample_distances=sample_distances)
+
+    @property
+    def n_points(self):
+        return len(self.indptr) - 1
+
+    def __len__(self):
+        return self.n_points
+
+    def check(self, X=None, metric=None):
+        '''
+        Raise ValueError if the graph was not built from X or with metric.
+        '''
+        if metric is not None and metric != 'precomputed' and metric != self.metric:
+            raise ValueError("KNNGraph was built with metric %r, not %r" % (self.metric, metric))
+        if X is not None and self.fingerprint is not None and data_fingerprint(X) != self.fingerprint:
+            raise ValueError("KNNGraph was built from different data")
+
+    def kneighbors(self, n_neighbors=None):
+        '''
+        Dense kNN arrays, optionally truncated to fewer neighbors.
+
+        :return: distances [n_points, n_neighbors] float32, indices [n_points, n_neighbors] int32
+        '''
+        if self.n_neighbors is None:
+            raise ValueError("KNNGraph has a variable number of neighbors per point")
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        if n_neighbors > self.n_neighbors:
+            raise ValueError("KNNGraph holds %d neighbors per point, %d requested" % (self.n_neighbors, n_neighbors))
+        shape = (self.n_points, self.n_neighbors)
+        return (np.asarray(self.distances).reshape(shape)[:, :n_neighbors],
+                np.asarray(self.indices).reshape(shape)[:, :n_neighbors])
+
+    def radius_csr(self, radius, rows=None):
+        '''
+        Neighbors within radius (inclusive) of every point, in CSR form.
+
+        A kNN graph only sees the k nearest neighbors: a warning is issued
+        if some point has all k of them within radius, since its
+        neighborhood may then be incomplete.
+
+        :param rows: sorted array of point indices, optional; only their
+            rows are thresholded and the others are left empty
+        :return: indptr [n_points + 1,] int64, indices [n_entries,] int32
+        '''
+        if self.radius is not None and radius > self.radius:
+            raise ValueError("KNNGraph holds the neighbors within %g, %g requested" % (self.radius, radius))
+        indptr = np.asarray(self.indptr)
+        if rows is None:
+            entries = slice(None)
+            starts, ends = indptr[:-1], indptr[1:]
+        else:
+            rows = np.asarray(rows, dtype=np.intp)
+            lengths = indptr[rows + 1] - indptr[rows]
+            ends = np.cumsum(lengths)
+            starts = ends - lengths
+            # positions of the entries of the selected rows
+            entries = np.repeat(indptr[rows] - starts, lengths) + np.arange(ends[-1] if len(ends) else 0)
+        within = np.asarray(self.distances)[entries] <= radius
+        cumulative = np.concatenate(([0], np.cumsum(within)))
+        counts = cumulative[ends] - cumulative[starts]
+        if rows is not None:
+            counts, row_counts = np.zeros(self.n_points, dtype=np.int64), counts
+            counts[rows] = row_counts
+        if self.n_neighbors is not None:
+            truncated = np.count_nonzero(counts == self.n_neighbors)
+            if truncated:
+                warnings.warn("%d points have all %d neighbors of the KNNGraph within eps=%g; their "
+                              "neighborhoods may be incomplete" % (truncated, self.n_neighbors, radius))
+        # rows are sorted by distance, so the neighbors within radius come first
+        indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return indptr, np.asarray(self.indices)[entries][within]
+
+    def radius_neighborhoods(self, radius):
+        '''
+        Neighbors within radius (inclusive) of every point, as the
+        object array of index arrays used by DBSCAN.
+        '''
+        indptr, indices = self.radius_csr(radius)
+        neighborhoods = np.empty(self.n_points, dtype=object)
+        for i in range(self.n_points):
+            neighborhoods[i] = indices[indptr[i]:indptr[i + 1]].astype(np.intp)
+        return neighborhoods
+
+    def to_csr(self, mode='connectivity', include_self=False):
+        '''
+        The graph as a scipy.sparse CSR matrix [n_points, n_points], as
+        returned by sklearn's kneighbors_graph.
+
+        :param mode: 'connectivity' (ones) or 'distance'
+        :param include_self: keep the entry of every point for itself
+        '''
+        # copies: scipy sorts the column indices in place, which would lose
+        # the distance order of the rows (and fails on read-only memmaps)
+        indices = np.array(self.indices)
+        if mode == 'connectivity':
+            data = np.ones(len(indices), dtype=np.float64)
+        elif mode == 'distance':
+            data = np.asarray(self.distances, dtype=np.float64)
+        else:
+            raise ValueError("mode must be 'connectivity' or 'distance', got %r" % (mode,))
+        graph = sparse.csr_matrix((data, indices, np.array(self.indptr)), shape=(self.n_points, self.n_points))
+        if not include_self:
+            graph.setdiag(0)
+            graph.eliminate_zeros()
+        return graph
+
+    def save(self, path):
+        '''
+        Save to a single .npz file if path ends with '.npz', otherwise to a
+        directory of .npy files that ``load`` memory-maps.
+        '''
+        info = dict(metric=self.metric, n_neighbors=self.n_neighbors, radius=self.radius,
+                    fingerprint=self.fingerprint)
+        arrays = dict((name, getattr(self, name)) for name in self._arrays if getattr(self, name) is not None)
+        if path.endswith('.npz'):
+            np.savez(path, info=np.array(json.dumps(info)), **arrays)
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        with open(os.path.join(path, 'info.json'), 'w') as f:
+            json.dump(info, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Load a graph written by ``save``. The arrays of a directory are
+        memory-mapped with mmap_mode (None reads them into memory).
+        '''
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                info = json.loads(str(f['info']))
+                arrays = dict((name, f[name]) for name in cls._arrays if name in f)
+        else:
+            with open(os.path.join(path, 'info.json')) as f:
+                info = json.load(f)
+            arrays = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                          for name in cls._arrays if os.path.exists(os.path.join(path, name + '.npy')))
+        return cls(metric=info['metric'], n_neighbors=info['n_neighbors'], radius=info.get('radius'),
+                   fingerprint=info['fingerprint'], **arrays)
@@ -1,8 +1,370 @@
 __author__ = 'stephen'
+import os
+import threading
 import numpy as np
 import mdtraj as md
+from numba import njit, prange
 import sklearn.metrics.pairwise as sp
-def pairwise_distances(X, Y=None, index=None, metric="euclidean"):
+from sklearn.neighbors import VALID_METRICS
+from concurrent.futures import ThreadPoolExecutor
+from .rmsd_ import as_rmsd_dataset
+
+# numba's parallel kernels must not be entered by two Python threads at once
+_numba_lock = threading.Lock()
+
+# Registered metrics: name -> (kernel, prepare). ``prepare(Y)`` computes
+# per-row data of Y once (e.g. squared norms), ``kernel(X, Y, Y_data, out)``
+# fills the block ``out`` [len(X), len(Y)] with the distances.
+METRICS = {}
+
+def register_metric(name, prepare=None):
+    '''
+    Register a native distance kernel for `name`, used as a decorator on
+    ``kernel(X, Y, Y_data, out, **kwds)``. X and Y are C-contiguous 2-D
+    arrays of the working dtype, ``Y_data`` is ``prepare(Y)`` (None without
+    prepare), ``out`` is the preallocated block [len(X), len(Y)] to fill and
+    ``kwds`` are the metric parameters passed to ``pairwise_distances``.
+    '''
+    def decorator(kernel):
+        METRICS[name] = (kernel, prepare)
+        return kernel
+    return decorator
+
+# bytes of the float64 copy of Y made per GEMM, see _upcast_batches
+_UPCAST_BYTES = 2 ** 25
+
+def _squared_norms(Y):
+    return np.einsum('ij,ij->i', Y, Y, dtype=np.float64)
+
+def _norms(Y):
+    return np.sqrt(_squared_norms(Y))
+
+def _upcast_batches(Y):
+    '''
+    Yield ``(start, stop, Y[start:stop])`` in float64, a bounded number of
+    rows at a time. The GEMM-based kernels accumulate in float64, as sklearn
+    does for float32 input: in float32 the norm expansion cancels for close
+    pairs far from the origin and misorders the nearest neighbors.
+    '''
+    n_rows = max(1, _UPCAST_BYTES // (8 * max(1, Y.shape[1])))
+    for start in range(0, len(Y), n_rows):
+        stop = min(start + n_rows, len(Y))
+        yield start, stop, Y[start:stop].astype(np.float64, copy=False)
+
+def _one_vs_many(X, y):
+    # the norm expansion saves nothing against a single row, so subtract
+    # directly, with the arithmetic of the fused k-centers kernel
+    diff = X.astype(np.float64) - y.astype(np.float64)
+    return np.einsum('ij,ij->i', diff, diff)
+
+@register_metric('sqeuclidean', prepare=_squared_norms)
+def _sqeuclidean(X, Y, Y_norms, out):
+    if len(Y) == 1:
+        out[:, 0] = _one_vs_many(X, Y[0])
+        return out
+    # ||x||^2 - 2 x.y + ||y||^2 with one float64 GEMM per batch of Y
+    X = X.astype(np.float64, copy=False)
+    X_norms = _squared_norms(X)
+    for start, stop, Y_batch in _upcast_batches(Y):
+        block = np.dot(X, Y_batch.T)
+        block *= -2
+        block += X_norms[:, np.newaxis]
+        block += Y_norms[np.newaxis, start:stop]
+        np.maximum(block, 0, out=block)
+        out[:, start:stop] = block
+    return out
+
+@register_metric('euclidean', prepare=_squared_norms)
+def _euclidean(X, Y, Y_norms, out):
+    _sqeuclidean(X, Y, Y_norms, out)
+    np.sqrt(out, out=out)
+    return out
+
+@register_metric('cosine', prepare=_norms)
+def _cosine(X, Y, Y_norms, out):
+    X = X.astype(np.float64, copy=False)
+    X_norms = _norms(X)
+    # zero vectors have cosine distance 1 to everything, as in sklearn
+    X_norms[X_norms == 0] = 1
+    Y_norms = np.where(Y_norms == 0, 1, Y_norms)
+    for start, stop, Y_batch in _upcast_batches(Y):
+        block = np.dot(X, Y_batch.T)
+        block /= X_norms[:, np.newaxis]
+        block /= Y_norms[np.newaxis, start:stop]
+        np.subtract(1, block, out=block)
+        np.clip(block, 0, 2, out=block)
+        out[:, start:stop] = block
+    return out
+
+@njit(parallel=True)
+def _cityblock_kernel(X, Y, out):
+    for i in prange(X.shape[0]):
+        for j in range(Y.shape[0]):
+            d = 0.0
+            for k in range(X.shape[1]):
+                d += abs(np.float64(X[i, k]) - np.float64(Y[j, k]))
+            out[i, j] = d
+
+@njit(parallel=True)
+def _chebyshev_kernel(X, Y, out):
+    for i in prange(X.shape[0]):
+        for j in range(Y.shape[0]):
+            d = 0.0
+            for k in range(X.shape[1]):
+                d = max(d, abs(np.float64(X[i, k]) - np.float64(Y[j, k])))
+            out[i, j] = d
+
+@njit(parallel=True)
+def _periodic_kernel(X, Y, period, out):
+    half = period / 2.0
+    for i in prange(X.shape[0]):
+        for j in range(Y.shape[0]):
+            d = 0.0
+            for k in range(X.shape[1]):
+                diff = abs(np.float64(X[i, k]) - np.float64(Y[j, k])) % period
+                if diff > half:
+                    diff = period - diff
+                d += diff * diff
+            out[i, j] = np.sqrt(d)
+
+@register_metric('periodic')
+def _periodic(X, Y, Y_data, out, period=360.0):
+    '''
+    Euclidean distance under the minimum-image convention: every feature is
+    an angle with the given period (360 for the degrees of
+    ``XTCReader.get_phipsi``), so -179 and 179 are 2 apart. It is a metric
+    on the torus.
+    '''
+    with _numba_lock:
+        _periodic_kernel(X, Y, float(period), out)
+    return out
+
+@register_metric('cityblock')
+def _cityblock(X, Y, Y_data, out):
+    with _numba_lock:
+        _cityblock_kernel(X, Y, out)
+    return out
+
+@register_metric('chebyshev')
+def _chebyshev(X, Y, Y_data, out):
+    with _numba_lock:
+        _chebyshev_kernel(X, Y, out)
+    return out
+
+METRICS['manhattan'] = METRICS['cityblock']
+METRICS['l1'] = METRICS['cityblock']
+METRICS['l2'] = METRICS['euclidean']
+
+@njit(inline='always', fastmath=True)
+def _qcp_rmsd(A, B, trace_a, trace_b):
+    '''
+    RMSD of two centered frames [3, n_atoms] after optimal superposition,
+    via the largest root of the QCP characteristic polynomial (Theobald,
+    Acta Cryst. A61, 2005), as in md.rmsd.
+    '''
+    Sxx = Sxy = Sxz = Syx = Syy = Syz = Szx = Szy = Szz = 0.0
+    for k in range(A.shape[1]):
+        ax, ay, az = np.float64(A[0, k]), np.float64(A[1, k]), np.float64(A[2, k])
+        bx, by, bz = np.float64(B[0, k]), np.float64(B[1, k]), np.float64(B[2, k])
+        Sxx += ax * bx
+        Sxy += ax * by
+        Sxz += ax * bz
+        Syx += ay * bx
+        Syy += ay * by
+        Syz += ay * bz
+        Szx += az * bx
+        Szy += az * by
+        Szz += az * bz
+    Sxx2, Syy2, Szz2 = Sxx * Sxx, Syy * Syy, Szz * Szz
+    Sxy2, Syz2, Sxz2 = Sxy * Sxy, Syz * Syz, Sxz * Sxz
+    Syx2, Szy2, Szx2 = Syx * Syx, Szy * Szy, Szx * Szx
+    SyzSzymSyySzz2 = 2.0 * (Syz * Szy - Syy * Szz)
+    Sxx2Syy2Szz2Syz2Szy2 = Syy2 + Szz2 - Sxx2 + Syz2 + Szy2
+    C2 = -2.0 * (Sxx2 + Syy2 + Szz2 + Sxy2 + Syx2 + Sxz2 + Szx2 + Syz2 + Szy2)
+    C1 = 8.0 * (Sxx * Syz * Szy + Syy * Szx * Sxz + Szz * Sxy * Syx
+                - Sxx * Syy * Szz - Syz * Szx * Sxy - Szy * Syx * Sxz)
+    SxzpSzx, SyzpSzy, SxypSyx = Sxz + Szx, Syz + Szy, Sxy + Syx
+    SyzmSzy, SxzmSzx, SxymSyx = Syz - Szy, Sxz - Szx, Sxy - Syx
+    SxxpSyy, SxxmSyy = Sxx + Syy, Sxx - Syy
+    Sxy2Sxz2Syx2Szx2 = Sxy2 + Sxz2 - Syx2 - Szx2
+    C0 = (Sxy2Sxz2Syx2Szx2 * Sxy2Sxz2Syx2Szx2
+          + (Sxx2Syy2Szz2Syz2Szy2 + SyzSzymSyySzz2) * (Sxx2Syy2Szz2Syz2Szy2 - SyzSzymSyySzz2)
+          + (-SxzpSzx * SyzmSzy + SxymSyx * (SxxmSyy - Szz)) * (-SxzmSzx * SyzpSzy + SxymSyx * (SxxmSyy + Szz))
+          + (-SxzpSzx * SyzpSzy - SxypSyx * (SxxpSyy - Szz)) * (-SxzmSzx * SyzmSzy - SxypSyx * (SxxpSyy + Szz))
+          + (SxypSyx * SyzpSzy + SxzpSzx * (SxxmSyy + Szz)) * (-SxymSyx * SyzmSzy + SxzpSzx * (SxxpSyy + Szz))
+          + (SxypSyx * SyzmSzy + SxzmSzx * (SxxmSyy - Szz)) * (-SxymSyx * SyzpSzy + SxzmSzx * (SxxpSyy - Szz)))
+    # Newton iteration from the upper bound (G_a + G_b) / 2
+    E0 = (np.float64(trace_a) + np.float64(trace_b)) / 2.0
+    eigenvalue = E0
+    for _ in range(50):
+        x2 = eigenvalue * eigenvalue
+        b = (x2 + C2) * eigenvalue
+        a = b + C1
+        delta = (a * eigenvalue + C0) / (2.0 * x2 * eigenvalue + b + a)
+        eigenvalue -= delta
+        if abs(delta) < abs(1e-11 * eigenvalue):
+            break
+    return np.sqrt(max(0.0, 2.0 * (E0 - eigenvalue) / A.shape[1]))
+
+@njit(parallel=True, fastmath=True)
+def _rmsd_block_kernel(X, Y, X_traces, Y_traces, out):
+    for i in prange(X.shape[0]):
+        for j in range(Y.shape[0]):
+            out[i, j] = _qcp_rmsd(X[i], Y[j], X_traces[i], Y_traces[j])
+
+@njit(parallel=True, fastmath=True)
+def _rmsd_condensed_kernel(X, traces, tile_size, tile_rows, tile_columns, out):
+    # the upper-triangle tiles (tile_rows <= tile_columns) are independent;
+    # entry (i, j), i < j, goes to n*i - i*(i+1)/2 + j - i - 1 as in scipy's
+    # squareform
+    n = X.shape[0]
+    for pair in prange(tile_rows.shape[0]):
+        ti, tj = tile_rows[pair], tile_columns[pair]
+        for i in range(ti * tile_size, min(n, (ti + 1) * tile_size)):
+            row = n * i - i * (i + 1) // 2 - i - 1
+            for j in range(max(i + 1, tj * tile_size), min(n, (tj + 1) * tile_size)):
+                out[row + j] = _qcp_rmsd(X[i], X[j], traces[i], traces[j])
+
+@njit(parallel=True, fastmath=True)
+def _rmsd_symmetric_kernel(X, traces, tile_size, tile_rows, tile_columns, out):
+    # as _rmsd_condensed_kernel, each pair computed once and written to
+    # both (i, j) and (j, i) of the square matrix
+    n = X.shape[0]
+    for pair in prange(tile_rows.shape[0]):
+        ti, tj = tile_rows[pair], tile_columns[pair]
+        for i in range(ti * tile_size, min(n, (ti + 1) * tile_size)):
+            if ti == tj:
+                out[i, i] = 0.0
+            for j in range(max(i + 1, tj * tile_size), min(n, (tj + 1) * tile_size)):
+                d = _qcp_rmsd(X[i], X[j], traces[i], traces[j])
+                out[i, j] = d
+                out[j, i] = d
+
+def _tiled_rmsd(kernel, X, X_atoms, tile_size, out):
+    n_tiles = (len(X) + tile_size - 1) // tile_size
+    tile_rows, tile_columns = np.triu_indices(n_tiles)
+    kernel(X_atoms, X.traces, tile_size, tile_rows, tile_columns, out)
+
+def _atom_major(X):
+    # [n_frames, 3, n_atoms], so the per-pair loop runs over contiguous atoms
+    return np.ascontiguousarray(X.xyz.transpose(0, 2, 1))
+
+def pairwise_rmsd(X, Y=None, condensed=False, filename=None, tile_size=64):
+    '''
+    All-pairs RMSD with a parallel QCP kernel on precentered float32 frames.
+
+    :param X: md.Trajectory or RMSDDataset
+    :param Y: md.Trajectory or RMSDDataset; if None, the distances among X
+    :param condensed: only with Y None: return the upper triangle as a
+        condensed array [n*(n-1)/2] (scipy's squareform layout) instead of
+        the full symmetric matrix; every pair is computed once
+    :param filename: write the result into a memory-mapped .npy file of
+        this name and return the memmap
+    :param tile_size: frames per tile of the condensed computation
+    :return: array float32, [len(X), len(Y)] or condensed
+    '''
+    X = as_rmsd_dataset(X)
+    X_atoms = _atom_major(X)
+    if Y is not None:
+        if condensed:
+            raise ValueError("condensed output requires Y=None")
+        Y = as_rmsd_dataset(Y)
+        shape = (len(X), len(Y))
+    elif condensed:
+        shape = (len(X) * (len(X) - 1) // 2,)
+    else:
+        shape = (len(X), len(X))
+    if filename is None:
+        out = np.empty(shape, dtype=np.float32)
+    else:
+        out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=shape)
+    with _numba_lock:
+        if Y is not None:
+            _rmsd_block_kernel(X_atoms, _atom_major(Y), X.traces, Y.traces, out)
+        elif condensed:
+            _tiled_rmsd(_rmsd_condensed_kernel, X, X_atoms, int(tile_size), out)
+        else:
+            _tiled_rmsd(_rmsd_symmetric_kernel, X, X_atoms, int(tile_size), out)
+    if filename is not None:
+        out.flush()
+    return out
+
+def _chunk_rows(n_rows, n_columns, itemsize, working_memory):
+    '''Rows per block so that a block and its temporaries fit in working_memory MiB.'''
+    # the block itself plus about one block of temporaries
+    row_bytes = max(1, 2 * n_columns * itemsize)
+    return int(max(1, min(n_rows, (working_memory * 2 ** 20) // row_bytes)))
+
+def requires_native(metric):
+    '''True for the registered metrics that sklearn's neighbor searches do not know, e.g. "periodic".'''
+    return metric in METRICS and metric not in VALID_METRICS['brute']
+
+def pairwise_distances_chunked(X, Y=None, metric="euclidean", n_jobs=None, working_memory=1024,
+                               dtype=None, **kwds):
+    '''
+    Yield the distance matrix between X and Y as consecutive blocks of rows.
+
+    Registered metrics (see ``METRICS``) are computed natively and returned
+    in `dtype`: euclidean/sqeuclidean/cosine with float64 GEMMs per block,
+    cityblock and chebyshev with parallel numba kernels accumulating in
+    float64. Other metrics go to sklearn. The distance of a sample to
+    itself is exactly 0 when Y is None or X.
+
+    :param X: array [n_samples_a, n_features]
+    :param Y: array [n_samples_b, n_features], default X
+    :param metric: metric name
+    :param n_jobs: number of threads computing blocks of a GEMM-based
+        metric at the same time; None leaves the threading to BLAS. The
+        numba kernels always use all numba threads.
+    :param working_memory: MiB a block (with temporaries) may take
+    :param dtype: floating point type of the data and the blocks; by
+        default float32 if X and Y are float32, float64 otherwise
+    :param kwds: metric parameters, e.g. ``period`` for "periodic"
+    :return: generator of arrays [n_rows, n_samples_b]
+    '''
+    if metric not in METRICS:
+        Y = X if Y is None else Y
+        n_rows = _chunk_rows(len(X), len(Y), 8, working_memory)
+        for start in range(0, len(X), n_rows):
+            yield sp.pairwise_distances(X[start:start + n_rows], Y, metric=metric, n_jobs=n_jobs, **kwds)
+        return
+    kernel, prepare = METRICS[metric]
+    symmetric = Y is None or Y is X
+    X = np.asarray(X)
+    Y = X if symmetric else np.asarray(Y)
+    if dtype is None:
+        dtype = np.float32 if X.dtype == np.float32 and Y.dtype == np.float32 else np.float64
+    X = np.ascontiguousarray(X, dtype=dtype)
+    if X.ndim == 1:
+        X = X[np.newaxis, :]
+    Y = X if symmetric else np.ascontiguousarray(Y, dtype=dtype)
+    if Y.ndim == 1:
+        Y = Y[np.newaxis, :]
+    Y_data = prepare(Y) if prepare is not None else None
+    n_rows = _chunk_rows(len(X), len(Y), X.itemsize, working_memory)
+    blocks = [(start, min(start + n_rows, len(X))) for start in range(0, len(X), n_rows)]
+
+    def compute(block):
+        start, stop = block
+        out = kernel(X[start:stop], Y, Y_data, np.empty((stop - start, len(Y)), dtype=dtype), **kwds)
+        if symmetric:
+            # rounding leaves the self-distances slightly off zero
+            rows = np.arange(stop - start)
+            out[rows, start + rows] = 0
+        return out
+
+    if n_jobs is not None and n_jobs != 1 and prepare is not None and len(blocks) > 1:
+        n_threads = n_jobs if n_jobs > 0 else os.cpu_count()
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # at most one block per thread in flight, to honor working_memory
+            for first in range(0, len(blocks), n_threads):
+                for out in pool.map(compute, blocks[first:first + n_threads]):
+                    yield out
+    else:
+        for block in blocks:
+            yield compute(block)
+
+def pairwise_distances(X, Y=None, index=None, metric="euclidean", n_jobs=None, working_memory=1024, **kwds):
     '''
     Compute the distance matrix from a vector array X and optional Y.
     This method takes either a vector array or a distance matrix,
@@ -17,23 +379,100 @@ def pairwise_distances(X, Y=None, index=None, metric="euclidean"):
         Array of pairwise distances between samples, or a feature array.
     :param Y:   array [n_samples_b, n_features]
         A second feature array only if X has shape [n_samples_a, n_features].
-    :param index:  int, the index of element in X array
+    :param index:  int, the index of element in Y (or X if Y is None). If given,
+        the distances of all samples of X to that one element are returned as
+        an array [n_samples_a,]; otherwise the full matrix [n_samples_a, n_samples_b].
     :param metric: The metric to use when calculating distance between instances in a feature array.
-        If metric ='rmsd', it should be computed by MDTraj
-    :return: The distances
+        If metric ='rmsd', X and Y may be md.Trajectory or RMSDDataset; pass an
+        RMSDDataset to center the coordinates only once. The full matrix is
+        computed by ``pairwise_rmsd``, a single column by MDTraj.
+        The metrics in ``METRICS`` are computed natively, see
+        ``pairwise_distances_chunked``; other metrics are passed to sklearn.
+    :param n_jobs: threads, see ``pairwise_distances_chunked``
+    :param working_memory: MiB of temporaries per block of rows
+    :param kwds: metric parameters, e.g. ``period`` for "periodic"
+    :return: The distances, float32 for float32 feature arrays (and RMSD),
+        float64 otherwise
     '''
     if metric == "rmsd":
-        if Y is None:
-            distances_ = md.rmsd(X, X, index, parallel=True, precentered=True)
+        X = as_rmsd_dataset(X)
+        if index is not None:
+            return X.rmsd(X if Y is None else as_rmsd_dataset(Y), frame=index)
+        return pairwise_rmsd(X, Y)
+    if Y is None:
+        Y = X
+    if index is not None:
+        Y = Y[[index]]
+    blocks = list(pairwise_distances_chunked(X, Y, metric=metric, n_jobs=n_jobs, working_memory=working_memory,
+                                             **kwds))
+    distances_ = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+    if index is not None:
+        return distances_[:, 0]
+    return distances_
+
+def pairwise_distances_argmin_min(X, Y, metric="euclidean", n_jobs=None, working_memory=1024, **kwds):
+    '''
+    Index of and distance to the closest row of Y for every row of X,
+    computed block by block so the full distance matrix is never held.
+
+    :return: labels, array [n_samples_a,] int32, and distances, array [n_samples_a,]
+    '''
+    labels, distances = [], []
+    for block in pairwise_distances_chunked(X, Y, metric=metric, n_jobs=n_jobs, working_memory=working_memory,
+                                            **kwds):
+        block_labels = np.argmin(block, axis=1)
+        labels.append(block_labels.astype(np.int32))
+        distances.append(block[np.arange(len(block)), block_labels])
+    return np.concatenate(labels), np.concatenate(distances)
+
+def kneighbors(X, n_neighbors, Y=None, metric="euclidean", n_jobs=None, working_memory=1024, **kwds):
+    '''
+    Brute-force k nearest neighbors, block by block, for any metric of
+    ``pairwise_distances``. Without Y the neighbors are searched in X and
+    every sample is its own first neighbor, as with sklearn.
+
+    :return: distances, array [n_samples_a, n_neighbors], and indices, array
+        [n_samples_a, n_neighbors], sorted by distance
+    '''
+    n_candidates = len(X) if Y is None else len(Y)
+    k = min(n_neighbors, n_candidates)
+    distances, indices = [], []
+    for block in pairwise_distances_chunked(X, Y, metric=metric, n_jobs=n_jobs, working_memory=working_memory,
+                                            **kwds):
+        if k < n_candidates:
+            block_indices = np.argpartition(block, k - 1, axis=1)[:, :k]
         else:
-            #distances_ = np.empty((len(X), len(Y)), dtype=np.float32)
-           # for i in xrange(len(Y)):
-            distances_ = md.rmsd(X, Y, index, parallel=True, precentered=True)
-        return distances_
-    else:
-        if Y is None:
-            #print "if Y is None"
-            return sp.pairwise_distances(X, X[index], metric=metric, n_jobs=1)
-        if index is None:
-            #print "if index is None, pairwise XX"
-            return sp.pairwise_distances(X, X, metric=metric, n_jobs=1)
+            block_indices = np.broadcast_to(np.arange(n_candidates), block.shape)
+        block_distances = np.take_along_axis(block, block_indices, axis=1)
+        ordering = np.argsort(block_distances, axis=1, kind='stable')
+        distances.append(np.take_along_axis(block_distances, ordering, axis=1))
+        indices.append(np.take_along_axis(block_indices, ordering, axis=1))
+    return np.concatenate(distances), np.concatenate(indices)
+
+def radius_neighbors(X, radius, Y=None, metric="euclidean", return_distance=False, n_jobs=None,
+                     working_memory=1024, **kwds):
+    '''
+    Brute-force radius search, block by block, for any metric of
+    ``pairwise_distances``. Without Y every sample is its own neighbor.
+
+    :return: array of index arrays, one per sample of X (an object array as
+        returned by sklearn), and the matching distance arrays if
+        return_distance
+    '''
+    neighborhoods = np.empty(len(X), dtype=object)
+    distances = np.empty(len(X), dtype=object)
+    start = 0
+    for block in pairwise_distances_chunked(X, Y, metric=metric, n_jobs=n_jobs, working_memory=working_memory,
+                                            **kwds):
+        rows, columns = np.nonzero(block <= radius)
+        bounds = np.searchsorted(rows, np.arange(1, len(block)))
+        # item by item: a slice assignment would broadcast rows of equal length
+        for i, neighbors in enumerate(np.split(columns, bounds)):
+            neighborhoods[start + i] = neighbors
+        if return_distance:
+            for i, neighbor_distances in enumerate(np.split(block[rows, columns], bounds)):
+                distances[start + i] = neighbor_distances
+        start += len(block)
+    if return_distance:
+        return distances, neighborhoods
+    return neighborhoods
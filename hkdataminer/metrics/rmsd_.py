@@ -0,0 +1,127 @@
+__author__ = 'stephen'
+import numpy as np
+import mdtraj as md
+
+
+def aligned_empty(shape, dtype=np.float32, alignment=32):
+    '''
+    Allocate an uninitialized C-contiguous array whose data pointer is
+    aligned to `alignment` bytes.
+    '''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(nbytes + alignment, dtype=np.uint8)
+    offset = (-buffer.ctypes.data) % alignment
+    return buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class RMSDDataset(object):
+    '''
+    Precentered coordinates for repeated RMSD calculations.
+
+    The frames of a trajectory are (optionally) restricted to an atom subset,
+    copied into a contiguous, aligned float32 buffer and centered once; the
+    per-frame inner-product traces needed by the QCP RMSD are computed at the
+    same time and cached. Every later RMSD call reuses both, so clustering
+    with thousands of centers pays the setup cost only once instead of on
+    every md.rmsd call.
+
+    :param traj: md.Trajectory, or array [n_frames, n_atoms, 3]
+    :param atom_indices: indices of the atoms used for the RMSD, default all
+    :param copy: copy the coordinates. If False and no atom subset is given,
+        a float32 C-contiguous trajectory is centered in place.
+    :param alignment: byte alignment of the coordinate buffer
+    '''
+    def __init__(self, traj, atom_indices=None, copy=True, alignment=32):
+        if isinstance(traj, md.Trajectory):
+            xyz = traj.xyz
+            topology = traj.topology
+        else:
+            xyz = np.asarray(traj)
+            topology = None
+        if atom_indices is not None:
+            atom_indices = np.asarray(atom_indices, dtype=np.intp)
+            xyz = xyz[:, atom_indices]
+            if topology is not None:
+                topology = topology.subset(atom_indices)
+            copy = True
+        if copy or xyz.dtype != np.float32 or not xyz.flags['C_CONTIGUOUS'] or not xyz.flags['WRITEABLE']:
+            buffer = aligned_empty(xyz.shape, np.float32, alignment)
+            buffer[:] = xyz
+            xyz = buffer
+        self.xyz = xyz
+        self.topology = topology
+        self.atom_indices = atom_indices
+        trajectory = md.Trajectory(self.xyz, None)
+        trajectory.center_coordinates()
+        self.traces = trajectory._rmsd_traces
+
+    @classmethod
+    def from_arrays(cls, xyz, traces, topology=None):
+        '''Wrap coordinates that are already centered, with their traces.'''
+        dataset = cls.__new__(cls)
+        dataset.xyz = xyz
+        dataset.traces = traces
+        dataset.topology = topology
+        dataset.atom_indices = None
+        return dataset
+
+    @property
+    def n_frames(self):
+        return self.xyz.shape[0]
+
+    @property
+    def n_atoms(self):
+        return self.xyz.shape[1]
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            key = [key]
+        return RMSDDataset.from_arrays(self.xyz[key], self.traces[key], self.topology)
+
+    def copy(self):
+        return RMSDDataset.from_arrays(self.xyz.copy(), self.traces.copy(), self.topology)
+
+    def to_trajectory(self, frames=None, topology=None):
+        '''
+        Return a precentered md.Trajectory of (a subset of) the frames. The
+        RMSD traces are attached, so md.rmsd(..., precentered=True) can
+        be used on it directly.
+        '''
+        if frames is None:
+            xyz, traces = self.xyz, self.traces
+        else:
+            xyz, traces = self.xyz[frames], self.traces[frames]
+        trajectory = md.Trajectory(xyz, topology)
+        trajectory._rmsd_traces = traces
+        return trajectory
+
+    def save(self, filename):
+        '''Save the (centered) frames, e.g. as a pdb file.'''
+        self.to_trajectory(topology=self.topology).save(filename)
+
+    def rmsd(self, reference=None, frame=0, frames=None, parallel=True):
+        '''
+        RMSD of the frames of this dataset to one frame of `reference`.
+
+        :param reference: RMSDDataset holding the reference frame, default self
+        :param frame: index of the reference frame in `reference`
+        :param frames: optional index array, only these frames are compared
+        :param parallel: use OpenMP inside md.rmsd
+        :return: array [n_frames,] float32
+        '''
+        if reference is None:
+            reference = self
+        target = self.to_trajectory(frames)
+        ref = reference.to_trajectory([frame])
+        return md.rmsd(target, ref, 0, parallel=parallel, precentered=True)
+
+
+def as_rmsd_dataset(X, copy=True):
+    '''Return X as an RMSDDataset, centering a copy of a trajectory if needed.'''
+    if isinstance(X, RMSDDataset):
+        return X
+    return RMSDDataset(X, copy=copy)
@@ -0,0 +1,287 @@
+__author__ = 'stephen'
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .rmsd_ import RMSDDataset, as_rmsd_dataset
+from .pairwise import pairwise_distances
+
+
+class VPTree(object):
+    '''
+    Vantage-point tree for exact nearest-neighbor and radius queries under
+    any metric, including RMSD.
+
+    Every internal node holds a vantage point and the median distance `mu`
+    of its subtree to it; points closer than `mu` go to the inside child,
+    the others to the outside child. Queries are answered in batches: at
+    each node the distances from all still active queries to the vantage
+    point are computed in one call, and a query only descends into a child
+    if the triangle inequality allows a neighbor closer than its current
+    k-th best (or within the radius) there.
+
+    With n_jobs > 1 the nodes of each level are split concurrently during
+    construction, and queries are divided into n_jobs batches searched
+    concurrently. Both use threads; md.rmsd and the pairwise kernels do not
+    hold the GIL while computing.
+
+    :param data: points to index, md.Trajectory or RMSDDataset for
+        metric='rmsd', array [n_points, n_features] otherwise
+    :param metric: 'rmsd' or a metric name understood by ``pairwise_distances``
+    :param leaf_size: maximum number of points in a leaf
+    :param random_state: seed for the choice of vantage points
+    :param n_jobs: number of threads for construction and queries, -1 for
+        one per CPU
+    :param metric_params: keyword arguments of the metric, e.g. ``period``
+        for "periodic"
+    :param p: power of the "minkowski" metric, as for sklearn's neighbor
+        searches; ignored for the other metrics
+    '''
+    def __init__(self, data, metric='rmsd', leaf_size=8, random_state=0, n_jobs=1, metric_params=None, p=None):
+        self.metric = metric
+        self.leaf_size = leaf_size
+        self.n_jobs = n_jobs
+        self.metric_params = dict(metric_params or {})
+        if metric == 'minkowski' and p is not None:
+            self.metric_params.setdefault('p', p)
+        if metric == 'rmsd' and self.metric_params:
+            raise ValueError("metric 'rmsd' takes no metric_params")
+        self.data = self._as_points(data)
+        self._build(np.random.RandomState(random_state))
+
+    def __len__(self):
+        return len(self.data)
+
+    def _as_points(self, X):
+        return as_rmsd_dataset(X) if self.metric == 'rmsd' else np.asarray(X)
+
+    def _distances(self, X, point, frames=None):
+        '''Distances from X (or its `frames`) to data point `point`.'''
+        if self.metric == 'rmsd':
+            return X.rmsd(self.data, point, frames=frames)
+        if frames is not None:
+            X = X[frames]
+        return pairwise_distances(X, self.data, index=point, metric=self.metric, **self.metric_params)
+
+    def _n_threads(self):
+        if self.n_jobs is None:
+            return 1
+        if self.n_jobs < 0:
+            return os.cpu_count() or 1
+        return self.n_jobs
+
+    def _map(self, function, items):
+        n_threads = self._n_threads()
+        if n_threads == 1 or len(items) < 2:
+            return [function(item) for item in items]
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            return list(pool.map(function, items))
+
+    def _split(self, item):
+        # reorders its own slice order[lo:hi] in place; slices of one level
+        # are disjoint, so they can be split concurrently
+        lo, hi, pivot = item
+        points = self.order[lo:hi]
+        points[[0, pivot]] = points[[pivot, 0]]
+        distances = self._distances(self.data, points[0], frames=points[1:])
+        ordering = np.argsort(distances, kind='stable')
+        points[1:] = points[1:][ordering]
+        middle = (len(distances) + 1) // 2
+        return points[0], float(distances[ordering[middle - 1]]), middle
+
+    def _build(self, random_state):
+        # flat arrays: vantage point, radius and children per node; a leaf
+        # has vantage -1 and owns order[start:stop]
+        self.order = np.arange(len(self.data))
+        vantage, mu, inside, outside, start, stop = [], [], [], [], [], []
+
+        def new_node(lo, hi):
+            for field, value in zip((vantage, mu, inside, outside, start, stop), (-1, 0.0, -1, -1, lo, hi)):
+                field.append(value)
+            return len(vantage) - 1
+
+        level = [new_node(0, len(self.data))]
+        while level:
+            level = [node for node in level if stop[node] - start[node] > self.leaf_size]
+            # pivots are drawn here, in node order, so the tree does not
+            # depend on n_jobs
+            items = [(start[node], stop[node], random_state.randint(stop[node] - start[node]))
+                     for node in level]
+            next_level = []
+            for node, (point, radius, middle) in zip(level, self._map(self._split, items)):
+                vantage[node], mu[node] = point, radius
+                lo = start[node] + 1
+                inside[node] = new_node(lo, lo + middle)
+                outside[node] = new_node(lo + middle, stop[node])
+                next_level += [inside[node], outside[node]]
+            level = next_level
+        self.vantage = np.array(vantage, dtype=np.intp)
+        self.mu = np.array(mu, dtype=np.float64)
+        self.inside = np.array(inside, dtype=np.intp)
+        self.outside = np.array(outside, dtype=np.intp)
+        self.start = np.array(start, dtype=np.intp)
+        self.stop = np.array(stop, dtype=np.intp)
+
+    def _batches(self, n_queries):
+        batches = np.array_split(np.arange(n_queries), min(self._n_threads(), max(n_queries, 1)))
+        return [batch for batch in batches if len(batch)]
+
+    def query(self, X, k=1):
+        '''
+        The k nearest indexed points of every frame of X.
+
+        :param X: query points, same kind as the indexed data
+        :param k: number of neighbors
+        :return: distances [n_queries, k], indices [n_queries, k], sorted by distance
+        '''
+        X = self._as_points(X)
+        results = self._map(lambda queries: self._query(X, queries, k), self._batches(len(X)))
+        if not results:
+            return np.zeros((0, k)), np.zeros((0, k), dtype=np.intp)
+        return (np.concatenate([distances for distances, _ in results]),
+                np.concatenate([indices for _, indices in results]))
+
+    def _query(self, X, queries, k):
+        n_queries = len(queries)
+        best = np.full((n_queries, k), np.inf)
+        best_index = np.full((n_queries, k), -1, dtype=np.intp)
+
+        def offer(rows, point, distances):
+            # replace the current worst of the k candidates where closer
+            worst = np.argmax(best[rows], axis=1)
+            closer = distances < best[rows, worst]
+            rows, columns = rows[closer], worst[closer]
+            best[rows, columns] = distances[closer]
+            best_index[rows, columns] = point
+
+        # entries: (node, rows, None) to visit a node, or (child, rows,
+        # (distances, mu, inside)) to visit the far child of a node once the
+        # near child has tightened the bounds; rows index into queries
+        stack = [(0, np.arange(n_queries), None)]
+        while stack:
+            node, rows, deferred = stack.pop()
+            if deferred is not None:
+                distances, mu, inside = deferred
+                tau = best[rows].max(axis=1)
+                if inside:
+                    rows = rows[distances - tau <= mu]
+                else:
+                    rows = rows[distances + tau >= mu]
+            if len(rows) == 0:
+                continue
+            if self.vantage[node] < 0:
+                for point in self.order[self.start[node]:self.stop[node]]:
+                    offer(rows, point, self._distances(X, point, frames=queries[rows]))
+                continue
+            distances = self._distances(X, self.vantage[node], frames=queries[rows])
+            offer(rows, self.vantage[node], distances)
+            mu = self.mu[node]
+            near = distances < mu
+            # every query searches the child on its side first
+            stack.append((self.outside[node], rows[near], (distances[near], mu, False)))
+            stack.append((self.inside[node], rows[~near], (distances[~near], mu, True)))
+            stack.append((self.inside[node], rows[near], None))
+            stack.append((self.outside[node], rows[~near], None))
+        return self._finish(best, best_index)
+
+    def _finish(self, best, best_index):
+        ordering = np.argsort(best, axis=1, kind='stable')
+        return np.take_along_axis(best, ordering, axis=1), np.take_along_axis(best_index, ordering, axis=1)
+
+    def query_radius(self, X, r, return_distance=False):
+        '''
+        All indexed points within distance r (inclusive) of every frame of X.
+
+        :param X: query points, same kind as the indexed data
+        :param r: search radius
+        :param return_distance: also return the distances
+        :return: object array [n_queries,] of index arrays sorted by index,
+            and the matching object array of distances if return_distance
+        '''
+        X = self._as_points(X)
+        neighborhoods = np.empty(len(X), dtype=object)
+        distances = np.empty(len(X), dtype=object)
+        batches = self._batches(len(X))
+        for queries, (batch_neighborhoods, batch_distances) in zip(
+                batches, self._map(lambda queries: self._query_radius(X, queries, r), batches)):
+            # item by item: equal-length arrays would broadcast into the slice
+            for i, neighbors, neighbor_distances in zip(queries, batch_neighborhoods, batch_distances):
+                neighborhoods[i], distances[i] = neighbors, neighbor_distances
+        if return_distance:
+            return neighborhoods, distances
+        return neighborhoods
+
+    def _query_radius(self, X, queries, r):
+        found_rows, found_points, found_distances = [], [], []
+
+        def collect(rows, point, distances):
+            within = distances <= r
+            found_rows.append(rows[within])
+            found_points.append(np.full(np.count_nonzero(within), point, dtype=np.intp))
+            found_distances.append(distances[within])
+
+        # a query descends inside if its ball reaches below mu, outside if
+        # it reaches beyond it
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            node, rows = stack.pop()
+            if len(rows) == 0:
+                continue
+            if self.vantage[node] < 0:
+                for point in self.order[self.start[node]:self.stop[node]]:
+                    collect(rows, point, self._distances(X, point, frames=queries[rows]))
+                continue
+            distances = self._distances(X, self.vantage[node], frames=queries[rows])
+            collect(rows, self.vantage[node], distances)
+            mu = self.mu[node]
+            stack.append((self.inside[node], rows[distances - r <= mu]))
+            stack.append((self.outside[node], rows[distances + r >= mu]))
+        rows = np.concatenate(found_rows + [np.zeros(0, dtype=np.intp)])
+        points = np.concatenate(found_points + [np.zeros(0, dtype=np.intp)])
+        distances = np.concatenate(found_distances + [np.zeros(0, dtype=np.float32)])
+        ordering = np.lexsort((points, rows))
+        bounds = np.searchsorted(rows[ordering], np.arange(1, len(queries)))
+        return np.split(points[ordering], bounds), np.split(distances[ordering], bounds)
+
+    def save(self, filename):
+        '''
+        Save the tree, including its points, to an .npz file.
+
+        :param filename: output file name
+        '''
+        arrays = dict(order=self.order, vantage=self.vantage, mu=self.mu, inside=self.inside,
+                      outside=self.outside, start=self.start, stop=self.stop,
+                      metric=np.array(self.metric), leaf_size=np.array(self.leaf_size))
+        if self.metric == 'rmsd':
+            arrays.update(xyz=self.data.xyz, traces=self.data.traces)
+        else:
+            arrays.update(data=self.data)
+        for name, value in self.metric_params.items():
+            arrays['metric_param_' + name] = np.asarray(value)
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename, n_jobs=1):
+        '''
+        Load a tree written by ``save``.
+
+        :param filename: .npz file
+        :param n_jobs: number of threads for queries
+        :return: VPTree
+        '''
+        tree = cls.__new__(cls)
+        with np.load(filename) as f:
+            tree.metric = str(f['metric'])
+            tree.leaf_size = int(f['leaf_size'])
+            tree.n_jobs = n_jobs
+            if tree.metric == 'rmsd':
+                tree.data = RMSDDataset.from_arrays(f['xyz'], f['traces'])
+            else:
+                tree.data = f['data']
+            for name in ('order', 'vantage', 'mu', 'inside', 'outside', 'start', 'stop'):
+                setattr(tree, name, f[name])
+            tree.metric_params = {}
+            for name in f.files:
+                if name.startswith('metric_param_'):
+                    value = f[name]
+                    tree.metric_params[name[len('metric_param_'):]] = value.item() if value.ndim == 0 else value
+        return tree
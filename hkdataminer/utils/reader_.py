@@ -56,7 +56,7 @@ class TrajReader:
         return framefile_list
 
 class XTCReader(TrajReader):
-    def __init__(self, trajlistName, atomlistName, homedir, trajExt, File_TOP, nSubSample=None):
+    def __init__(self, trajlistName, atomlistName, homedir, trajExt, File_TOP, nSubSample=None, load=True):
         self.trajlistName = trajlistName
         self.atomlistName = atomlistName
         self.trajDir = homedir
@@ -68,7 +68,24 @@ class XTCReader(TrajReader):
         self.trajlist_list = self.get_trajlist(trajlistName, self.homedir)
         self.atom_indices = self.get_atom_indices( atomlistName, self.homedir)
         self.framefile_list = self.get_framefile_list(self.trajlist_list)
-        self.trajs, self.traj_len = self.read_trajs(self.framefile_list)
+        if load:
+            self.trajs, self.traj_len = self.read_trajs(self.framefile_list)
+        else:
+            # frames are streamed with iter_trajs() instead
+            self.trajs, self.traj_len = None, None
+
+    def iter_trajs(self, chunk=1000):
+        '''Iterate over all frames in chunks of at most `chunk` frames
+        without loading the whole data set. Sets traj_len once a full
+        pass has completed.'''
+        traj_len = []
+        for frame in self.framefile_list:
+            n_frames = 0
+            for traj in md.iterload(frame, chunk=chunk, top=self.File_TOP, stride=self.nSubSample):
+                n_frames += len(traj)
+                yield traj
+            traj_len.append(n_frames)
+        self.traj_len = traj_len
 
 
     def read_trajs(self, framelist):
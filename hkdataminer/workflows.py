@@ -12,7 +12,10 @@ def run_clustering(
     iext='xtc',
     n_clusters=100,
     stride=None,
-    output_dir='.'
+    output_dir='.',
+    chunk_size=None,
+    checkpoint=None,
+    resume=False
 ):
     print(f"Running Clustering with n_clusters={n_clusters}, stride={stride}")
     
@@ -20,26 +23,44 @@ def run_clustering(
     phi_file = os.path.join(output_dir, "phi_angles.txt")
     psi_file = os.path.join(output_dir, "psi_angles.txt")
     traj_len_file = os.path.join(output_dir, "traj_len.txt")
-    
-    # Always read trajs if using RMSD
-    print("Reading trajectories...")
-    trajreader = XTCReader(trajListFns, atomListFns, homedir, iext, topology, nSubSample=stride)
-    trajs = trajreader.trajs
-    traj_len = trajreader.traj_len
-    np.savetxt(traj_len_file, traj_len, fmt="%d")
-    
-    if not (os.path.isfile(phi_file) and os.path.isfile(psi_file)):
-        phi_angles, psi_angles = trajreader.get_phipsi(trajs, psi=[6, 8, 14, 16], phi=[4, 6, 8, 14])
-        np.savetxt(phi_file, phi_angles, fmt="%f")
-        np.savetxt(psi_file, psi_angles, fmt="%f")
+    have_phipsi = os.path.isfile(phi_file) and os.path.isfile(psi_file)
+    
+    if chunk_size is None:
+        # Always read trajs if using RMSD
+        print("Reading trajectories...")
+        trajreader = XTCReader(trajListFns, atomListFns, homedir, iext, topology, nSubSample=stride)
+        trajs = trajreader.trajs
+        traj_len = trajreader.traj_len
+        np.savetxt(traj_len_file, traj_len, fmt="%d")
+        
+        if not have_phipsi:
+            phi_angles, psi_angles = trajreader.get_phipsi(trajs, psi=[6, 8, 14, 16], phi=[4, 6, 8, 14])
+            np.savetxt(phi_file, phi_angles, fmt="%f")
+            np.savetxt(psi_file, psi_angles, fmt="%f")
     else:
+        # Stream the trajectories chunk by chunk instead of loading every frame
+        print(f"Streaming trajectories in chunks of {chunk_size} frames...")
+        trajreader = XTCReader(trajListFns, atomListFns, homedir, iext, topology, nSubSample=stride, load=False)
+        trajs = lambda: trajreader.iter_trajs(chunk=chunk_size)
+        if not have_phipsi:
+            phi_chunks, psi_chunks = [], []
+            for traj in trajs():
+                phi_chunk, psi_chunk = trajreader.get_phipsi(traj, psi=[6, 8, 14, 16], phi=[4, 6, 8, 14])
+                phi_chunks.append(phi_chunk)
+                psi_chunks.append(psi_chunk)
+            np.savetxt(phi_file, np.concatenate(phi_chunks), fmt="%f")
+            np.savetxt(psi_file, np.concatenate(psi_chunks), fmt="%f")
+
+    if have_phipsi or chunk_size is not None:
         phi_angles = np.loadtxt(phi_file, dtype=np.float32)
         psi_angles = np.loadtxt(psi_file, dtype=np.float32)
 
     # do Clustering using KCenters method
     print(f"Clustering with KCenters (n={n_clusters})...")
-    cluster = KCenters(n_clusters=n_clusters, metric="rmsd", random_state=0)
+    cluster = KCenters(n_clusters=n_clusters, metric="rmsd", random_state=0, checkpoint=checkpoint, resume=resume)
     cluster.fit(trajs)
+    if chunk_size is not None:
+        np.savetxt(traj_len_file, trajreader.traj_len, fmt="%d")
 
     labels = cluster.labels_
     n_microstates = len(set(labels)) - (1 if -1 in labels else 0)
@@ -61,7 +82,7 @@ def run_clustering(
     try:
         os.chdir(output_dir)
         plot_cluster(labels=labels, phi_angles=phi_angles, psi_angles=psi_angles, name=clustering_name)
-        trajs[cluster_centers_].save(pdb_file)
+        cluster.cluster_center_frames_.save(pdb_file)
     finally:
         os.chdir(original_cwd)
         
@@ -104,7 +125,7 @@ def run_aplod(
     print("Clustering with APLoD (using Phi/Psi angles)...")
     data = np.column_stack((phi_angles, psi_angles))
     
-    cluster = APLoD(rho_cutoff=rho_cutoff, delta_cutoff=delta_cutoff, n_neighbors=n_neighbors, metric='euclidean')
+    cluster = APLoD(rho_cutoff=rho_cutoff, delta_cutoff=delta_cutoff, n_neighbors=n_neighbors, metric='periodic')
     cluster.fit(data)
 
     labels = cluster.labels_
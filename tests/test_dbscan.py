@@ -0,0 +1,245 @@
+import numpy as np
+from scipy.spatial.distance import cdist
+from sklearn.cluster._dbscan_inner import dbscan_inner
+
+
+def test_csr_neighborhoods_match_object_arrays():
+    from hkdataminer.cluster.dbscan_inner_ import csr_neighbor_counts, dbscan_inner_csr
+    from hkdataminer.cluster.faiss_dbscan_ import get_neighborhoods
+    rng = np.random.RandomState(0)
+    D = np.sort(rng.rand(300, 12).astype(np.float32), axis=1)
+    I = rng.randint(0, 300, size=D.shape).astype(np.int64)
+    I[:, 0] = np.arange(300)
+    I[:5, -2:] = -1
+    # faiss distances are squared
+    indptr, indices = get_neighborhoods(D, I, np.sqrt(0.4))
+    assert indices.dtype == np.int32
+    neighborhoods = np.empty(len(D), dtype=object)
+    for i in range(len(D)):
+        neighborhoods[i] = I[i][(D[i] <= 0.4) & (I[i] >= 0)].astype(np.intp)
+        np.testing.assert_array_equal(indices[indptr[i]:indptr[i + 1]], neighborhoods[i])
+
+    weight = rng.rand(300)
+    np.testing.assert_allclose(csr_neighbor_counts(indptr, indices, weight),
+                               [weight[n].sum() for n in neighborhoods])
+
+    # symmetric eps-neighborhoods of chains and blobs
+    X = np.concatenate([np.cumsum(rng.rand(200, 2) * 0.2, axis=0), rng.randn(300, 2) * 2])
+    within = cdist(X, X) <= 0.25
+    indptr = np.concatenate(([0], np.cumsum(within.sum(axis=1))))
+    indices = np.nonzero(within)[1].astype(np.int32)
+    neighborhoods = np.empty(len(X), dtype=object)
+    neighborhoods[:] = [np.flatnonzero(row) for row in within]
+    for min_samples in (2, 4, 7):
+        core = np.asarray(within.sum(axis=1) >= min_samples, dtype=np.uint8)
+        expected = np.full(len(X), -1, dtype=np.intp)
+        dbscan_inner(core, neighborhoods, expected)
+        labels = np.full(len(X), -1, dtype=np.intp)
+        dbscan_inner_csr(core, indptr, indices, labels)
+        np.testing.assert_array_equal(labels, expected)
+
+
+def test_faiss_range_search_is_exact():
+    from hkdataminer.cluster import DBSCAN, Faiss_DBSCAN
+    rng = np.random.RandomState(3)
+    X = np.concatenate([rng.randn(300, 4) * 0.3, rng.randn(300, 4) * 0.3 + 4]).astype(np.float32)
+    reference = DBSCAN(eps=0.35, min_samples=6).fit(X)
+    model = Faiss_DBSCAN(eps=0.35, min_samples=6, IVFFlat=False, batch_size=97).fit(X)
+    np.testing.assert_array_equal(model.labels_, reference.labels_)
+    np.testing.assert_array_equal(model.core_sample_indices_, reference.core_sample_indices_)
+
+
+def test_faiss_index_reuse_and_sweep(tmp_path):
+    from hkdataminer.cluster import Faiss_DBSCAN
+    rng = np.random.RandomState(4)
+    X = np.concatenate([rng.randn(400, 3) * 0.3, rng.randn(400, 3) * 0.3 + 4]).astype(np.float32)
+    model = Faiss_DBSCAN(min_samples=5, nlist=8, nprobe=8, index_dir=str(tmp_path))
+    params = [dict(eps=0.2, min_samples=4), dict(eps=0.4, min_samples=8), dict(eps=0.3, nprobe=2)]
+    results = model.fit_sweep(X, params)
+    index = model.index_
+    assert len(list(tmp_path.iterdir())) == 1
+    for param, (core, labels) in zip(params, results):
+        model.set_params(**param).fit(X)
+        assert model.index_ is index
+        np.testing.assert_array_equal(model.core_sample_indices_, core)
+        np.testing.assert_array_equal(model.labels_, labels)
+        model.set_params(min_samples=5, nprobe=8)
+
+    # a new estimator reads the index written for the same data
+    loaded = Faiss_DBSCAN(eps=0.4, min_samples=8, nlist=8, nprobe=8, index_dir=str(tmp_path)).fit(X)
+    assert loaded.index_.ntotal == len(X)
+    np.testing.assert_array_equal(loaded.labels_, results[1][1])
+
+
+def test_dbscan_sweep_and_optics_ordering(tmp_path):
+    import pytest
+    from sklearn.cluster import OPTICS
+    from hkdataminer.cluster import DBSCAN, radius_graph, dbscan_sweep, optics_ordering
+    from hkdataminer.metrics import KNNGraph
+    rng = np.random.RandomState(5)
+    X = np.concatenate([rng.randn(150, 2) * 0.4, rng.randn(150, 2) * 0.2 + 3, rng.rand(50, 2) * 6])
+    eps, min_samples = [0.15, 0.3, 0.5], [3, 8]
+    graph = radius_graph(X, 0.5)
+    graph.save(str(tmp_path / "radius.npz"))
+    graph = KNNGraph.load(str(tmp_path / "radius.npz"))
+    with pytest.raises(ValueError):
+        graph.radius_csr(0.6)
+    # thresholding some rows only leaves the others empty
+    indptr, indices = graph.radius_csr(0.3)
+    rows = np.arange(0, len(X), 3)
+    sub_indptr, sub_indices = graph.radius_csr(0.3, rows=rows)
+    np.testing.assert_array_equal(np.diff(sub_indptr)[rows], np.diff(indptr)[rows])
+    assert np.diff(sub_indptr).sum() == np.diff(indptr)[rows].sum()
+    np.testing.assert_array_equal(sub_indices, np.concatenate([indices[indptr[i]:indptr[i + 1]] for i in rows]))
+    labels = dbscan_sweep(X, eps, min_samples)
+    np.testing.assert_array_equal(dbscan_sweep(graph, eps, min_samples), labels)
+    for i, radius in enumerate(eps):
+        for j, threshold in enumerate(min_samples):
+            np.testing.assert_array_equal(labels[i, j], DBSCAN(eps=radius, min_samples=threshold).fit(X).labels_)
+
+    ordering, reachability, core_distances, predecessor = optics_ordering(graph, 8)
+    reference = OPTICS(min_samples=8, max_eps=0.5).fit(X)
+    np.testing.assert_array_equal(ordering, reference.ordering_)
+    np.testing.assert_allclose(reachability, reference.reachability_)
+    np.testing.assert_allclose(core_distances, reference.core_distances_)
+    np.testing.assert_array_equal(predecessor, reference.predecessor_)
+
+
+def test_chunked_dbscan_matches_bulk():
+    import mdtraj as md
+    from hkdataminer.cluster import DBSCAN
+    rng = np.random.RandomState(6)
+    X = np.concatenate([rng.randn(400, 3) * 0.3, rng.randn(400, 3) * 0.3 + 3, rng.rand(100, 3) * 6])
+    angles = rng.rand(300, 2) * 360
+    traj = md.Trajectory((rng.randn(4, 8, 3) + 0.05 * rng.randn(60, 4, 8, 3)).reshape(240, 8, 3), None)
+    for X, params in ((X, dict(eps=0.3, min_samples=6)),
+                      (angles, dict(eps=25, min_samples=4, metric="periodic")),
+                      (traj, dict(eps=0.08, min_samples=5, metric="rmsd"))):
+        reference = DBSCAN(**params).fit(X)
+        # a 1 MiB budget splits the samples into many blocks
+        model = DBSCAN(working_memory=1, n_jobs=3, **params).fit(X)
+        np.testing.assert_array_equal(model.labels_, reference.labels_)
+        np.testing.assert_array_equal(model.core_sample_indices_, reference.core_sample_indices_)
+
+
+def test_core_only_storage_gives_same_labels():
+    from hkdataminer.cluster import DBSCAN, Faiss_DBSCAN
+    from hkdataminer.cluster.mr_dbscan_ import MR_DBSCAN
+    rng = np.random.RandomState(7)
+    # mostly noise: few samples are core
+    X = np.concatenate([rng.randn(150, 3) * 0.2, rng.rand(600, 3) * 10]).astype(np.float32)
+    weight = rng.rand(len(X)) * 2
+    for sample_weight in (None, weight):
+        reference = DBSCAN(eps=0.4, min_samples=5).fit(X, sample_weight=sample_weight)
+        for model in (DBSCAN(eps=0.4, min_samples=5, core_only=True, working_memory=1, n_jobs=2),
+                      MR_DBSCAN(eps=0.4, min_samples=5, core_only=True),
+                      Faiss_DBSCAN(eps=0.4, min_samples=5, IVFFlat=False, core_only=True, batch_size=64)):
+            model.fit(X, sample_weight=sample_weight)
+            np.testing.assert_array_equal(model.labels_, reference.labels_)
+            np.testing.assert_array_equal(model.core_sample_indices_, reference.core_sample_indices_)
+
+
+def test_multi_resolution_dbscan():
+    from hkdataminer.cluster import DBSCAN
+    from hkdataminer.cluster.mr_dbscan_ import MR_DBSCAN, merge_assignments
+
+    def merge_loop(new, old, coverage):
+        # per-frame reference of merge_assignments
+        n_clusters = old.max() + 1
+        merged = old.copy()
+        for cluster in range(n_clusters):
+            members = np.flatnonzero(old == cluster)
+            if len(members) and np.mean(new[members] != -1) < coverage:
+                for i in members:
+                    if new[i] != -1:
+                        merged[i] = new[i] + n_clusters
+        return merged
+
+    def canonical(labels):
+        # labels numbered in order of first appearance, noise kept
+        _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        rank = np.argsort(np.argsort(first))
+        return np.where(labels == -1, -1, rank[inverse])
+
+    rng = np.random.RandomState(8)
+    # a wide state holding two dense sub-states, and a dense state
+    X = np.concatenate([rng.randn(300, 2) * 1.0, rng.randn(150, 2) * 0.1 + [0.5, 0.5],
+                        rng.randn(150, 2) * 0.1 - [0.5, 0.5], rng.randn(200, 2) * 0.1 + 6])
+    levels = [0.5, 0.2, 0.1]
+    model = MR_DBSCAN(eps=levels[0], min_samples=10, eps_levels=levels[1:]).fit(X)
+    expected = DBSCAN(eps=levels[0], min_samples=10).fit(X).labels_
+    np.testing.assert_array_equal(model.hierarchy_[0], expected)
+    for level, eps in enumerate(levels[1:], 1):
+        finer = DBSCAN(eps=eps, min_samples=10).fit(X).labels_
+        expected = merge_loop(finer, expected, 0.7)
+        # same clusters; the refined ones are numbered past the old labels
+        np.testing.assert_array_equal(canonical(model.hierarchy_[level]), canonical(expected))
+        assert np.all(model.hierarchy_[level][expected != model.hierarchy_[level - 1]] > model.hierarchy_[level - 1].max())
+    np.testing.assert_array_equal(model.labels_, model.hierarchy_[-1])
+    assert model.hierarchy_.dtype == np.int32 and model.hierarchy_.shape == (3, len(X))
+    # the wide state was refined into sub-states, the dense one kept
+    assert len(np.unique(model.labels_[300:600])) > 1 and len(np.unique(model.labels_[600:])) == 1
+
+    old = rng.randint(-1, 6, size=1000)
+    new = rng.randint(-1, 4, size=1000)
+    np.testing.assert_array_equal(merge_assignments(new, old.copy(), coverage=0.8), merge_loop(new, old, 0.8))
+
+
+def test_compressed_faiss_indexes():
+    from hkdataminer.cluster import DBSCAN, Faiss_DBSCAN
+    from hkdataminer.cluster.aplod_ import FaissNearestNeighbors
+    rng = np.random.RandomState(9)
+    X = np.concatenate([rng.randn(1000, 8) * 0.3, rng.randn(1000, 8) * 0.3 + 3]).astype(np.float32)
+    reference = DBSCAN(eps=0.6, min_samples=8).fit(X)
+    for index_factory in ('IVF4,SQ8', 'IVF4,PQ4x4', 'HNSW16'):
+        reports = []
+        model = Faiss_DBSCAN(eps=0.6, min_samples=8, nprobe=4, index_factory=index_factory, refine_factor=1.5,
+                             report=reports.append).fit(X)
+        if index_factory == 'HNSW16':
+            # graph search may miss a few neighbors
+            assert np.mean(model.labels_ != reference.labels_) < 0.01
+        else:
+            np.testing.assert_array_equal(model.labels_, reference.labels_)
+        assert len(reports) == 1 and reports[0]['n_vectors'] == len(X) and reports[0]['memory'] > 0
+    assert model.index_report_['index'] == 'IndexHNSWFlat'
+    # codes of 4 bytes per vector instead of 32
+    flat = Faiss_DBSCAN(eps=0.6, min_samples=8, IVFFlat=False, report=lambda report: None).fit(X)
+    assert Faiss_DBSCAN(index_factory='PQ4x4', report=reports.append).fit(X).index_report_['memory'] < \
+        flat.index_report_['memory'] / 4
+
+    exact = np.sort(cdist(X, X, 'sqeuclidean'), axis=1)[:, :10]
+    D, I = FaissNearestNeighbors(X, 0.1, 10, 4, 4, return_distance=True, index_factory='IVF4,SQ8', refine_factor=2)
+    np.testing.assert_allclose(D, exact, rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(np.sum((X[I] - X[:, None]) ** 2, axis=2), D, rtol=1e-5, atol=1e-5)
+
+
+def test_batched_knn_search_and_threads():
+    import faiss
+    from hkdataminer.cluster import Faiss_DBSCAN
+    from hkdataminer.cluster.aplod_ import FaissNearestNeighbors
+    from hkdataminer.cluster.faiss_dbscan_ import build_index, faiss_threads, knn_probe_neighbors, knn_search
+    rng = np.random.RandomState(10)
+    X = np.concatenate([rng.randn(600, 4) * 0.3, rng.randn(600, 4) * 0.3 + 3]).astype(np.float32)
+    index = build_index(X, IVFFlat=False)
+    D, I = index.search(X, 30)
+    # same random probes, one batch or many
+    np.random.seed(0)
+    expected = knn_probe_neighbors(index, X, 0.3, 30, batch_size=len(X))
+    np.random.seed(0)
+    indptr, indices = knn_probe_neighbors(index, X, 0.3, 30, batch_size=77)
+    np.testing.assert_array_equal(indptr, expected[0])
+    np.testing.assert_array_equal(indices, expected[1])
+    assert indices.dtype == np.int32
+    batched = knn_search(index, X, 30, refine_factor=2, batch_size=50)
+    np.testing.assert_allclose(batched[0], D, rtol=1e-4, atol=1e-5)
+
+    threads = faiss.omp_get_max_threads()
+    with faiss_threads(2):
+        assert faiss.omp_get_max_threads() == 2
+    assert faiss.omp_get_max_threads() == threads
+    reference = Faiss_DBSCAN(eps=0.3, min_samples=6, IVFFlat=False).fit(X).labels_
+    model = Faiss_DBSCAN(eps=0.3, min_samples=6, IVFFlat=False, search='knn', batch_size=64, n_jobs=2).fit(X)
+    np.testing.assert_array_equal(model.labels_, reference)
+    assert faiss.omp_get_max_threads() == threads
+    np.testing.assert_array_equal(FaissNearestNeighbors(X, 0.1, 8, 4, 4, batch_size=100, n_jobs=1),
+                                  FaissNearestNeighbors(X, 0.1, 8, 4, 4, IVFFlat=False))
@@ -0,0 +1,41 @@
+import numpy as np
+
+from hkdataminer.cluster.density_peaks_ import density_peaks, density_peaks_clustering
+
+
+def test_density_peaks_finds_blob_centers():
+    rng = np.random.RandomState(0)
+    means = np.array([[0.0, 0.0], [10.0, 0.0], [0.0, 10.0]])
+    sizes = (80, 50, 30)
+    X = np.concatenate([mean + 0.5 * rng.randn(size, 2) for mean, size in zip(means, sizes)])
+    blobs = np.repeat(np.arange(3), sizes)
+
+    centers, labels = density_peaks_clustering(X, n_clusters=3, percent=0.02)
+    # one center, the densest point, per blob
+    assert sorted(blobs[centers]) == [0, 1, 2]
+    for center in centers:
+        members = X[blobs == blobs[center]]
+        assert np.linalg.norm(X[center] - members.mean(axis=0)) < 0.5
+    for blob in range(3):
+        assert len(set(labels[blobs == blob])) == 1
+    assert len(set(labels)) == 3
+
+    model = density_peaks(n_clusters=2, percent=0.02, metric="euclidean").fit(X)
+    # the two largest rho * delta: the two densest blobs
+    assert sorted(blobs[model.cluster_centers_]) == [0, 1]
+    assert np.all(model.labels_ >= 0)
+
+
+def test_density_peaks_breaks_ties_by_rank():
+    import pytest
+    # four identical lattice blobs on the corners of a square: the three
+    # lower peaks tie in rho * delta
+    blob = 0.5 * np.array([[i, j] for i in range(-2, 3) for j in range(-2, 3) if abs(i) + abs(j) <= 2])
+    corners = 1000.0 * np.array([[0, 0], [1, 0], [0, 1], [1, 1]])
+    X = np.concatenate([corner + blob for corner in corners])
+    for n_clusters in (1, 2, 3, 4):
+        centers, labels = density_peaks_clustering(X, n_clusters=n_clusters, percent=0.05)
+        assert len(centers) == n_clusters and len(set(labels)) == n_clusters
+        assert np.all(labels >= 0)
+    with pytest.warns(DeprecationWarning):
+        density_peaks_clustering(X, n_clusters=2, rho_cutoff=1.0)
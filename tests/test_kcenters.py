@@ -0,0 +1,354 @@
+import faiss
+import mdtraj as md
+import numpy as np
+import pytest
+from sklearn.metrics.pairwise import pairwise_distances as sk_pairwise_distances
+
+from hkdataminer.cluster import KCenters, k_centers
+
+
+def reference_k_centers(X, n_clusters, seed, metric):
+    distances = sk_pairwise_distances(X, X[[seed]], metric=metric)[:, 0]
+    labels = np.zeros(len(X), dtype=np.int32)
+    centers = [seed]
+    for i in range(1, n_clusters):
+        new_center = int(np.argmax(distances))
+        centers.append(new_center)
+        new_distances = sk_pairwise_distances(X, X[[new_center]], metric=metric)[:, 0]
+        updated = new_distances < distances
+        distances[updated] = new_distances[updated]
+        labels[updated] = i
+    return centers, labels
+
+
+def test_fused_k_centers_matches_reference():
+    rng = np.random.RandomState(0)
+    X = rng.randn(2000, 5).astype(np.float32)
+    for metric in ("euclidean", "sqeuclidean"):
+        centers, labels = k_centers(X, n_clusters=40, metric=metric, random_state=3)
+        ref_centers, ref_labels = reference_k_centers(X.astype(np.float64), 40, 3, metric)
+        assert centers == ref_centers
+        np.testing.assert_array_equal(labels, ref_labels)
+
+
+def test_kcenters_estimator_euclidean():
+    rng = np.random.RandomState(1)
+    X = rng.randn(500, 3)
+    model = KCenters(n_clusters=10, metric="euclidean", random_state=0, n_jobs=1).fit(X)
+    assert len(model.cluster_centers_) == 10
+    assert set(model.labels_) == set(range(10))
+
+
+def random_trajectory(n_frames, n_atoms=10, seed=0):
+    top = md.Topology()
+    residue = top.add_residue("ALA", top.add_chain())
+    for _ in range(n_atoms):
+        top.add_atom("CA", md.element.carbon, residue)
+    rng = np.random.RandomState(seed)
+    return md.Trajectory(rng.randn(n_frames, n_atoms, 3).astype(np.float32), top)
+
+
+def test_kcenters_assign_rmsd_matches_per_frame():
+    trajs = random_trajectory(300)
+    centers = trajs[[0, 17, 42, 99, 250]]
+    expected = np.array([np.argmin(md.rmsd(centers, trajs, i)) for i in range(len(trajs))])
+    model = KCenters(n_clusters=5, metric="rmsd", centers=centers, n_jobs=2)
+    model.assign(trajs, chunk_size=64)
+    np.testing.assert_array_equal(model.labels_, expected)
+    expected_distances = [md.rmsd(trajs[i], centers, label)[0] for i, label in enumerate(expected)]
+    np.testing.assert_allclose(model.distances_, expected_distances, atol=1e-5)
+
+
+def test_streaming_kcenters_matches_in_memory():
+    rng = np.random.RandomState(2)
+    X = rng.randn(1000, 4).astype(np.float32)
+    chunks = [X[i:i + 128] for i in range(0, len(X), 128)]
+    for metric in ("euclidean", "cityblock"):
+        ref_centers, ref_labels = reference_k_centers(X.astype(np.float64), 12, 5, metric)
+        model = KCenters(n_clusters=12, metric=metric, random_state=5).fit(chunks)
+        assert model.cluster_centers_ == ref_centers
+        np.testing.assert_array_equal(model.labels_, ref_labels)
+        np.testing.assert_array_equal(model.cluster_center_frames_, X[ref_centers])
+
+
+def test_streaming_kcenters_rmsd_from_callable():
+    trajs = random_trajectory(400)
+    ref = KCenters(n_clusters=6, metric="rmsd", random_state=0).fit(trajs)
+    model = KCenters(n_clusters=6, metric="rmsd", random_state=0).fit(
+        lambda: (trajs[i:i + 50] for i in range(0, len(trajs), 50)))
+    assert model.cluster_centers_ == [int(c) for c in ref.cluster_centers_]
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+    assert model.cluster_center_frames_.n_frames == 6
+
+    # an RMSDDataset is clustered in memory, like the trajectory
+    from hkdataminer.metrics import RMSDDataset
+    model = KCenters(n_clusters=6, metric="rmsd", random_state=0).fit(RMSDDataset(trajs))
+    assert model.cluster_centers_ == [int(c) for c in ref.cluster_centers_]
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+    np.testing.assert_allclose(model.distances_, ref.distances_, atol=1e-5)
+    assert model.cluster_center_frames_.n_frames == 6
+    model.partial_fit(trajs[:10])
+    assert isinstance(model._blocks[0], RMSDDataset)
+
+
+def test_streaming_kcenters_rmsd_from_memmap(tmp_path):
+    trajs = random_trajectory(300, seed=4)
+    ref = KCenters(n_clusters=6, metric="rmsd", random_state=0).fit(trajs)
+    np.save(str(tmp_path / "xyz.npy"), trajs.xyz)
+    model = KCenters(n_clusters=6, metric="rmsd", random_state=0, chunk_size=100).fit(
+        np.load(str(tmp_path / "xyz.npy"), mmap_mode="r"))
+    assert model.cluster_centers_ == [int(c) for c in ref.cluster_centers_]
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+    assert model.cluster_center_frames_.n_frames == 6
+    centers = trajs[ref.cluster_centers_]
+    for j in range(6):
+        np.testing.assert_allclose(md.rmsd(model.cluster_center_frames_[j], centers, j), 0, atol=1e-3)
+
+
+def test_sharded_kcenters_matches_serial():
+    from hkdataminer.cluster import ShardedKCenters
+    rng = np.random.RandomState(4)
+    X = rng.randn(900, 3)
+    ref_centers, ref_labels = reference_k_centers(X, 15, 7, "euclidean")
+    model = ShardedKCenters(n_clusters=15, metric="euclidean", random_state=7, n_workers=3).fit(X)
+    assert model.cluster_centers_ == ref_centers
+    np.testing.assert_array_equal(model.labels_, ref_labels)
+
+    trajs = random_trajectory(200)
+    ref = KCenters(n_clusters=5, metric="rmsd", random_state=0).fit(trajs)
+    model = ShardedKCenters(n_clusters=5, metric="rmsd", random_state=0, n_workers=2).fit(trajs)
+    assert model.cluster_centers_ == [int(c) for c in ref.cluster_centers_]
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+
+
+def test_sharded_kcenters_over_sockets():
+    import socket
+    import threading
+    import time
+    from hkdataminer.cluster import ShardedKCenters, serve_shard
+    rng = np.random.RandomState(5)
+    X = rng.randn(600, 3)
+    ports = []
+    for _ in range(2):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            ports.append(s.getsockname()[1])
+    shards = [X[:250], X[250:]]
+    servers = [threading.Thread(target=serve_shard, args=(shard, ("127.0.0.1", port), b"secret", "cityblock"))
+               for shard, port in zip(shards, ports)]
+    for server in servers:
+        server.start()
+    time.sleep(1.0)
+    workers = [("127.0.0.1", port) for port in ports]
+    model = ShardedKCenters(n_clusters=10, metric="cityblock", random_state=2, workers=workers,
+                            authkey=b"secret").fit()
+    for server in servers:
+        server.join()
+    ref_centers, ref_labels = reference_k_centers(X, 10, 2, "cityblock")
+    assert model.cluster_centers_ == ref_centers
+    np.testing.assert_array_equal(model.labels_, ref_labels)
+
+
+def test_rmsd_dataset_matches_mdtraj():
+    import warnings
+    from hkdataminer.metrics import RMSDDataset, pairwise_distances
+    trajs = random_trajectory(120, seed=3)
+    dataset = RMSDDataset(trajs)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        distances = dataset.rmsd(frame=7)
+        subset = pairwise_distances(dataset, metric="rmsd", index=7)
+    np.testing.assert_allclose(distances, md.rmsd(trajs, trajs, 7), atol=1e-5)
+    np.testing.assert_allclose(subset, distances, atol=1e-6)
+    np.testing.assert_allclose(dataset[10:20].rmsd(dataset, 7), distances[10:20], atol=1e-6)
+    assert dataset.xyz.ctypes.data % 32 == 0
+
+
+def test_pruned_k_centers_matches_exact():
+    rng = np.random.RandomState(6)
+    X = np.concatenate([rng.randn(300, 3) + offset for offset in (0, 10, 20)])
+    for metric in ("euclidean", "sqeuclidean", "cityblock"):
+        if metric == "cityblock":
+            centers, labels = reference_k_centers(X, 30, 1, metric)
+        else:
+            centers, labels = k_centers(X, n_clusters=30, metric=metric, random_state=1)
+        pruned_centers, pruned_labels, n_skipped = k_centers(X, n_clusters=30, metric=metric, random_state=1,
+                                                             prune=True, return_n_skipped=True)
+        assert pruned_centers == centers
+        np.testing.assert_array_equal(pruned_labels, labels)
+        assert n_skipped > 0
+
+    trajs = random_trajectory(300, seed=2)
+    exact = KCenters(n_clusters=20, metric="rmsd", random_state=0).fit(trajs)
+    pruned = KCenters(n_clusters=20, metric="rmsd", random_state=0, prune=True).fit(trajs)
+    assert [int(c) for c in pruned.cluster_centers_] == [int(c) for c in exact.cluster_centers_]
+    np.testing.assert_array_equal(pruned.labels_, exact.labels_)
+    assert pruned.n_skipped_ > 0
+
+
+def test_hybrid_kmedoids_lowers_cost():
+    from hkdataminer.cluster import HybridKMedoids
+    rng = np.random.RandomState(8)
+    X = rng.randn(600, 2)
+    model = HybridKMedoids(n_clusters=8, metric="euclidean", random_state=0, n_sweeps=4, n_jobs=2).fit(X)
+    centers, labels = k_centers(X, n_clusters=8, metric="euclidean", random_state=0)
+    kcenters_cost = np.linalg.norm(X - X[centers][labels], axis=1).sum()
+    distances = np.linalg.norm(X[:, None] - X[model.cluster_centers_][None], axis=2)
+    np.testing.assert_array_equal(model.labels_, distances.argmin(axis=1))
+    np.testing.assert_allclose(model.distances_, distances.min(axis=1), rtol=1e-6)
+    assert model.inertia_ < kcenters_cost
+
+    trajs = random_trajectory(150, seed=5)
+    model = HybridKMedoids(n_clusters=4, metric="rmsd", random_state=0, n_sweeps=2).fit(trajs)
+    assert model.cluster_center_frames_.n_frames == 4
+    expected = np.array([md.rmsd(trajs, model.cluster_center_frames_, j) for j in range(4)]).argmin(axis=0)
+    np.testing.assert_array_equal(model.labels_, expected)
+
+
+def test_hybrid_kmedoids_prunes_trial_distances(monkeypatch):
+    from hkdataminer.cluster import kmedoids_
+    rng = np.random.RandomState(10)
+    X = np.concatenate([rng.randn(300, 2) * 0.3 + center for center in rng.rand(10, 2) * 20])
+    n_clusters, n_sweeps = 10, 3
+    medoids, labels = k_centers(X, n_clusters=n_clusters, metric="euclidean", random_state=0)
+    distances = np.linalg.norm(X - X[medoids][labels], axis=1)
+    pruned = kmedoids_.hybrid_k_medoids(X, medoids, labels, distances, metric="euclidean", n_sweeps=n_sweeps,
+                                        random_state=1, n_jobs=3, return_n_skipped=True)
+    # a sweep evaluates fewer than n_samples * n_clusters distances
+    assert pruned[4] > 0.25 * n_sweeps * len(X) * n_clusters
+    monkeypatch.delitem(kmedoids_.PRUNE_FACTORS, "euclidean")
+    full = kmedoids_.hybrid_k_medoids(X, medoids, labels, distances, metric="euclidean", n_sweeps=n_sweeps,
+                                      random_state=1, n_jobs=3, return_n_skipped=True)
+    assert full[4] == 0
+    for a, b in zip(pruned[:4], full[:4]):
+        np.testing.assert_array_equal(a, b)
+    all_distances = np.linalg.norm(X[:, None] - X[pruned[0]][None], axis=2)
+    np.testing.assert_array_equal(pruned[1], all_distances.argmin(axis=1))
+
+
+def test_kcenters_checkpoint_resume(tmp_path):
+    import pytest
+    rng = np.random.RandomState(9)
+    X = rng.randn(400, 3)
+    ref = KCenters(n_clusters=20, metric="euclidean", random_state=4).fit(X)
+    chunks = [X[i:i + 100] for i in range(0, len(X), 100)]
+    passes = []
+
+    def interrupted():
+        passes.append(1)
+        if len(passes) > 10:
+            raise KeyboardInterrupt
+        return iter(chunks)
+
+    checkpoint = str(tmp_path / "ckpt")
+    with pytest.raises(KeyboardInterrupt):
+        KCenters(n_clusters=20, metric="euclidean", random_state=4, checkpoint=checkpoint,
+                 checkpoint_interval=3).fit(interrupted)
+    model = KCenters(n_clusters=20, metric="euclidean", random_state=4, checkpoint=checkpoint,
+                     checkpoint_interval=3, resume=True).fit(chunks)
+    assert model.cluster_centers_ == ref.cluster_centers_
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+
+    # a finished in-memory run can be extended with more centers
+    trajs = random_trajectory(200, seed=6)
+    ref = KCenters(n_clusters=12, metric="rmsd", random_state=0).fit(trajs)
+    KCenters(n_clusters=7, metric="rmsd", random_state=0, checkpoint=checkpoint).fit(trajs)
+    model = KCenters(n_clusters=12, metric="rmsd", random_state=0, checkpoint=checkpoint, resume=True).fit(trajs)
+    assert model.cluster_centers_ == [int(c) for c in ref.cluster_centers_]
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+    assert model.cluster_center_frames_.n_frames == 12
+    # but not cut back: its labels refer to all 12 centers
+    with pytest.raises(ValueError):
+        KCenters(n_clusters=10, metric="rmsd", random_state=0, checkpoint=checkpoint, resume=True).fit(trajs)
+    model = KCenters(n_clusters=12, metric="rmsd", random_state=0, checkpoint=checkpoint, resume=True).fit(trajs)
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+
+
+def test_kcenters_predict_uses_cached_index():
+    import pickle
+    rng = np.random.RandomState(10)
+    X = rng.randn(1000, 4).astype(np.float32)
+    model = KCenters(n_clusters=25, metric="euclidean", random_state=0).fit(X)
+    Y = rng.randn(300, 4).astype(np.float32)
+    distances = np.linalg.norm(Y[:, None] - model.cluster_center_frames_[None], axis=2)
+    labels, predicted = model.predict(Y, batch_size=64, return_distance=True)
+    np.testing.assert_array_equal(labels, distances.argmin(axis=1))
+    np.testing.assert_allclose(predicted, distances.min(axis=1), rtol=1e-4)
+    restored = pickle.loads(pickle.dumps(model))
+    assert restored.index_ is not None
+    np.testing.assert_array_equal(restored.predict(Y), labels)
+
+    trajs = random_trajectory(300, seed=7)
+    model = KCenters(n_clusters=30, metric="rmsd", random_state=0).fit(trajs)
+    query = random_trajectory(100, seed=8)
+    expected = np.array([md.rmsd(query, model.cluster_center_frames_, j) for j in range(30)])
+    labels, predicted = model.predict(query, batch_size=40, return_distance=True)
+    np.testing.assert_array_equal(labels, expected.argmin(axis=0))
+    np.testing.assert_allclose(predicted, expected.min(axis=0), atol=1e-5)
+    np.testing.assert_array_equal(pickle.loads(pickle.dumps(model)).predict(query), labels)
+
+
+def test_kcenters_partial_fit():
+    rng = np.random.RandomState(11)
+    X = rng.randn(500, 3)
+    X_new = np.concatenate([rng.randn(200, 3), rng.randn(50, 3) + 8])
+    model = KCenters(n_clusters=10, metric="euclidean", random_state=2).partial_fit(X)
+    ref = KCenters(n_clusters=10, metric="euclidean", random_state=2).fit(X)
+    assert model.cluster_centers_ == ref.cluster_centers_
+    np.testing.assert_array_equal(model.labels_, ref.labels_)
+
+    radius = model.distances_.max()
+    old_labels = model.labels_.copy()
+    model.partial_fit(X_new)
+    data = np.concatenate([X, X_new])
+    assert len(model.cluster_centers_) > 10
+    assert all(center >= len(X) for center in model.cluster_centers_[10:])
+    distances = np.linalg.norm(data[:, None] - data[model.cluster_centers_][None], axis=2)
+    np.testing.assert_array_equal(model.labels_, distances.argmin(axis=1))
+    np.testing.assert_allclose(model.distances_, distances.min(axis=1), rtol=1e-5)
+    assert model.distances_.max() <= radius
+    moved = model.labels_[:len(X)] != old_labels
+    assert np.all(model.labels_[:len(X)][moved] >= 10)
+
+
+def test_kcenters_partial_fit_after_fit(tmp_path):
+    import pickle
+    rng = np.random.RandomState(12)
+    X = rng.randn(500, 3)
+    np.save(str(tmp_path / "X.npy"), X)
+    for source in (X, np.load(str(tmp_path / "X.npy"), mmap_mode="r")):
+        model = KCenters(n_clusters=10, metric="euclidean", random_state=2, chunk_size=64).fit(source)
+        old_centers, old_labels = list(model.cluster_centers_), model.labels_.copy()
+        old_distances = np.linalg.norm(X - X[old_centers][old_labels], axis=1)
+        np.testing.assert_allclose(model.distances_, old_distances, rtol=1e-5)
+        # fit keeps no copy of the data in the pickled model
+        assert len(pickle.dumps(model)) < X.nbytes
+        with pytest.raises(ValueError):
+            pickle.loads(pickle.dumps(model)).partial_fit(X[:10])
+        # new frames just beyond the frame farthest from its center
+        far = int(np.argmax(old_distances))
+        outward = (X[far] - X[old_centers][old_labels[far]]) / old_distances[far]
+        X_new = np.concatenate([rng.randn(200, 3), X[far] + 0.3 * outward + 0.05 * rng.randn(20, 3)])
+        data = np.concatenate([X, X_new])
+        model.partial_fit(X_new)
+        assert model.cluster_centers_[:10] == old_centers and len(model.cluster_centers_) > 10
+        distances = np.linalg.norm(data[:, None] - data[model.cluster_centers_][None], axis=2)
+        np.testing.assert_array_equal(model.labels_, distances.argmin(axis=1))
+        # old frames only move where a new center is strictly closer
+        moved = model.labels_[:len(X)] != old_labels
+        assert moved[far] and np.all(model.labels_[:len(X)][moved] >= 10)
+        assert np.all(distances[:len(X)][moved].min(axis=1) < old_distances[moved])
+        np.testing.assert_array_equal(model.labels_[:len(X)][~moved], old_labels[~moved])
+
+
+def test_kcenters_pickle_round_trip():
+    import pickle
+    from hkdataminer.metrics.vptree_ import VPTree
+    rng = np.random.RandomState(13)
+    X = rng.rand(400, 5)
+    for metric, index_type in (("euclidean", faiss.Index), ("cityblock", VPTree), ("braycurtis", np.ndarray)):
+        model = KCenters(n_clusters=5, metric=metric, random_state=0).fit(X)
+        labels = model.predict(X)
+        restored = pickle.loads(pickle.dumps(model))
+        assert isinstance(restored.index_, index_type)
+        np.testing.assert_array_equal(restored.predict(X), labels)
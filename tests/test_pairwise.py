@@ -0,0 +1,119 @@
+import numpy as np
+from sklearn.metrics.pairwise import pairwise_distances as sk_pairwise_distances
+
+from hkdataminer.metrics import pairwise_distances, pairwise_distances_argmin_min, METRICS
+
+
+def test_native_metrics_match_sklearn():
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 7).astype(np.float32)
+    Y = rng.randn(50, 7).astype(np.float32)
+    Y[0] = 0
+    for metric in ("euclidean", "sqeuclidean", "cityblock", "chebyshev", "cosine"):
+        assert metric in METRICS
+        expected = sk_pairwise_distances(X.astype(np.float64), Y.astype(np.float64), metric=metric)
+        # a working memory of 0 MiB forces one row per block
+        for working_memory, n_jobs in ((1024, None), (0, 2)):
+            D = pairwise_distances(X, Y, metric=metric, working_memory=working_memory, n_jobs=n_jobs)
+            assert D.shape == (300, 50) and D.dtype == np.float32
+            np.testing.assert_allclose(D, expected, rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(pairwise_distances(X, Y, index=3, metric=metric), expected[:, 3],
+                                   rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(pairwise_distances(X, index=5, metric=metric),
+                                   sk_pairwise_distances(X, X[[5]], metric=metric)[:, 0], rtol=1e-4, atol=1e-4)
+
+
+def test_euclidean_precision_off_center():
+    from sklearn.neighbors import NearestNeighbors
+    from hkdataminer.cluster import KCenters
+    from hkdataminer.metrics import kneighbors
+    rng = np.random.RandomState(5)
+    for dtype in (np.float64, np.float32):
+        # close pairs far from the origin, where the float32 norm expansion cancels
+        X = (rng.randn(1000, 10) * 0.01 + 10).astype(dtype)
+        D = pairwise_distances(X)
+        assert D.dtype == dtype and np.all(np.diag(D) == 0)
+        _, indices = kneighbors(X, 8)
+        _, expected = NearestNeighbors(n_neighbors=8).fit(X.astype(np.float64)).kneighbors(X.astype(np.float64))
+        np.testing.assert_array_equal(indices[:, 0], np.arange(len(X)))
+        assert np.mean([set(row) == set(ref) for row, ref in zip(indices, expected)]) > 0.99
+        model = KCenters(n_clusters=40, metric="euclidean", random_state=0).fit(X)
+        labels = model.labels_.copy()
+        model.assign(X, cluster_centers_frames=model.cluster_center_frames_)
+        np.testing.assert_array_equal(model.labels_, labels)
+
+
+def test_argmin_min_and_fallback_metric():
+    rng = np.random.RandomState(1)
+    X = rng.rand(200, 4)
+    Y = rng.rand(20, 4)
+    labels, distances = pairwise_distances_argmin_min(X, Y, metric="cityblock", working_memory=0)
+    expected = sk_pairwise_distances(X, Y, metric="cityblock")
+    np.testing.assert_array_equal(labels, expected.argmin(axis=1))
+    np.testing.assert_allclose(distances, expected.min(axis=1), rtol=1e-5)
+    np.testing.assert_allclose(pairwise_distances(X, Y, metric="braycurtis"),
+                               sk_pairwise_distances(X, Y, metric="braycurtis"))
+
+
+def test_periodic_metric_and_neighbor_searches():
+    from hkdataminer.metrics import kneighbors, radius_neighbors
+    rng = np.random.RandomState(2)
+    X = rng.uniform(-180, 180, size=(400, 2)).astype(np.float32)
+    diff = np.abs(X[:, None] - X[None]) % 360
+    expected = np.sqrt((np.minimum(diff, 360 - diff) ** 2).sum(axis=2))
+    np.testing.assert_allclose(pairwise_distances(X, metric="periodic", working_memory=0), expected, atol=1e-3)
+    np.testing.assert_allclose(pairwise_distances(X, index=4, metric="periodic"), expected[:, 4], atol=1e-3)
+    radians = np.deg2rad(X)
+    np.testing.assert_allclose(pairwise_distances(radians, metric="periodic", period=2 * np.pi),
+                               np.deg2rad(expected), atol=1e-4)
+
+    distances, indices = kneighbors(X, 5, metric="periodic")
+    np.testing.assert_allclose(distances, np.sort(expected, axis=1)[:, :5], atol=1e-3)
+    np.testing.assert_array_equal(indices[:, 0], np.arange(len(X)))
+    neighborhoods = radius_neighbors(X, 30.0, metric="periodic")
+    for i in range(0, len(X), 37):
+        np.testing.assert_array_equal(neighborhoods[i], np.where(expected[i] <= 30.0)[0])
+
+
+def test_periodic_clustering_wraps_around():
+    from hkdataminer.cluster import DBSCAN, KCenters
+    from hkdataminer.cluster.mr_dbscan_ import MR_DBSCAN
+    rng = np.random.RandomState(3)
+    # one blob split by the +-180 boundary, one in the middle
+    X = np.concatenate([rng.normal(0, 3, size=(100, 2)) + [180, 0], rng.normal(0, 3, size=(100, 2))])
+    X = (X + 180) % 360 - 180
+    for model in (DBSCAN(eps=5, min_samples=5, metric="periodic"),
+                  MR_DBSCAN(eps=5, min_samples=5, metric="periodic"),
+                  MR_DBSCAN(eps=5, min_samples=5, metric="periodic", eps_levels=[4])):
+        labels = model.fit(X).labels_
+        assert len(set(labels[:100]) - {-1}) == 1 and len(set(labels[100:]) - {-1}) == 1
+        assert set(labels[:100]) - {-1} != set(labels[100:]) - {-1}
+    model = KCenters(n_clusters=2, metric="periodic", random_state=0).fit(X)
+    assert len(set(model.labels_[:100])) == 1 and len(set(model.labels_[100:])) == 1
+    np.testing.assert_array_equal(model.predict(X), model.labels_)
+
+
+def test_pairwise_rmsd_kernel(tmp_path):
+    import mdtraj as md
+    from scipy.spatial.distance import squareform
+    from hkdataminer.metrics import pairwise_rmsd
+    from hkdataminer.cluster.density_peaks_ import density_peaks
+    rng = np.random.RandomState(3)
+    states = rng.randn(3, 12, 3)
+    xyz = np.concatenate([state + 0.02 * rng.randn(40, 12, 3) for state in states])
+    traj = md.Trajectory(xyz.astype(np.float32), None)
+    expected = np.array([md.rmsd(traj, traj, i) for i in range(len(traj))]).T
+    # md.rmsd leaves float32 noise of ~1e-3 on the diagonal
+    np.fill_diagonal(expected, 0)
+    np.testing.assert_allclose(pairwise_rmsd(traj), expected, atol=1e-4)
+    full = pairwise_rmsd(traj, tile_size=7, filename=str(tmp_path / "full.npy"))
+    np.testing.assert_allclose(np.load(str(tmp_path / "full.npy")), expected, atol=1e-4)
+    np.testing.assert_array_equal(full, full.T)
+    np.testing.assert_allclose(pairwise_distances(traj[:30], traj[50:], metric="rmsd"), expected[:30, 50:], atol=1e-4)
+    condensed = pairwise_rmsd(traj, condensed=True, tile_size=7, filename=str(tmp_path / "rmsd.npy"))
+    assert isinstance(condensed, np.memmap) and condensed.dtype == np.float32
+    np.testing.assert_allclose(squareform(np.load(str(tmp_path / "rmsd.npy")), checks=False), expected, atol=1e-4)
+
+    labels = density_peaks(n_clusters=3, percent=0.02, metric="rmsd").fit(traj).labels_
+    assert [len(set(labels[i:i + 40])) for i in (0, 40, 80)] == [1, 1, 1]
+    assert len(set(labels)) == 3
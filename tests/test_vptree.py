@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import mdtraj as md
+from scipy.spatial.distance import cdist
+
+from hkdataminer.metrics import VPTree
+
+
+def random_trajectory(n_frames, n_atoms=10, seed=0):
+    rng = np.random.RandomState(seed)
+    return md.Trajectory(rng.randn(n_frames, n_atoms, 3).astype(np.float32), None)
+
+
+def test_vptree_queries_are_exact(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(400, 4)
+    D = cdist(X, X)
+    for n_jobs in (1, 3):
+        tree = VPTree(X, metric="euclidean", leaf_size=5, n_jobs=n_jobs)
+        neighborhoods, distances = tree.query_radius(X, 1.0, return_distance=True)
+        for i in range(len(X)):
+            np.testing.assert_array_equal(neighborhoods[i], np.flatnonzero(D[i] <= 1.0))
+            np.testing.assert_allclose(distances[i], D[i, neighborhoods[i]], rtol=1e-5, atol=1e-5)
+        knn_distances, _ = tree.query(X, k=5)
+        np.testing.assert_allclose(knn_distances, np.sort(D, axis=1)[:, :5], rtol=1e-5, atol=1e-5)
+
+    traj = random_trajectory(200)
+    R = np.array([md.rmsd(traj, traj, i) for i in range(len(traj))])
+    radius = np.median(R) / 1.3
+    tree = VPTree(traj, n_jobs=2)
+    tree.save(str(tmp_path / "tree.npz"))
+    loaded = VPTree.load(str(tmp_path / "tree.npz"))
+    for neighbors, loaded_neighbors, row in zip(tree.query_radius(traj, radius),
+                                                loaded.query_radius(traj, radius), R):
+        np.testing.assert_array_equal(neighbors, np.flatnonzero(row <= radius))
+        np.testing.assert_array_equal(loaded_neighbors, neighbors)
+
+
+def test_vptree_metric_params(tmp_path):
+    from hkdataminer.cluster import dbscan
+    rng = np.random.RandomState(3)
+    # angles in radians: with period 2*pi, -3.1 and 3.1 are neighbors
+    X = np.concatenate([rng.uniform(-np.pi, np.pi, (150, 2)), [[-3.1, 0.0], [3.1, 0.0]]])
+    diff = np.abs(X[:, None] - X[None]) % (2 * np.pi)
+    D = np.sqrt((np.minimum(diff, 2 * np.pi - diff) ** 2).sum(axis=2))
+    tree = VPTree(X, metric="periodic", metric_params=dict(period=2 * np.pi), leaf_size=5)
+    tree.save(str(tmp_path / "tree.npz"))
+    for searched in (tree, VPTree.load(str(tmp_path / "tree.npz"))):
+        neighborhoods = searched.query_radius(X, 0.5)
+        for i in range(len(X)):
+            np.testing.assert_array_equal(neighborhoods[i], np.flatnonzero(D[i] <= 0.5 + 1e-6))
+
+    M = rng.randn(200, 3)
+    for p in (1, 3):
+        _, reference = dbscan(M, eps=0.6, min_samples=4, p=p)
+        _, labels = dbscan(M, eps=0.6, min_samples=4, p=p, algorithm="vp_tree")
+        np.testing.assert_array_equal(labels, reference)
+    with pytest.raises(ValueError):
+        VPTree(random_trajectory(10), metric_params=dict(period=1.0))
+
+
+def test_density_clustering_on_trajectory():
+    from hkdataminer.cluster import DBSCAN
+    from hkdataminer.cluster.mr_dbscan_ import MR_DBSCAN
+    from hkdataminer.cluster.aplod_ import run_knn
+    rng = np.random.RandomState(1)
+    # two tight conformational states
+    states = rng.randn(2, 10, 3)
+    xyz = np.concatenate([states[0] + 0.01 * rng.randn(60, 10, 3), states[1] + 0.01 * rng.randn(60, 10, 3)])
+    traj = md.Trajectory(xyz.astype(np.float32), None)
+    for model in (DBSCAN(eps=0.1, min_samples=5, metric="rmsd"), MR_DBSCAN(eps=0.1, min_samples=5, metric="rmsd")):
+        labels = model.fit(traj).labels_
+        assert len(set(labels[:60])) == 1 and len(set(labels[60:])) == 1 and labels[0] != labels[-1]
+        assert model.components_.n_frames == 120
+
+    sample_distances, distances, indices = run_knn(traj, n_neighbors=4, n_samples=20, metric="rmsd")
+    assert sample_distances.shape == (20, 20)
+    assert distances.shape == indices.shape == (120, 4)
+    assert np.all(indices[:60] < 60) and np.all(indices[60:] >= 60)
+
+
+def test_knn_graph_feeds_every_estimator(tmp_path):
+    from scipy import sparse
+    from hkdataminer.metrics import KNNGraph, data_fingerprint
+    from hkdataminer.cluster import DBSCAN, Faiss_DBSCAN
+    from hkdataminer.cluster.mr_dbscan_ import MR_DBSCAN
+    from hkdataminer.cluster.aplod_ import aplod_clustering
+    rng = np.random.RandomState(2)
+    X = np.concatenate([rng.randn(100, 3) * 0.3, rng.randn(100, 3) * 0.3 + 5]).astype(np.float32)
+    graph = KNNGraph.build(X, 30, n_samples=50, random_state=0)
+    graph.check(X, metric="euclidean")
+    with pytest.raises(ValueError):
+        graph.check(X + 1)
+    assert data_fingerprint(sparse.csr_matrix(X)) == graph.fingerprint
+
+    reference = DBSCAN(eps=0.3, min_samples=5).fit(X).labels_
+    for path in (str(tmp_path / "graph.npz"), str(tmp_path / "graph")):
+        graph.save(path)
+        loaded = KNNGraph.load(path)
+        np.testing.assert_array_equal(loaded.to_csr().toarray(), graph.to_csr().toarray())
+        for model in (DBSCAN(eps=0.3, min_samples=5), MR_DBSCAN(eps=0.3, min_samples=5),
+                      Faiss_DBSCAN(eps=0.3, min_samples=5)):
+            np.testing.assert_array_equal(model.fit(loaded).labels_, reference)
+
+    distances, indices = graph.kneighbors(10)
+    centers, labels = aplod_clustering(X, n_neighbors=10, n_samples=50, metric="euclidean", algorithm="precomputed",
+                                       sample_dist_metric=graph.sample_distances, distances_=distances,
+                                       indices=indices)
+    assert aplod_clustering(graph, n_neighbors=10)[1].tolist() == labels.tolist()
+
+    # a cached graph is reused only for the data and metric it was built with
+    cache = str(tmp_path / "graph.npz")
+    graph.save(cache)
+    reused = aplod_clustering(X, n_neighbors=10, metric="euclidean", knn_graph=cache)[1]
+    assert reused.tolist() == labels.tolist()
+    for data, metric in ((X, "cityblock"), (X + 1, "euclidean")):
+        with pytest.warns(UserWarning, match="Rebuilding"):
+            aplod_clustering(data, n_neighbors=10, n_samples=50, metric=metric, knn_graph=cache)
+        KNNGraph.load(cache).check(data, metric)